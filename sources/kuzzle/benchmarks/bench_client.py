@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+from typing import *
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firmware'))
+
+from kuzzle import serializer
+from kuzzle.connection import KuzzleConnection
+from kuzzle.kuzzle import KuzzleIOT
+from simulator.mockkuzzle import MockKuzzleProcess
+
+from benchutil import Report, rate, LOWER
+
+"""
+KuzzleIOT client benchmarks, against a mock Kuzzle started in a child process (or a real Kuzzle with
+--host): connect and reconnect times, publish_state throughput and publish-to-ack latency, receive
+loop dispatch cost, and publish_state called from sensor threads.
+"""
+
+DEVICE_UID = 'buttons_00000000c9591b74'
+STATE = {
+    "button_0": "PRESSED",
+    "button_1": "RELEASED",
+    "button_2": "RELEASED",
+    "button_3": "RELEASED",
+}
+
+
+class AckCounter(object):
+    """
+    Counts the states acknowledged by Kuzzle, by hooking KuzzleConnection.on_publish_done
+    """
+
+    def __init__(self, connection: KuzzleConnection):
+        self.acked = 0
+        self.__waiting = None  # type: Tuple[int, asyncio.Future]
+        on_publish_done = connection.on_publish_done
+
+        def hook(f: asyncio.Future, states):
+            on_publish_done(f, states)
+            if not f.cancelled() and f.exception() is None:
+                self.acked += len(states)
+                if self.__waiting and self.acked >= self.__waiting[0] and not self.__waiting[1].done():
+                    self.__waiting[1].set_result(self.acked)
+
+        connection.on_publish_done = hook
+
+    def wait(self, acked: int) -> asyncio.Future:
+        """
+        :return: a future resolved once acked states in total have been acknowledged
+        """
+        f = asyncio.get_event_loop().create_future()
+        if self.acked >= acked:
+            f.set_result(self.acked)
+        else:
+            self.__waiting = (acked, f)
+        return f
+
+
+def device(connection: KuzzleConnection) -> KuzzleIOT:
+    d = KuzzleIOT(DEVICE_UID, 'button', host=connection.host, port=connection.port, connection=connection)
+    KuzzleIOT.LOG.setLevel(logging.WARNING)  # KuzzleIOT sets it to debug on each instance
+    return d
+
+
+async def bench_connect(report: Report, host: str, port: str, rounds: int):
+    connects = []
+    for _ in range(0, rounds):
+        connection = KuzzleConnection(host, port)
+        t = time.perf_counter()
+        await connection.connect()
+        connects.append(time.perf_counter() - t)
+        await connection.close()
+    report.add_latencies('client.connect', connects)
+
+    # Reconnection without backoff delay, until connected then until the device is subscribed again
+    connection = KuzzleConnection(host, port, reconnect_min_delay=0.0)
+    d = device(connection)
+    await d.connect(None)
+    await d.subscribe_state(lambda state, partial: None)
+    loop = asyncio.get_event_loop()
+    reconnected, resubscribed = None, None
+
+    def on_state(c: KuzzleConnection, state: str):
+        if state == KuzzleConnection.CONNECTED and reconnected and not reconnected.done():
+            reconnected.set_result(time.perf_counter())
+
+    on_subscribe_resp = d.on_subscribe_resp
+
+    def on_resubscribed(resp):
+        on_subscribe_resp(resp)
+        if resubscribed and not resubscribed.done():
+            resubscribed.set_result(time.perf_counter())
+
+    connection.add_state_listener(on_state)
+    d.on_subscribe_resp = on_resubscribed
+    KuzzleConnection.LOG.setLevel(logging.CRITICAL)  # Each disconnection is logged as an error
+    reconnects, resubscribes = [], []
+    for _ in range(0, rounds):
+        reconnected, resubscribed = loop.create_future(), loop.create_future()
+        t = time.perf_counter()
+        await connection.ws.close()
+        reconnects.append(await reconnected - t)
+        resubscribes.append(await resubscribed - t)
+    KuzzleConnection.LOG.setLevel(logging.WARNING)
+    report.add_latencies('client.reconnect', reconnects)
+    report.add_latencies('client.reconnect_resubscribed', resubscribes)
+    await connection.close()
+
+
+async def bench_publish(report: Report, d: KuzzleIOT, acks: AckCounter, count: int):
+    # Throughput: the states published in a burst are drained by the sender coroutine in batches
+    connection = d.connection
+    wakeups = connection.ingress_wakeups
+    target = acks.acked + count
+    t = time.perf_counter()
+    for _ in range(0, count):
+        d.publish_state(STATE)
+    await acks.wait(target)
+    elapsed = time.perf_counter() - t
+    report.add('client.publish.throughput', count / elapsed, 'states/s')
+    report.add('client.publish.states_per_wakeup', count / max(1, connection.ingress_wakeups - wakeups), 'states')
+
+    # Latency: one state at a time, from publish_state to the Kuzzle response
+    latencies = []
+    for _ in range(0, min(count, 2000)):
+        target = acks.acked + 1
+        t = time.perf_counter()
+        d.publish_state(STATE)
+        await acks.wait(target)
+        latencies.append(time.perf_counter() - t)
+    report.add_latencies('client.publish.ack_latency', latencies)
+
+
+def bench_dispatch(report: Report, d: KuzzleIOT, number: int):
+    """
+    Receive loop cost of a realtime notification routed to a subscribed device, without the network
+    """
+    connection = d.connection
+    channel = 'bench-channel'
+    connection.add_channel(channel, d)
+    received = []
+    on_state_changed = d.on_state_changed
+    d.on_state_changed = lambda state, partial: received.append(state)
+
+    notification = serializer.dumps({
+        "status": 200,
+        "requestId": "dashboard-1",
+        "room": channel,
+        "controller": "document",
+        "action": "create",
+        "index": KuzzleConnection.INDEX_IOT,
+        "collection": KuzzleConnection.COLLECTION_DEVICE_STATES,
+        "scope": "in",
+        "result": {"_id": "AWbench", "_source": {
+            "device_id": DEVICE_UID, "device_type": "button", "partial_state": False, "state": STATE}},
+    })
+    decoded = serializer.loads(notification)
+
+    report.add('client.dispatch.notification', rate(lambda: connection.dispatch(decoded), number), 'msg/s')
+    report.add('client.dispatch.decode_notification',
+               rate(lambda: connection.dispatch(serializer.loads(notification)), number), 'msg/s')
+    assert received
+    d.on_state_changed = on_state_changed
+
+
+async def bench_threads(report: Report, d: KuzzleIOT, acks: AckCounter, threads: int, count: int):
+    """
+    publish_state called from sensor threads: cost of a call on the calling thread, and end to end
+    throughput until acknowledged
+    """
+    connection = d.connection
+    loop = asyncio.get_event_loop()
+
+    # Call cost on the event loop thread, as a baseline
+    target = acks.acked + count
+    t = time.perf_counter()
+    for _ in range(0, count):
+        d.publish_state(STATE)
+    report.add('client.threads.call_cost_loop', (time.perf_counter() - t) / count * 1e6, 'us', LOWER)
+    await acks.wait(target)
+
+    per_thread = count // threads
+    call_times = []
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def publisher():
+        start.wait()
+        t = time.perf_counter()
+        for _ in range(0, per_thread):
+            d.publish_state(STATE)
+        with lock:
+            call_times.append(time.perf_counter() - t)
+
+    wakeups = connection.ingress_wakeups
+    target = acks.acked + per_thread * threads
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        t = time.perf_counter()
+        await asyncio.gather(*[loop.run_in_executor(executor, publisher) for _ in range(0, threads)])
+        await acks.wait(target)
+        elapsed = time.perf_counter() - t
+
+    report.add('client.threads.call_cost_thread', sum(call_times) / (per_thread * threads) * 1e6, 'us', LOWER)
+    report.add('client.threads.throughput', per_thread * threads / elapsed, 'states/s')
+    report.add('client.threads.states_per_wakeup',
+               per_thread * threads / max(1, connection.ingress_wakeups - wakeups), 'states')
+
+
+async def bench(report: Report, host: str, port: str, count: int, rounds: int, threads: int):
+    report.section("KuzzleIOT client, ws://{}:{}".format(host, port))
+    await bench_connect(report, host, port, rounds)
+
+    connection = KuzzleConnection(host, port)
+    acks = AckCounter(connection)
+    d = device(connection)
+    await d.connect(None)
+    await d.subscribe_state(lambda state, partial: None)
+
+    await bench_publish(report, d, acks, count)
+    bench_dispatch(report, d, count)
+    await bench_threads(report, d, acks, threads, count)
+    await connection.close()
+    report.end()
+
+
+def run(report: Report, host: str = None, port: str = '17600', count: int = 20000, rounds: int = 20,
+        threads: int = 4):
+    """
+    :param host: Kuzzle host, a mock Kuzzle is started on localhost if not set
+    """
+    logging.basicConfig(level=logging.WARNING)
+    for logger in [KuzzleConnection.LOG, logging.getLogger('websockets')]:
+        logger.setLevel(logging.WARNING)
+
+    mock = None
+    if host is None:
+        host = 'localhost'
+        mock = MockKuzzleProcess(host, int(port))
+        if not mock.start():
+            raise RuntimeError('Mock Kuzzle did not start')
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(bench(report, host, port, count, rounds, threads))
+    finally:
+        loop.close()
+        if mock is not None:
+            mock.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='KuzzleIOT client benchmarks')
+    parser.add_argument('--host', default=None, help='Kuzzle host, a mock Kuzzle is started if not set')
+    parser.add_argument('--port', default='17600', help='Kuzzle port')
+    parser.add_argument('--count', type=int, default=20000, help='states published per measure')
+    parser.add_argument('--rounds', type=int, default=20, help='connections and reconnections measured')
+    parser.add_argument('--threads', type=int, default=4, help='publishing threads')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args()
+
+    report = Report()
+    run(report, args.host, args.port, args.count, args.rounds, args.threads)
+    if args.json:
+        report.save(args.json)
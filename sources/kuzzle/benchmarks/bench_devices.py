@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firmware'))
+
+import hal
+
+hal.load('sim')
+
+from adcscanner import AdcScanner, AdcChannel
+from animation import EFFECTS
+from framebuffer import FrameBuffer
+from hal.sim import Pn532Emulator, SimAdcChannel, SimCard, SimSpi
+from mcp3208 import MCP3208
+from neopixeldevice import NeopixelDevice, LED_PIN
+from pn532 import Pn532
+from pn532transport import FrameParser, Pn532Transport
+
+from benchutil import Report, rate, LOWER
+
+"""
+Device benchmarks on the simulated hardware backend (hal.sim): AdcScanner scans of the eight
+MCP3208 inputs through the emulated spidev ioctl, Pn532 frame builder, parser and command round
+trip over the emulated UART, and the NeopixelDevice render path from a state assignment, or an
+animation frame, to the LED driver.
+
+The driver itself is simulated: the DMA transfer of a real strip (30us per LED) is not included.
+"""
+
+CARDS = [SimCard('04A23BC2', 0.0, 1.0, 0.0), SimCard('8E2F61D4A90480', 0.0, 1.0, 0.0)]
+
+
+def bench_adc(report: Report, number: int, samples: int = 16):
+    # All the inputs are due on each scan: one burst of 8 * samples conversions, over the ioctl path
+    spi = SimSpi({c: SimAdcChannel(offset=256 * c + 128) for c in range(0, 8)})
+    scanner = AdcScanner(MCP3208(5.2, spi=spi))
+    readings = {}
+    for c in range(0, 8):
+        scanner.add_channel(AdcChannel(c, 'channel_{}'.format(c), int, readings.update, period=0.0, samples=samples,
+                                       raw=True))
+
+    scanner.scan()
+    assert spi.conversions == 8 * samples, 'the eight inputs must be read in a single burst'
+    assert readings == {'channel_{}'.format(c): 256 * c + 128 for c in range(0, 8)}
+
+    scans = rate(scanner.scan, number)
+    report.add('adc.scan.8_channels', scans, 'scan/s')
+    report.add('adc.scan.conversions', scans * 8 * samples, 'conv/s')
+
+
+def bench_pn532(report: Report, number: int, rounds: int):
+    pn532 = Pn532(serial_dev=hal.serial('/dev/serial0', 115200))
+    Pn532.LOG.setLevel(logging.WARNING)  # Pn532 sets it to debug on each instance
+
+    poll = bytes([100, 0x01, Pn532.TARGET_MIFARE])
+    report.add('pn532.frame.build', rate(lambda: Pn532Transport.frame(Pn532.CMD_IN_AUTO_POLL, poll), number), 'frame/s')
+
+    targets = Pn532Emulator(CARDS).targets(CARDS)
+    response = Pn532Emulator.response(Pn532.CMD_IN_AUTO_POLL, targets)
+    parser = FrameParser()
+    assert parser.feed(response)[0].data[1:] == targets
+    report.add('pn532.frame.parse', rate(lambda: parser.feed(response), number), 'frame/s')
+
+    # As read from the UART: ACK then response, a few bytes at a time
+    stream = Pn532Transport.ACK + response
+    chunks = [stream[i:i + 8] for i in range(0, len(stream), 8)]
+
+    def feed_chunks():
+        for chunk in chunks:
+            parser.feed(chunk)
+
+    report.add('pn532.frame.parse_chunked', rate(feed_chunks, number // len(chunks)) * 2, 'frame/s')
+    report.add('pn532.targets.parse', rate(lambda: pn532.parse_targets(targets), number), 'resp/s')
+
+    # Command round trip through the transport, the emulated UART and the event loop
+    loop = asyncio.get_event_loop()
+    pn532.transport.open()
+    latencies = []
+
+    async def commands():
+        for _ in range(0, rounds):
+            t = time.perf_counter()
+            await pn532.transport.command(Pn532.CMD_GET_FIRMWARE_VERSION)
+            latencies.append(time.perf_counter() - t)
+
+    loop.run_until_complete(commands())
+    pn532.transport.close()
+    report.add_latencies('pn532.command', latencies)
+
+
+def bench_neopixel(report: Report, led_count: int, number: int):
+    neo = NeopixelDevice(led_count, LED_PIN)
+    NeopixelDevice.LOG.setLevel(logging.WARNING)  # NeopixelDevice sets it to debug on each instance
+
+    ramp = [((i * 37) % 256, (i * 91) % 256, (i * 13) % 256) for i in range(0, led_count)]
+    colors = ['#FF0000', '#0000FF']
+    states = [{'mode': 'single-color', 'color': c} for c in colors]
+    ramp_state = {'mode': 'color-ramp', 'ramp': ramp}
+    i = [0]
+
+    def assign():
+        i[0] += 1
+        neo.state = states[i[0] % 2]
+
+    def fill_show():
+        i[0] += 1
+        neo.frame.fill(i[0] & 0xFFFFFF)
+        neo.show()
+
+    report.add('neopixel.compile_state.ramp', rate(lambda: neo.compile_state(ramp_state), number), 'state/s')
+    report.add('neopixel.state_assign.single_color', rate(assign, number), 'state/s')
+    report.add('neopixel.show.full_frame', rate(fill_show, number), 'frame/s')
+    report.add('neopixel.show.unchanged', rate(neo.show, number), 'frame/s')
+
+    # One animation frame: render at the next frame time, then show
+    palette = FrameBuffer.palette([NeopixelDevice.parse_color(c) for c in ramp])
+    for name in sorted(EFFECTS):
+        effect = EFFECTS[name](neo.frame, palette, {})
+        t = [0.0]
+
+        def frame():
+            t[0] += 1.0 / 30
+            effect.render(t[0])
+            neo.show()
+
+        report.add('neopixel.effect.{}'.format(name), 1e6 / rate(frame, number // 10), 'us/frame', LOWER)
+
+    neo.animation.stop()
+
+
+def run(report: Report, number: int = 20000, rounds: int = 1000, led_count: int = 60):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        report.section("MCP3208, simulated spidev")
+        bench_adc(report, number // 20)
+        report.end()
+        report.section("Pn532, simulated UART")
+        bench_pn532(report, number, rounds)
+        report.end()
+        report.section("Neopixel, {} LEDs, simulated driver".format(led_count))
+        bench_neopixel(report, led_count, number)
+        report.end()
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pn532 and neopixel benchmarks on simulated hardware')
+    parser.add_argument('--number', type=int, default=20000, help='calls per measure')
+    parser.add_argument('--rounds', type=int, default=1000, help='Pn532 commands measured')
+    parser.add_argument('--leds', type=int, default=60, help='LEDs of the neopixel strip')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args()
+
+    report = Report()
+    run(report, args.number, args.rounds, args.leds)
+    if args.json:
+        report.save(args.json)
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import sys
+import json
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firmware'))
+
+from kuzzle import serializer
+from kuzzle.serializer import StateEncoder, DocumentEnvelope
+
+from benchutil import Report, rate
+
+"""
+Microbenchmark of the device state message encoding: messages/second of the former path (one
+json.dumps of the whole query per state) against the pre-serialized envelope path.
+"""
+
+DEVICE_UID = 'buttons_00000000c9591b74'
+DEVICE_TYPE = 'button'
+STATE = {
+    "button_0": "PRESSED",
+    "button_1": "RELEASED",
+    "button_2": "RELEASED",
+    "button_3": "RELEASED",
+}
+
+
+def legacy_encode(request_id: str) -> str:
+    query = {
+        "index": "iot",
+        "collection": "device-state",
+        "requestId": request_id,
+        "controller": "document",
+        "action": "create",
+        "body": {
+            "device_id": DEVICE_UID,
+            "device_type": DEVICE_TYPE,
+            "partial_state": False,
+            "state": STATE
+        }
+    }
+    return json.dumps(query)
+
+
+encoder = StateEncoder(DEVICE_UID, DEVICE_TYPE)
+envelope = DocumentEnvelope("iot", "device-state")
+
+
+def envelope_encode(request_id: str) -> str:
+    return envelope.create(request_id, encoder.encode(STATE))
+
+
+def run(report: Report, number: int = 100000):
+    response = legacy_encode('0123456789ab-1')
+
+    assert json.loads(legacy_encode('rid')) == json.loads(envelope_encode('rid'))
+
+    report.meta["encoder"] = serializer.ENCODER
+    report.section("serializer ({}), messages/s".format(serializer.ENCODER))
+    legacy = report.add('serializer.encode.json_dumps', rate(lambda: legacy_encode('0123456789ab-1'), number),
+                        'msg/s')
+    fast = report.add('serializer.encode.envelope', rate(lambda: envelope_encode('0123456789ab-1'), number), 'msg/s')
+    report.add('serializer.decode.json_loads', rate(lambda: json.loads(response), number), 'msg/s')
+    report.add('serializer.decode.loads', rate(lambda: serializer.loads(response), number), 'msg/s')
+    report.end()
+    print("Encoding speedup: x{:.2f}".format(fast / legacy))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Device state serialization benchmark')
+    parser.add_argument('number', type=int, nargs='?', default=100000, help='messages per run')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args()
+
+    report = Report()
+    run(report, args.number)
+    if args.json:
+        report.save(args.json)
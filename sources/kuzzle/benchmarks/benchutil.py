@@ -0,0 +1,117 @@
+import collections
+import json
+import platform
+import subprocess
+import sys
+import time
+import timeit
+from typing import *
+
+"""
+Helpers shared by the benchmarks: result table, JSON results and their comparison across versions.
+
+The JSON results are {"meta": {...}, "results": {name: {"value", "unit", "better"}}}, "better" tells
+whether a higher or a lower value is an improvement.
+"""
+
+HIGHER = 'higher'
+LOWER = 'lower'
+
+
+def rate(stmt: callable, number: int, repeat: int = 5) -> float:
+    """
+    :return: calls of stmt per second, best of repeat runs of number calls
+    """
+    return number / min(timeit.repeat(stmt, number=number, repeat=repeat))
+
+
+def percentile(samples: List[float], p: float) -> float:
+    """
+    :param samples: sorted samples
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+class Report(object):
+    """
+    Prints the results as they are added and keeps them for the JSON output
+    """
+
+    def __init__(self):
+        self.results = collections.OrderedDict()
+        self.meta = {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        }
+
+    def section(self, title: str):
+        print("+------------------------------------------+----------------+-----------+")
+        print("| {:40} | {:>14} | {:9} |".format(title, 'value', 'unit'))
+        print("+------------------------------------------+----------------+-----------+")
+
+    def add(self, name: str, value: float, unit: str, better: str = HIGHER) -> float:
+        """
+        :param name: unique name of the result, e.g. 'client.publish.throughput'
+        """
+        self.results[name] = {"value": value, "unit": unit, "better": better}
+        print("| {:40} | {:14.2f} | {:9} |".format(name, value, unit))
+        return value
+
+    def add_latencies(self, name: str, samples: List[float]):
+        """
+        Add the p50, p90, p99 and max of latency samples, in ms
+
+        :param samples: latencies in seconds
+        """
+        samples = sorted(samples)
+        for p in [50, 90, 99]:
+            self.add('{}.p{}'.format(name, p), percentile(samples, p) * 1000, 'ms', LOWER)
+        self.add('{}.max'.format(name), samples[-1] * 1000 if samples else 0.0, 'ms', LOWER)
+
+    def end(self):
+        print("+------------------------------------------+----------------+-----------+")
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({"meta": self.meta, "results": self.results}, f, indent=2)
+
+
+def compare(old: dict, new: dict, threshold: float = 0.1) -> List[str]:
+    """
+    Print the results of two JSON result files side by side
+
+    :param threshold: relative change counted as a regression
+    :return: the names of the regressed results
+    """
+    regressions = []
+    print("{} ({}) => {} ({})".format(old["meta"].get("revision"), old["meta"].get("timestamp"),
+                                      new["meta"].get("revision"), new["meta"].get("timestamp")))
+    print("+------------------------------------------+----------------+----------------+----------+")
+    print("| {:40} | {:>14} | {:>14} | {:>8} |".format('result', 'old', 'new', 'change'))
+    print("+------------------------------------------+----------------+----------------+----------+")
+    for name, result in new["results"].items():
+        previous = old["results"].get(name)
+        if previous is None or not previous["value"]:
+            continue
+        change = result["value"] / previous["value"] - 1
+        worse = -change if result["better"] == HIGHER else change
+        flag = ' <<' if worse > threshold else ''
+        if flag:
+            regressions.append(name)
+        print("| {:40} | {:14.2f} | {:14.2f} | {:+7.1%} |{}".format(name, previous["value"], result["value"], change,
+                                                                     flag))
+    print("+------------------------------------------+----------------+----------------+----------+")
+    return regressions
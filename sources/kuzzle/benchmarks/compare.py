@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import sys
+
+from benchutil import compare
+
+"""
+Compares two benchmark result files, e.g. of two firmware versions. Exits with status 1 when a result
+regressed by more than the threshold.
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('old', help='results of the reference version')
+    parser.add_argument('new', help='results of the version to check')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = compare(old, new, args.threshold)
+    if regressions:
+        print("{} regression(s): {}".format(len(regressions), ', '.join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+
+import argparse
+
+from benchutil import Report
+
+import bench_client
+import bench_devices
+import bench_serializer
+
+"""
+Runs every benchmark offline, against a mock Kuzzle and the simulated hardware, and writes the results
+to a single JSON file to be compared with compare.py
+
+Usage, from sources/kuzzle/benchmarks: python3 run_all.py --json results-$(git describe --always).json
+"""
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Kuzzle IoT firmware benchmarks')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations, for a smoke test')
+    parser.add_argument('--port', default='17600', help='port of the mock Kuzzle')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args()
+
+    scale = 10 if args.quick else 1
+    report = Report()
+    bench_serializer.run(report, 100000 // scale)
+    bench_client.run(report, None, args.port, count=20000 // scale, rounds=max(5, 20 // scale))
+    bench_devices.run(report, number=20000 // scale, rounds=1000 // scale)
+    if args.json:
+        report.save(args.json)
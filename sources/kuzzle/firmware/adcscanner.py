@@ -0,0 +1,125 @@
+import logging
+import math
+import time
+from typing import *
+
+import mcp3208
+import metrics
+from filters import SensorFilter
+
+"""
+Single owner of the MCP3208 SPI bus: scans a configured set of channels at their own rate and fans
+readings out to per-channel converters and Kuzzle devices
+"""
+
+
+class Thermistor(object):
+    """
+    NTC thermistor wired from v_ref to the ADC input, with a series resistor from the input to the ground
+    """
+
+    def __init__(self, v_ref: float, r_series: float = 10000.0, r0: float = 10000.0, t0: float = 25.0,
+                 beta: float = 3950.0):
+        """
+        :param r_series: series resistor (Ohm)
+        :param r0: thermistor resistance at t0 (Ohm)
+        :param t0: reference temperature (Celsius)
+        :param beta: thermistor beta coefficient (Kelvin)
+        """
+        self.v_ref = v_ref
+        self.r_series = r_series
+        self.r0 = r0
+        self.t0 = t0 + 273.15
+        self.beta = beta
+
+    def temperature(self, voltage: float) -> float:
+        voltage = min(max(voltage, 1e-6), self.v_ref - 1e-6)
+        r = self.r_series * (self.v_ref - voltage) / voltage
+        return 1.0 / (1.0 / self.t0 + math.log(r / self.r0) / self.beta) - 273.15
+
+
+class AdcChannel(object):
+    def __init__(self, channel: int, key: str, converter: callable, publish: callable, period: float = 1.0,
+                 samples: int = 16, sensor_filter: SensorFilter = None, raw: bool = False):
+        """
+        :param channel: MCP3208 channel
+        :param key: key of the published state holding the converted value
+        :param converter: converts the channel median voltage to the published value
+        :param raw: the converter is given the median raw ADC code instead of the voltage
+        :param publish: called with the state to publish, e.g. KuzzleIOT.publish_state
+        :param period: delay between two readings, in seconds
+        :param samples: ADC samples per reading
+        """
+        self.channel = channel
+        self.key = key
+        self.converter = converter
+        self.publish = publish
+        self.period = period
+        self.samples = samples
+        self.filter = sensor_filter
+        self.raw = raw
+        self.next_due = 0.0
+        self.readings = 0
+        labels = {'channel': channel}
+        self.readings_metric = metrics.counter('adc_readings_total', 'MCP3208 channel readings', labels)
+        self.errors_metric = metrics.counter('adc_reading_errors_total', 'MCP3208 readings failed to convert',
+                                             labels)
+
+
+class AdcScanner(object):
+    LOG = logging.getLogger('ADC')
+
+    def __init__(self, mcp: mcp3208.MCP3208, mode: int = mcp3208.MCP3208.SINGLE):
+        self.mcp = mcp
+        self.mode = mode
+        self.channels = []  # type: List[AdcChannel]
+
+    def add_channel(self, channel: AdcChannel):
+        assert channel.channel not in [c.channel for c in self.channels], \
+            'MCP3208 channel {} is already scanned'.format(channel.channel)
+        self.channels.append(channel)
+
+    def scan(self, now: float = None) -> float:
+        """
+        Read all the channels that are due, channels sharing the same number of samples are read in
+        the same SPI burst
+
+        :return: the time at which the next channel will be due
+        """
+        now = time.monotonic() if now is None else now
+        due = [c for c in self.channels if c.next_due <= now]
+
+        by_samples = {}
+        for c in due:
+            by_samples.setdefault(c.samples, []).append(c)
+
+        for samples, channels in by_samples.items():
+            readings = self.mcp.read_burst(self.mode, [c.channel for c in channels], samples)
+            for c in channels:
+                r = readings[c.channel]
+                self.__dispatch(c, r.median_code if c.raw else r.median_voltage, now)
+
+        return min(c.next_due for c in self.channels)
+
+    def __dispatch(self, c: AdcChannel, reading, now: float):
+        c.readings += 1
+        c.readings_metric.inc()
+        # Drift-free schedule, unless we are late by more than a period
+        c.next_due = c.next_due + c.period if now - c.next_due < c.period else now + c.period
+
+        try:
+            value = c.converter(reading)
+            if c.filter:
+                value = c.filter.update(value, now)
+            if value is not None:
+                c.publish({c.key: value})
+        except Exception as e:
+            c.errors_metric.inc()
+            self.LOG.error('MCP3208 channel %d: %r', c.channel, e)
+
+    @property
+    def period(self) -> float:
+        """
+        Scan period to schedule scan() at: the shortest channel period
+        """
+        return min(c.period for c in self.channels)
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import math
+import time
+from typing import *
+
+import metrics
+from framebuffer import FrameBuffer
+
+"""
+Animation engine of the neopixel strip: effects render frames into the framebuffer, a single frame
+clock shows them at a fixed rate.
+
+Effects are registered by name with the @effect decorator, the name being the light mode of the
+neopixel state. They get the time elapsed since the animation started rather than a frame count,
+so dropped frames don't slow animations down.
+"""
+
+EFFECTS = {}  # type: Dict[str, type]
+
+FRAMES = metrics.counter('neopixel_animation_frames_total', 'Animation frames rendered')
+FRAMES_DROPPED = metrics.counter('neopixel_animation_frames_dropped_total', 'Animation frames dropped, rendered late')
+FRAME_TIME = metrics.histogram('neopixel_frame_render_seconds', 'Render and show time of the animation frames',
+                               buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1))
+
+
+def effect(name: str):
+    """
+    Class decorator registering an Effect subclass for the light mode name
+    """
+
+    def register(cls):
+        EFFECTS[name] = cls
+        return cls
+
+    return register
+
+
+def scale(color: int, k: float) -> int:
+    """
+    :return: color with each 0xWWRRGGBB component multiplied by k, 0 <= k <= 1
+    """
+    return ((int(((color >> 24) & 0xFF) * k) << 24) | (int(((color >> 16) & 0xFF) * k) << 16) |
+            (int(((color >> 8) & 0xFF) * k) << 8) | int((color & 0xFF) * k))
+
+
+def blend(a: int, b: int, k: float) -> int:
+    """
+    :return: the color at k between a (k = 0) and b (k = 1)
+    """
+    color = 0
+    for shift in (24, 16, 8, 0):
+        ca = (a >> shift) & 0xFF
+        cb = (b >> shift) & 0xFF
+        color |= int(ca + (cb - ca) * k) << shift
+    return color
+
+
+class Effect(object):
+    """
+    Base class of the effects. render() draws the frame at t seconds from the start of the animation.
+    A static effect is rendered once.
+    """
+    static = False
+
+    def __init__(self, frame: FrameBuffer, colors: Sequence[int], params: dict):
+        """
+        :param colors: the packed colors of the state, its ramp or its single color
+        :param params: the optional effect parameters of the state: period, speed, length
+        """
+        self.frame = frame
+        self.colors = colors
+        self.params = params
+
+    def render(self, t: float):
+        raise NotImplementedError()
+
+
+@effect('blink')
+class Blink(Effect):
+    def render(self, t: float):
+        half_period = self.params.get('period', 0.2) / 2
+        if int(t / half_period) % 2:
+            self.frame.fill(0)
+        else:
+            self.frame.pattern(self.colors)
+
+
+@effect('cycle')
+class Cycle(Effect):
+    def render(self, t: float):
+        self.frame.pattern(self.colors, int(t * self.params.get('speed', 10)))
+
+
+@effect('fade')
+class Fade(Effect):
+    """
+    The whole strip fades from one color of the ramp to the next one, in period seconds
+    """
+
+    def render(self, t: float):
+        position = t / self.params.get('period', 2.0)
+        i = int(position)
+        count = len(self.colors)
+        self.frame.fill(blend(int(self.colors[i % count]), int(self.colors[(i + 1) % count]), position - i))
+
+
+@effect('breathe')
+class Breathe(Effect):
+    def render(self, t: float):
+        k = (1 - math.cos(2 * math.pi * t / self.params.get('period', 4.0))) / 2
+        self.frame.pattern([scale(int(c), k) for c in self.colors])
+
+
+@effect('chase')
+class Chase(Effect):
+    """
+    A segment of length pixels, colored with the ramp, runs along the strip at speed pixels per second
+    """
+
+    def render(self, t: float):
+        size = len(self.frame)
+        head = int(t * self.params.get('speed', 10))
+        count = len(self.colors)
+        self.frame.fill(0)
+        for i in range(0, min(self.params.get('length', 3), size)):
+            self.frame[(head - i) % size] = self.colors[i % count]
+
+
+@effect('gradient')
+class Gradient(Effect):
+    """
+    Smooth gradient through the ramp colors along the strip, scrolling at speed pixels per second
+    """
+
+    def __init__(self, frame: FrameBuffer, colors: Sequence[int], params: dict):
+        super().__init__(frame, colors, params)
+        size = len(frame)
+        count = len(colors)
+        gradient = []
+        for i in range(0, size):
+            position = i * count / size
+            j = int(position)
+            gradient.append(blend(int(colors[j % count]), int(colors[(j + 1) % count]), position - j))
+        self.gradient = FrameBuffer.palette(gradient)
+        self.static = not params.get('speed', 0)
+
+    def render(self, t: float):
+        self.frame.pattern(self.gradient, int(t * self.params.get('speed', 0)))
+
+
+class AnimationEngine(object):
+    """
+    Plays one effect at a time. Frame n is due at start + n / fps: when rendering falls behind by
+    more than a frame, the late frames are dropped instead of delaying the next ones.
+    """
+
+    LOG = logging.getLogger('Animation')
+
+    def __init__(self, show: callable, fps: float = 30.0, event_loop: asyncio.AbstractEventLoop = None):
+        """
+        :param show: called after each frame is rendered, pushes the framebuffer to the strip
+        """
+        assert fps > 0, "fps must be > 0"
+
+        self.show = show
+        self.fps = fps
+        self.event_loop = event_loop if event_loop else asyncio.get_event_loop()
+        self.effect = None  # type: Effect
+        self.__task = None  # type: asyncio.Task
+
+        self.__started = 0.0
+        self.frames = 0
+        self.dropped = 0
+        self.render_time_last = 0.0
+        self.render_time_max = 0.0
+        self.render_time_total = 0.0
+
+    @property
+    def playing(self) -> bool:
+        return self.__task is not None
+
+    def play(self, e: Effect):
+        """
+        Start an effect, the effect being played is cancelled
+        """
+        self.stop()
+        self.effect = e
+        self.__task = self.event_loop.create_task(self.__run_task(e))
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        self.effect = None
+
+    async def __run_task(self, e: Effect):
+        frame_period = 1.0 / self.fps
+        start = self.event_loop.time()
+        self.__started = start
+        self.frames = 0
+        self.dropped = 0
+        self.render_time_max = 0.0
+        self.render_time_total = 0.0
+        n = 0
+
+        while True:
+            due = start + n * frame_period
+            now = self.event_loop.time()
+            if now - due >= frame_period:
+                late = int((now - due) / frame_period)
+                self.dropped += late
+                FRAMES_DROPPED.inc(late)
+                n += late
+                due = start + n * frame_period
+            await asyncio.sleep(max(due - now, 0))  # Always yield, even when late
+
+            t0 = time.perf_counter()
+            try:
+                e.render(due - start)
+                self.show()
+            except Exception as ex:
+                self.LOG.error('Effect %s failed: %r', type(e).__name__, ex)
+                self.__task = None
+                return
+            self.render_time_last = time.perf_counter() - t0
+            self.render_time_max = max(self.render_time_max, self.render_time_last)
+            self.render_time_total += self.render_time_last
+            self.frames += 1
+            FRAMES.inc()
+            FRAME_TIME.observe(self.render_time_last)
+            n += 1
+
+            if e.static:
+                self.__task = None
+                return
+
+    def stats(self) -> dict:
+        """
+        :return: achieved frame rate and render time (render + show) of the current animation, in seconds
+        """
+        elapsed = self.event_loop.time() - self.__started
+        return {
+            "fps_target": self.fps,
+            "fps": self.frames / elapsed if self.frames and elapsed > 0 else 0.0,
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "render_time_last": self.render_time_last,
+            "render_time_max": self.render_time_max,
+            "render_time_avg": self.render_time_total / self.frames if self.frames else 0.0,
+        }
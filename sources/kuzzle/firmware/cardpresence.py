@@ -0,0 +1,87 @@
+import time
+from typing import *
+
+"""
+Tracks the cards in the field of an RFID reader from successive polls, and turns them into
+debounced enter/leave transitions
+"""
+
+
+class CardPresence(object):
+    """
+    A card enters the field the first time a poll sees it. It leaves the field once it has been
+    missed by leave_misses consecutive polls: a card missed by fewer polls is still in the field,
+    which absorbs the flapping of a card at the edge of the field.
+    """
+
+    def __init__(self, leave_misses: int = 2):
+        assert leave_misses >= 1, "leave_misses must be >= 1"
+
+        self.leave_misses = leave_misses
+        self.cards = {}  # type: Dict[str, dict]  card ID => card, in field order
+        self.__misses = {}  # type: Dict[str, int]
+
+        self.started = time.monotonic()
+        self.polls = 0
+        self.entered = 0
+        self.left = 0
+        self.flaps = 0  # misses absorbed by the debounce
+        self.latency_count = 0
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+
+    def __len__(self):
+        return len(self.cards)
+
+    def update(self, cards: List[dict], latency: float = None) -> Tuple[List[dict], List[dict]]:
+        """
+        Feed the result of a poll
+
+        :param cards: the cards seen by the poll, each with a 'card_id' key
+        :param latency: delay between the poll request and its response, in seconds
+        :return: the cards that entered and the cards that left the field
+        """
+        self.polls += 1
+        if latency is not None and cards:
+            self.latency_count += 1
+            self.latency_last = latency
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_total += latency
+
+        seen = set()
+        entered = []
+        for card in cards:
+            card_id = card['card_id']
+            seen.add(card_id)
+            if card_id not in self.cards:
+                entered.append(card)
+            elif self.__misses[card_id]:
+                self.flaps += 1
+            self.cards[card_id] = card
+            self.__misses[card_id] = 0
+
+        left = []
+        for card_id in [c for c in self.cards if c not in seen]:
+            self.__misses[card_id] += 1
+            if self.__misses[card_id] >= self.leave_misses:
+                left.append(self.cards.pop(card_id))
+                del self.__misses[card_id]
+
+        self.entered += len(entered)
+        self.left += len(left)
+        return entered, left
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "in_field": len(self.cards),
+            "polls": self.polls,
+            "poll_rate": self.polls / elapsed if elapsed > 0 else 0.0,
+            "entered": self.entered,
+            "left": self.left,
+            "flaps": self.flaps,
+            "read_latency_last": self.latency_last,
+            "read_latency_max": self.latency_max,
+            "read_latency_avg": self.latency_total / self.latency_count if self.latency_count else 0.0,
+        }
@@ -0,0 +1,236 @@
+import asyncio
+import collections
+import logging
+import time
+from typing import *
+
+import ruamel.yaml
+
+from kuzzle.connection import KuzzleConnection, REQUEST_TIMEOUT
+
+"""
+Local registry of the RFID cards known by the board, so a card read can be resolved (who/what the
+card is) without a round trip to Kuzzle
+"""
+
+
+class CardRegistry(object):
+    """
+    Resolves card IDs to registry entries (any dict, e.g. {"owner": "alice", "color": "#00FF00"}).
+
+    Entries come from a local YAML file (card ID => entry, never expire) and/or from the iot/rfid-cards
+    Kuzzle collection (document _id = card ID). Kuzzle entries are kept in an LRU cache with a TTL,
+    preloaded on connection and refreshed by a realtime subscription on the collection. Unknown cards
+    are cached too, so they are not looked up again before the TTL expires.
+    """
+
+    COLLECTION_RFID_CARDS = "rfid-cards"
+
+    LOG = logging.getLogger('Cards')
+
+    def __init__(self, path: str = None, connection: KuzzleConnection = None, capacity: int = 256,
+                 ttl: float = 3600.0, lookup_timeout: float = 2.0):
+        """
+        :param path: local registry file, optional
+        :param connection: resolve the cards missing from the local file in Kuzzle, optional
+        :param capacity: maximum number of Kuzzle entries kept in cache
+        :param ttl: lifetime of a cached Kuzzle entry, in seconds
+        :param lookup_timeout: delay to get a card from Kuzzle, in seconds
+        """
+        assert capacity > 0, "capacity must be > 0"
+
+        self.path = path
+        self.connection = connection
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lookup_timeout = lookup_timeout
+        self.device_type = 'card-registry'  # For the connection logs
+        self.on_state_changed = None  # Not a device: the connection must not subscribe it to a state
+
+        self.local = self.load(path) if path else {}
+        self.__cache = collections.OrderedDict()  # type: Dict[str, Tuple[Optional[dict], float]]
+        self.__in_flight = {}  # type: Dict[str, asyncio.Future]
+        self.event_loop = None
+
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self.evictions = 0
+        self.updates = 0
+
+        if connection is not None:
+            connection.attach(self)
+            connection.add_state_listener(self.on_connection_state)
+            if connection.connected:
+                self.on_connection_state(connection, KuzzleConnection.CONNECTED)
+
+    @staticmethod
+    def card_id(card_id: str) -> str:
+        return card_id.upper()
+
+    @staticmethod
+    def load(path: str) -> Dict[str, dict]:
+        """
+        Load a registry file: a mapping of card IDs to entries. Card IDs must be quoted, a card ID
+        made of digits only would be loaded as an integer. Entries that are not mappings are skipped
+        """
+        with open(path) as f:
+            content = ruamel.yaml.YAML(typ='safe').load(f) or {}
+        assert isinstance(content, dict), '{} must be a mapping of card IDs to entries'.format(path)
+        cards = {}
+        for card_id, entry in content.items():
+            assert isinstance(card_id, str), 'Card ID {} must be quoted in {}'.format(card_id, path)
+            if not isinstance(entry, dict):
+                CardRegistry.LOG.warning('Card %s skipped in %s: the entry must be a mapping, got %r', card_id, path,
+                                         entry)
+                continue
+            cards[CardRegistry.card_id(card_id)] = entry
+        CardRegistry.LOG.info('Loaded %d cards from %s', len(cards), path)
+        return cards
+
+    def get(self, card_id: str) -> Tuple[bool, Optional[dict]]:
+        """
+        Cache only lookup, does not block
+
+        :return: (found, entry), entry is None for a card known to be unregistered
+        """
+        if card_id in self.local:
+            self.hits += 1
+            return True, self.local[card_id]
+
+        cached = self.__cache.get(card_id)
+        if cached is not None:
+            entry, expires = cached
+            if expires > time.monotonic():
+                self.__cache.move_to_end(card_id)
+                self.hits += 1
+                return True, entry
+            del self.__cache[card_id]
+
+        self.misses += 1
+        return False, None
+
+    def resolve(self, card_id: str) -> asyncio.Future:
+        """
+        :return: a future resolved with the registry entry of the card, None if unknown. It is already
+                 done when the card is cached
+        """
+        if self.event_loop is None:
+            self.event_loop = asyncio.get_event_loop()
+
+        found, entry = self.get(card_id)
+        if found or self.connection is None:
+            f = self.event_loop.create_future()
+            f.set_result(entry)
+            return f
+
+        if card_id not in self.__in_flight:
+            self.__in_flight[card_id] = self.event_loop.create_future()
+            self.event_loop.create_task(self.__lookup_task(card_id))
+        return self.__in_flight[card_id]
+
+    async def __lookup_task(self, card_id: str):
+        self.lookups += 1
+        query = {
+            "index": KuzzleConnection.INDEX_IOT,
+            "collection": CardRegistry.COLLECTION_RFID_CARDS,
+            "controller": "document",
+            "action": "get",
+            "_id": card_id
+        }
+
+        entry = None
+        try:
+            resp = await self.connection.send(self, query, self.lookup_timeout)
+            if resp["status"] == 200:
+                entry = resp["result"]["_source"]
+                self.put(card_id, entry)
+            elif resp["status"] == 404:
+                self.put(card_id, None)
+            else:
+                self.LOG.warning('Card %s lookup failed: %s', card_id, (resp.get("error") or {}).get("message"))
+        except Exception as e:
+            self.LOG.warning('Card %s lookup failed: %r', card_id, e)
+        finally:
+            self.__in_flight.pop(card_id).set_result(entry)
+
+    def put(self, card_id: str, entry: Optional[dict]):
+        if entry is not None and not isinstance(entry, dict):
+            self.LOG.warning('Card %s: the Kuzzle entry must be an object, got %r', card_id, entry)
+            entry = None
+        self.__cache[card_id] = (entry, time.monotonic() + self.ttl)
+        self.__cache.move_to_end(card_id)
+        while len(self.__cache) > self.capacity:
+            self.__cache.popitem(last=False)
+            self.evictions += 1
+
+    def on_connection_state(self, connection: KuzzleConnection, state: str):
+        if state == KuzzleConnection.CONNECTED:
+            # Changes may have been missed while disconnected
+            self.__cache.clear()
+            if self.event_loop is None:
+                self.event_loop = asyncio.get_event_loop()
+            self.event_loop.create_task(self.__subscribe_task())
+            self.event_loop.create_task(self.__preload_task())
+
+    async def __subscribe_task(self):
+        query = {
+            "index": KuzzleConnection.INDEX_IOT,
+            "collection": CardRegistry.COLLECTION_RFID_CARDS,
+            "controller": "realtime",
+            "action": "subscribe",
+            "body": {}
+        }
+        try:
+            resp = await self.connection.send(self, query)
+        except Exception:
+            return  # Already logged by the connection
+        if resp["status"] == 200:
+            self.connection.add_channel(resp["result"]["channel"], self)
+        else:
+            self.LOG.error('Cards subscription failed: %s', (resp.get("error") or {}).get("message"))
+
+    async def __preload_task(self):
+        query = {
+            "index": KuzzleConnection.INDEX_IOT,
+            "collection": CardRegistry.COLLECTION_RFID_CARDS,
+            "controller": "document",
+            "action": "search",
+            "body": {},
+            "size": self.capacity
+        }
+        try:
+            resp = await self.connection.send(self, query, REQUEST_TIMEOUT)
+        except Exception:
+            return  # Already logged by the connection
+        if resp["status"] == 200:
+            for hit in resp["result"]["hits"]:
+                self.put(self.card_id(hit["_id"]), hit["_source"])
+            self.LOG.info('Preloaded %d cards from Kuzzle', len(resp["result"]["hits"]))
+        else:
+            self.LOG.error('Cards preload failed: %s', (resp.get("error") or {}).get("message"))
+
+    def on_notification(self, resp: dict):
+        card_id = self.card_id(resp["result"]["_id"])
+        self.updates += 1
+        if resp["action"] in ['create', 'createOrReplace', 'replace']:
+            self.put(card_id, resp["result"]["_source"])
+        else:
+            # update notifications hold the changed fields only: get the whole card again on next read
+            self.__cache.pop(card_id, None)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.remove_state_listener(self.on_connection_state)
+            self.connection.detach(self)
+
+    def stats(self) -> dict:
+        return {
+            "local": len(self.local),
+            "cached": len(self.__cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "lookups": self.lookups,
+            "evictions": self.evictions,
+            "updates": self.updates,
+        }
@@ -0,0 +1,91 @@
+import time
+
+"""
+Filtering stage between a sensor and Kuzzle, deciding which samples are worth publishing
+"""
+
+
+class SensorFilter(object):
+    """
+    Deadband, rate-limit and smoothing filter for a stream of sensor values.
+
+    A sample is published when it moved away from the last published value by more than the
+    deadband: max(abs_deadband, rel_deadband * |last published value|). Publishes are never closer
+    than min_interval seconds, and a heartbeat is published at least every max_interval seconds
+    even if the value didn't move.
+    """
+
+    def __init__(self, abs_deadband: float = 0.0, rel_deadband: float = 0.0, min_interval: float = 0.0,
+                 max_interval: float = 0.0, smoothing: float = 0.0):
+        """
+        :param abs_deadband: minimum absolute change to publish a new value
+        :param rel_deadband: minimum change relative to the last published value (0.05 = 5%)
+        :param min_interval: minimum delay in seconds between two publishes, 0 to disable
+        :param max_interval: heartbeat, maximum delay in seconds between two publishes, 0 to disable
+        :param smoothing: exponential smoothing factor in [0, 1[, the weight of the previous smoothed
+                          value. 0 disables smoothing
+        """
+        assert 0.0 <= smoothing < 1.0, "smoothing must be 0 <= smoothing < 1"
+        assert abs_deadband >= 0 and rel_deadband >= 0, "deadbands must be >= 0"
+
+        self.abs_deadband = abs_deadband
+        self.rel_deadband = rel_deadband
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+
+        self.value = None
+        self.last_published = None
+        self.last_publish_ts = 0.0
+
+        self.samples = 0
+        self.published = 0
+
+    @staticmethod
+    def from_config(cfg) -> 'SensorFilter':
+        """
+        Build a filter from a hw config 'filter' entry, missing keys keep their default value
+        """
+        return SensorFilter(
+            abs_deadband=getattr(cfg, 'abs_deadband', 0.0),
+            rel_deadband=getattr(cfg, 'rel_deadband', 0.0),
+            min_interval=getattr(cfg, 'min_interval', 0.0),
+            max_interval=getattr(cfg, 'max_interval', 0.0),
+            smoothing=getattr(cfg, 'smoothing', 0.0),
+        )
+
+    def update(self, value: float, now: float = None):
+        """
+        Feed a new sample to the filter
+
+        :return: the (smoothed) value to publish, or None if the sample must not be published
+        """
+        now = time.monotonic() if now is None else now
+        self.samples += 1
+
+        if self.value is None or not self.smoothing:
+            self.value = value
+        else:
+            self.value = self.smoothing * self.value + (1.0 - self.smoothing) * value
+
+        if self.last_published is not None:
+            elapsed = now - self.last_publish_ts
+            if elapsed < self.min_interval:
+                return None
+
+            heartbeat = self.max_interval and elapsed >= self.max_interval
+            deadband = max(self.abs_deadband, self.rel_deadband * abs(self.last_published))
+            if not heartbeat and abs(self.value - self.last_published) <= deadband:
+                return None
+
+        self.last_published = self.value
+        self.last_publish_ts = now
+        self.published += 1
+        return self.value
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "published": self.published,
+            "publish_ratio": self.published / self.samples if self.samples else 0.0,
+        }
@@ -2,7 +2,6 @@
 
 
 import signal
-import RPi.GPIO as GPIO
 import logging
 import coloredlogs
 import sys
@@ -14,11 +13,21 @@ import ruamel.yaml as YAML
 import time
 import threading
 import asyncio
+import hal
+import metrics
+from hal import GPIO
 from neopixeldevice import NeopixelDevice, LED_PIN, LightMode, ws as ws_
 from utils import *
 from pn532 import Pn532
+from frametrace import FrameCapture
+from cardregistry import CardRegistry
+from filters import SensorFilter
+from scheduler import SamplingScheduler
+from gpioedges import EdgePipeline, EdgePolicy
 from kuzzle.kuzzle import KuzzleIOT
+from kuzzle.connection import KuzzleConnection
 import namedtupled
+from typing import *
 
 yaml = YAML.YAML()
 CONFIG_PATH = '../config'
@@ -46,8 +55,6 @@ default_state = {
 
 # @formatter:on
 
-GPIO.setmode(GPIO.BCM)
-
 buttons = {
     "button_0": "RELEASED",
     "button_1": "RELEASED",
@@ -70,15 +77,41 @@ def init_hw_components(fw_config, hw_config):
     UID = rpi_get_serial()
     log.info('Getting device base UID: %s', UID)
     log.info('Connecting to Kuzzle on {}:{}'.format(kuzzle_cfg.host, kuzzle_cfg.port))
+    reconnect_cfg = getattr(kuzzle_cfg, 'reconnect', None)
+    if reconnect_cfg:
+        connection = KuzzleConnection(kuzzle_cfg.host, kuzzle_cfg.port, reconnect_min_delay=reconnect_cfg.min_delay,
+                                      reconnect_max_delay=reconnect_cfg.max_delay)
+    else:
+        connection = KuzzleConnection(kuzzle_cfg.host, kuzzle_cfg.port)
+    metrics.add_collector(connection.update_metrics)
+
+    if hw_config.connection_led.enabled:
+        connection.add_state_listener(
+            lambda c, state: GPIO.output(hw_config.connection_led.gpio, 1 if c.connected else 0)
+        )
+    batch_cfg = getattr(kuzzle_cfg, 'batch', None)
+    if batch_cfg and batch_cfg.enabled:
+        log.info('Batching device states: max_count = %d, max_delay = %ss', batch_cfg.max_count, batch_cfg.max_delay)
+        connection.enable_batching(KuzzleIOT.INDEX_IOT, KuzzleIOT.COLLECTION_DEVICE_STATES,
+                                   max_count=batch_cfg.max_count, max_delay=batch_cfg.max_delay)
+    queue_cfg = getattr(kuzzle_cfg, 'offline_queue', None)
+    if queue_cfg and queue_cfg.enabled:
+        log.info('Offline queue: %s, max_size = %d, drop_policy = %s', queue_cfg.path, queue_cfg.max_size,
+                 queue_cfg.drop_policy)
+        connection.enable_offline_queue(KuzzleIOT.INDEX_IOT, KuzzleIOT.COLLECTION_DEVICE_STATES, queue_cfg.path,
+                                        max_size=queue_cfg.max_size, drop_policy=queue_cfg.drop_policy,
+                                        replay_max_attempts=getattr(queue_cfg, 'replay_max_attempts', 3))
 
     log.debug("Neopixel: led_count = {}".format(hw_config.rgb_light.led_count))
-    neo = NeopixelDevice(hw_config.rgb_light.led_count, LED_PIN, strip_type=ws_.WS2811_STRIP_GRB)
+    neo = NeopixelDevice(hw_config.rgb_light.led_count, LED_PIN, strip_type=ws_.WS2811_STRIP_GRB,
+                         fps=getattr(hw_config.rgb_light, 'fps', 30))
     devices["kuzzle_neo"] = KuzzleIOT(
         'rgb_light_{}'.format(UID),
         'neopixel-linear',
         host=kuzzle_cfg.host,
         port=kuzzle_cfg.port,
         owner=fw_config.device.owner,
+        connection=connection,
         additional_info={'led_count': hw_config.rgb_light.led_count}
     )
     dev_conn += (devices["kuzzle_neo"].connect(neo.on_kuzzle_connected),)
@@ -88,7 +121,8 @@ def init_hw_components(fw_config, hw_config):
         "RFID_reader",
         host=kuzzle_cfg.host,
         port=kuzzle_cfg.port,
-        owner=fw_config.device.owner
+        owner=fw_config.device.owner,
+        connection=connection
     )
     dev_conn += (devices["kuzzle_rfid"].connect(None),)
 
@@ -98,7 +132,8 @@ def init_hw_components(fw_config, hw_config):
             "motion-sensor",
             host=kuzzle_cfg.host,
             port=kuzzle_cfg.port,
-            owner=fw_config.device.owner
+            owner=fw_config.device.owner,
+            connection=connection
         )
         dev_conn += (devices["kuzzle_motion"].connect(None),)
 
@@ -108,7 +143,8 @@ def init_hw_components(fw_config, hw_config):
             "button",
             host=kuzzle_cfg.host,
             port=kuzzle_cfg.port,
-            owner=fw_config.device.owner
+            owner=fw_config.device.owner,
+            connection=connection
         )
         dev_conn += (devices["kuzzle_buttons"].connect(None),)
 
@@ -117,10 +153,30 @@ def init_hw_components(fw_config, hw_config):
         "light_sensor",
         host=kuzzle_cfg.host,
         port=kuzzle_cfg.port,
-        owner=fw_config.device.owner
+        owner=fw_config.device.owner,
+        connection=connection
     )
     dev_conn += (devices["kuzzle_light"].connect(None),)
 
+    for sensor in getattr(hw_config, 'analog_sensors', None) or []:
+        devices["kuzzle_" + sensor.name] = KuzzleIOT(
+            "{}_{}".format(sensor.name, UID),
+            sensor.type,
+            host=kuzzle_cfg.host,
+            port=kuzzle_cfg.port,
+            owner=fw_config.device.owner,
+            connection=connection
+        )
+        dev_conn += (devices["kuzzle_" + sensor.name].connect(None),)
+
+    delta_cfg = getattr(kuzzle_cfg, 'delta', None)
+    if delta_cfg and delta_cfg.enabled:
+        for name in delta_cfg.devices:
+            if 'kuzzle_' + name in devices:
+                log.info('Publishing %s state changes only, full snapshot every %d publishes or %ss', name,
+                         delta_cfg.snapshot_every, delta_cfg.snapshot_period)
+                devices['kuzzle_' + name].enable_delta(delta_cfg.snapshot_every, delta_cfg.snapshot_period)
+
     asyncio.get_event_loop().run_until_complete(
         asyncio.gather(*dev_conn)
     )
@@ -135,6 +191,7 @@ def init_hw_components(fw_config, hw_config):
         host=kuzzle_cfg.host,
         port=kuzzle_cfg.port,
         owner=fw_config.device.owner,
+        connection=connection,
         additional_info={
             "devices": attached_devices,
             "hw_version": hw_config.hw_version,
@@ -152,7 +209,75 @@ def init_hw_components(fw_config, hw_config):
 
     neo.state = default_state
     neo.publish_state()
-    pn532 = Pn532('/dev/serial0', devices["kuzzle_rfid"].publish_state)
+    rfid_cfg = getattr(hw_config, 'rfid', None)
+    capture_cfg = getattr(rfid_cfg, 'capture', None)
+    if capture_cfg and capture_cfg.enabled:
+        log.info('Capturing the last %d Pn532 UART exchanges to %s', capture_cfg.size, capture_cfg.path)
+        capture = FrameCapture(capture_cfg.size, capture_cfg.path)
+    else:
+        capture = None
+    polling_cfg = getattr(rfid_cfg, 'polling', None)
+    registry_cfg = getattr(fw_config, 'card_registry', None)
+    if registry_cfg and registry_cfg.enabled:
+        on_rfid_state = card_registry_init(registry_cfg, connection)
+    else:
+        on_rfid_state = devices["kuzzle_rfid"].publish_state
+    pn532 = Pn532('/dev/serial0', on_rfid_state, trace=bool(getattr(rfid_cfg, 'trace', 0)),
+                  capture=capture,
+                  idle_polls=getattr(polling_cfg, 'idle_polls', 100),
+                  present_interval=getattr(polling_cfg, 'present_interval', 0.3),
+                  leave_misses=getattr(polling_cfg, 'leave_misses', 2))
+
+
+def card_registry_init(registry_cfg, connection: KuzzleConnection) -> callable:
+    """
+    :return: the RFID state callback: enriches the state with the card registry entry, lights the
+             neopixels with the card color and publishes the state
+    """
+    registry = CardRegistry(
+        path=getattr(registry_cfg, 'path', None),
+        connection=connection if getattr(registry_cfg, 'kuzzle', 1) else None,
+        capacity=getattr(registry_cfg, 'cache_size', 256),
+        ttl=getattr(registry_cfg, 'ttl', 3600.0),
+    )
+    feedback_cfg = getattr(registry_cfg, 'feedback', None)
+
+    def on_card_resolved(state: dict, entry: Optional[dict]):
+        if entry is not None and not isinstance(entry, dict):
+            log.warning('Card %s: invalid registry entry %r, published as unresolved', state['card_id'], entry)
+            entry = None
+        state['card'] = entry
+        if state['in_field'] and feedback_cfg and feedback_cfg.enabled:
+            if entry is None:
+                color = feedback_cfg.unknown_color
+            else:
+                color = entry.get('color', feedback_cfg.default_color)
+            neo.flash(color, feedback_cfg.duration)
+        devices["kuzzle_rfid"].publish_state(state)
+
+    def on_rfid_state(state: dict):
+        f = registry.resolve(state['card_id'])
+        if f.done():
+            on_card_resolved(state, f.result())
+        else:
+            # Enter and leave states of a card being looked up are published in order, once resolved
+            f.add_done_callback(lambda f: on_card_resolved(state, f.result()))
+
+    return on_rfid_state
+
+
+def metrics_init(fw_config):
+    """
+    Share the metrics with the admin webserver, which serves them on its /metrics route
+    """
+    metrics_cfg = getattr(fw_config, 'metrics', None)
+    if not metrics_cfg or not metrics_cfg.enabled:
+        return
+
+    try:
+        metrics.REGISTRY.open(getattr(metrics_cfg, 'path', metrics.DEFAULT_PATH), getattr(metrics_cfg, 'capacity', 256))
+    except OSError as e:
+        log.error('Metrics not shared: %s', e)
 
 
 def logs_init():
@@ -162,35 +287,64 @@ def logs_init():
                         stream=sys.stdout)
 
 
+def edge_policy(cfg, default: EdgePolicy) -> EdgePolicy:
+    """
+    :param cfg: the optional edges section of a GPIO device in the hardware config
+    """
+    return EdgePolicy(
+        debounce=getattr(cfg, 'debounce', default.debounce),
+        glitch=getattr(cfg, 'glitch', default.glitch),
+        coalesce=getattr(cfg, 'coalesce', default.coalesce)
+    )
+
+
 class GpioHandler:
+    BUTTONS_POLICY = EdgePolicy(debounce=0.010, glitch=0.002, coalesce=0.005)
+    MOTION_POLICY = EdgePolicy(debounce=0.050, glitch=0.010, coalesce=0.0)
+
     def __init__(self, hw_config):
         self.hw_config = hw_config
-
-    def on_gpio_changed(self, gpio, level):
-        if gpio in self.hw_config.buttons.gpios:
-            buttons[
-                'button_{}'.format(self.hw_config.buttons.gpios.index(gpio))] = 'PRESSED' if not level else 'RELEASED'
-            log.debug('Buttons state: %s', buttons)
-            devices["kuzzle_buttons"].publish_state(buttons)
-        elif gpio == self.hw_config.motion_sensor.gpio:
-            log.debug('Motion: %s', 'True' if level else 'False')
-            devices["kuzzle_motion"].publish_state({'motion': True if level else False})
-        else:
-            log.warning('Unexpected GPIO: %d', gpio)
-
-    def on_gpio_changed_up(self, channel):
-        time.sleep(0.03)  # 30 ms sleep to make sure the GPIO state is stabilized before reading it
-        self.on_gpio_changed(channel, GPIO.input(channel))
+        self.edges = EdgePipeline(GPIO.input)
+
+    def on_buttons_changed(self, changes):
+        """
+        Buttons changed together are published once, a button changing twice (a short press) is
+        published once per change
+        """
+        changed = set()
+        for change in changes:
+            name = 'button_{}'.format(self.hw_config.buttons.gpios.index(change.gpio))
+            if name in changed:
+                devices["kuzzle_buttons"].publish_state(dict(buttons))
+                changed.clear()
+            buttons[name] = 'PRESSED' if not change.level else 'RELEASED'
+            changed.add(name)
+        log.debug('Buttons state: %s', buttons)
+        devices["kuzzle_buttons"].publish_state(dict(buttons))
+
+    def on_motion_changed(self, changes):
+        for change in changes:
+            log.debug('Motion: %s', 'True' if change.level else 'False')
+            devices["kuzzle_motion"].publish_state({'motion': True if change.level else False})
 
     def motion_sensor_install(self):
-        GPIO.setup(self.hw_config.motion_sensor.gpio, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.hw_config.motion_sensor.gpio, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(self.hw_config.motion_sensor.gpio, GPIO.BOTH, callback=self.on_gpio_changed_up)
+        gpio = self.hw_config.motion_sensor.gpio
+        GPIO.setup(gpio, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        policy = edge_policy(getattr(self.hw_config.motion_sensor, 'edges', None), self.MOTION_POLICY)
+        self.edges.add_pin(gpio, self.on_motion_changed, policy)
+        self.edges.start()
+        GPIO.add_event_detect(gpio, GPIO.BOTH, callback=self.edges.on_edge)
 
     def buttons_install(self):
         GPIO.setup(self.hw_config.buttons.gpios, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        default = edge_policy(getattr(self.hw_config.buttons, 'edges', None), self.BUTTONS_POLICY)
+        overrides = {p.gpio: p for p in getattr(self.hw_config.buttons, 'pin_edges', None) or []}
         for gpio in self.hw_config.buttons.gpios:
-            GPIO.add_event_detect(gpio, GPIO.BOTH, callback=self.on_gpio_changed_up, bouncetime=50)
+            policy = edge_policy(overrides[gpio], default) if gpio in overrides else default
+            self.edges.add_pin(gpio, self.on_buttons_changed, policy)
+        self.edges.start()
+        for gpio in self.hw_config.buttons.gpios:
+            GPIO.add_event_detect(gpio, GPIO.BOTH, callback=self.edges.on_edge)
 
 
 def cleanup(hw_config):
@@ -205,21 +359,89 @@ def cleanup(hw_config):
         'on': False,
     }
 
+    if pn532 and pn532.transport.capture is not None:
+        log.info('Saved %d Pn532 UART exchanges', pn532.transport.capture.save())
+
+    hal.backend().stop()
     GPIO.cleanup()
 
 
-def start_sensing_light(hw_config):
-    log.info("Starting light level sensing thread: reading in MCP channel {}".format(hw_config.light_sensor.mcp_channel))
+def add_adc_scanner_job(scheduler: SamplingScheduler, hw_config):
+    """
+    A single scanner owns the MCP3208: the light sensor and the other analog sensors are all channels of it
+    """
     import tept5700
+    import mcp3208
+    from adcscanner import AdcScanner, AdcChannel, Thermistor
+
+    v_ref = 5.2
+    mcp = mcp3208.MCP3208(v_ref, 0, 0)
+    scanner = AdcScanner(mcp)
+
+    log.info("Light level sensing: reading in MCP channel {}".format(hw_config.light_sensor.mcp_channel))
+    light_cfg = hw_config.light_sensor
+    tept = tept5700.Tept5700(
+        getattr(light_cfg, 'v_ce', 5.2),
+        getattr(light_cfg, 'rl', 10000),
+        mcp_channel=light_cfg.mcp_channel,
+        mcp=mcp,
+        m=getattr(light_cfg, 'm', None),
+        k=getattr(light_cfg, 'k', None),
+        calibration=getattr(light_cfg, 'calibration', None)
+    )
+    filter_cfg = getattr(light_cfg, 'filter', None)
+    scanner.add_channel(AdcChannel(
+        light_cfg.mcp_channel,
+        'level',
+        tept.lux_from_code,
+        devices["kuzzle_light"].publish_state,
+        period=1.0,
+        samples=tept.oversampling,
+        sensor_filter=SensorFilter.from_config(filter_cfg) if filter_cfg else None,
+        raw=True
+    ))
+
+    for sensor in getattr(hw_config, 'analog_sensors', None) or []:
+        if sensor.type == 'thermistor':
+            key, converter = 'temperature', Thermistor(v_ref).temperature
+        else:
+            key, converter = 'voltage', float
 
-    tept = tept5700.Tept5700(5.2, 10000, mcp_channel=hw_config.light_sensor.mcp_channel)
-    try:
-        while 1:
-            voltage, lux = tept.read_lux()
-            devices["kuzzle_light"].publish_state({"level": lux})  # "{:.3f}".format(lux)})
-            time.sleep(1)
-    except KeyboardInterrupt as e:
-        pass
+        log.info("Analog sensor %s (%s): reading in MCP channel %d", sensor.name, sensor.type, sensor.mcp_channel)
+        filter_cfg = getattr(sensor, 'filter', None)
+        scanner.add_channel(AdcChannel(
+            sensor.mcp_channel,
+            key,
+            converter,
+            devices["kuzzle_" + sensor.name].publish_state,
+            period=getattr(sensor, 'period', 1.0),
+            samples=getattr(sensor, 'samples', 16),
+            sensor_filter=SensorFilter.from_config(filter_cfg) if filter_cfg else None
+        ))
+
+    scheduler.add_job('adc_scanner', scanner.scan, scanner.period)
+
+
+def start_scheduler(fw_config, hw_config, gpio_handler: GpioHandler = None) -> SamplingScheduler:
+    sched_cfg = getattr(fw_config, 'scheduler', None)
+    scheduler = SamplingScheduler(max_workers=getattr(sched_cfg, 'workers', 2))
+
+    add_adc_scanner_job(scheduler, hw_config)
+    scheduler.add_job('pn532_polling', pn532.poll, 0, offload=False)  # Back to back, non blocking I/O
+
+    metrics_cfg = getattr(fw_config, 'metrics', None)
+    if metrics_cfg and metrics_cfg.enabled:
+        scheduler.add_job('metrics', metrics.REGISTRY.collect, getattr(metrics_cfg, 'period', 5), offload=False)
+
+    stats_period = getattr(sched_cfg, 'stats_period', 0)
+    if stats_period:
+        scheduler.add_job('scheduler_stats', scheduler.log_stats, stats_period, offload=False)
+        scheduler.add_job('neopixel_stats', neo.log_render_stats, stats_period, offload=False)
+        if gpio_handler is not None:
+            scheduler.add_job('gpio_stats', gpio_handler.edges.log_stats, stats_period, offload=False)
+
+    scheduler.start()
+    return scheduler
 
 
 class SignalHandler:
@@ -251,6 +473,11 @@ def startup():
     hw_config = namedtupled.map(hw_config)
     kuzzle_config = fw_config.kuzzle
 
+    hal_cfg = getattr(fw_config, 'hal', None)
+    hal.load(getattr(hal_cfg, 'backend', 'rpi'), getattr(hal_cfg, 'sim', None))
+    GPIO.setmode(GPIO.BCM)
+    metrics_init(fw_config)
+
     sh = SignalHandler(hw_config)
     signal.signal(signal.SIGTERM, sh.on_sigterm)
 
@@ -287,14 +514,9 @@ def startup():
             if hw_config.buttons.enabled:
                 gpio_handler.buttons_install()
 
-            pn532_thread = threading.Thread(target=pn532.start_polling, name="pn532_polling")
-            pn532_thread.daemon = True
-            pn532_thread.start()
+            hal.backend().start()
 
-            light_sensor_thread = threading.Thread(target=start_sensing_light, args=(hw_config,),
-                                                   name="light_sensor")
-            light_sensor_thread.daemon = True
-            light_sensor_thread.start()
+            start_scheduler(fw_config, hw_config, gpio_handler)
         else:
             log.warning("Unable to connect to Kuzzle...")
             retry -= 1
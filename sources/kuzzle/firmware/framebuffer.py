@@ -0,0 +1,96 @@
+import array
+from typing import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Framebuffer of a LED strip: modes render whole frames of packed 0xWWRRGGBB colors into it, and only
+the pixels that changed since the last frame shown are written to the driver
+"""
+
+
+class FrameBuffer(object):
+    def __init__(self, size: int):
+        self.size = size
+        if numpy is not None:
+            self.pixels = numpy.zeros(size, dtype=numpy.uint32)
+            self.__shown = numpy.zeros(size, dtype=numpy.uint32)
+        else:
+            self.pixels = array.array('I', [0]) * size
+            self.__shown = array.array('I', [0]) * size
+        self.__invalid = False
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i: int) -> int:
+        return int(self.pixels[i])
+
+    def __setitem__(self, i: int, color: int):
+        self.pixels[i] = color
+
+    @staticmethod
+    def palette(colors: Sequence[int]):
+        """
+        :return: colors in the framebuffer pixel format, to render them repeatedly without conversion
+        """
+        if numpy is not None:
+            return numpy.asarray(colors, dtype=numpy.uint32)
+        return array.array('I', colors)
+
+    def fill(self, color: int):
+        if numpy is not None:
+            self.pixels.fill(color)
+        else:
+            self.pixels[:] = array.array('I', [color]) * self.size
+
+    def pattern(self, colors: Sequence[int], offset: int = 0):
+        """
+        Repeat colors along the strip, shifted by offset pixels
+        """
+        count = len(colors)
+        if numpy is not None:
+            self.pixels[:] = numpy.asarray(colors, dtype=numpy.uint32)[(numpy.arange(self.size) + offset) % count]
+        else:
+            self.pixels[:] = array.array('I', [colors[(i + offset) % count] for i in range(0, self.size)])
+
+    @property
+    def dirty(self) -> bool:
+        if self.__invalid:
+            return True
+        if numpy is not None:
+            return not numpy.array_equal(self.pixels, self.__shown)
+        return self.pixels != self.__shown
+
+    def invalidate(self):
+        """
+        Next flush() returns all the pixels, e.g. the driver buffer has been overwritten
+        """
+        self.__invalid = True
+
+    def flush(self) -> List[Tuple[int, int]]:
+        """
+        Mark the frame as shown
+
+        :return: the (index, color) pixels changed since the last frame shown
+        """
+        if numpy is not None:
+            if self.__invalid:
+                changed = numpy.arange(self.size)
+            else:
+                changed = numpy.flatnonzero(self.pixels != self.__shown)
+            colors = self.pixels[changed]
+            self.__shown[changed] = colors
+            self.__invalid = False
+            return list(zip(changed.tolist(), colors.tolist()))
+
+        if not self.__invalid and self.pixels == self.__shown:
+            return []
+        shown = self.__shown
+        changed = [(i, c) for i, c in enumerate(self.pixels) if self.__invalid or c != shown[i]]
+        shown[:] = self.pixels
+        self.__invalid = False
+        return changed
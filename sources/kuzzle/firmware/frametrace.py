@@ -0,0 +1,93 @@
+import collections
+import os
+import struct
+import time
+from typing import *
+
+"""
+Debugging aids for serial links: lazy hex formatting for log messages, and a compact binary capture
+of the raw bytes exchanged, for offline analysis or to replay a session against a fake serial port
+"""
+
+
+class HexBytes(object):
+    """
+    Formats bytes as hex only when converted to a string, i.e. when the log record is emitted:
+    LOG.debug('> %s', HexBytes(frame)) costs nothing when debug logs are disabled
+    """
+    __slots__ = ['data']
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __str__(self):
+        try:
+            return bytes(self.data).hex(' ')
+        except TypeError:  # Python < 3.8, no separator argument
+            h = bytes(self.data).hex()
+            return ' '.join([h[i:i + 2] for i in range(0, len(h), 2)])
+
+
+# A captured chunk of bytes: time.time() timestamp, direction (FrameCapture.TX or RX) and raw bytes
+CapturedFrame = collections.namedtuple('CapturedFrame', ['timestamp', 'direction', 'data'])
+
+
+class FrameCapture(object):
+    """
+    Keeps the last captured chunks in memory, saved to a file on demand.
+
+    File format: a sequence of records, each one a little endian header (float64 timestamp, uint8
+    direction, uint16 length) followed by the raw bytes.
+    """
+
+    TX = 0
+    RX = 1
+
+    RECORD_HEADER = struct.Struct('<dBH')
+
+    def __init__(self, capacity: int = 1000, path: str = None):
+        """
+        :param capacity: number of chunks kept, the oldest are dropped
+        :param path: default file written by save()
+        """
+        self.path = path
+        self.frames = collections.deque(maxlen=capacity)  # type: Deque[CapturedFrame]
+
+    def record(self, direction: int, data: bytes):
+        self.frames.append(CapturedFrame(time.time(), direction, bytes(data)))
+
+    def save(self, path: str = None) -> int:
+        """
+        Write the captured chunks, oldest first
+
+        :return: the number of chunks written
+        """
+        path = path if path else self.path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        frames = list(self.frames)
+        with open(path, 'wb') as f:
+            for frame in frames:
+                f.write(FrameCapture.RECORD_HEADER.pack(frame.timestamp, frame.direction, len(frame.data)))
+                f.write(frame.data)
+        return len(frames)
+
+    @staticmethod
+    def load(path: str) -> Iterator[CapturedFrame]:
+        header_size = FrameCapture.RECORD_HEADER.size
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(header_size)
+                if len(header) < header_size:
+                    return
+                timestamp, direction, length = FrameCapture.RECORD_HEADER.unpack(header)
+                yield CapturedFrame(timestamp, direction, f.read(length))
+
+
+if __name__ == '__main__':
+    import sys
+
+    for frame in FrameCapture.load(sys.argv[1]):
+        print('{:.6f} {} {}'.format(frame.timestamp, '>' if frame.direction == FrameCapture.TX else '<',
+                                    HexBytes(frame.data)))
@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import logging
+from typing import *
+
+"""
+GPIO edge pipeline: the GPIO callback thread only timestamps edges and queues them, debounce, glitch
+filtering and coalescing are done on the event loop
+"""
+
+# A raw edge, as seen by the GPIO callback thread. ts is an event loop time
+Edge = collections.namedtuple('Edge', ['gpio', 'level', 'ts'])
+
+# A debounced level change. ts is the time of the first edge of the change
+Change = collections.namedtuple('Change', ['gpio', 'level', 'ts'])
+
+# Filtering of a pin, in seconds:
+# - debounce: the level is read once no edge happened for debounce seconds
+# - glitch: pulses shorter than glitch are noise. A longer pulse that ended before the level settled
+#   is still reported, as a change and a change back: a short press is never lost
+# - coalesce: changes of the pins sharing a callback within coalesce seconds are delivered together
+EdgePolicy = collections.namedtuple('EdgePolicy', ['debounce', 'glitch', 'coalesce'])
+EdgePolicy.__new__.__defaults__ = (0.010, 0.002, 0.0)
+
+
+class EdgePin(object):
+    def __init__(self, gpio: int, level: int, callback: callable, policy: EdgePolicy):
+        self.gpio = gpio
+        self.callback = callback
+        self.policy = policy
+        self.stable = level  # last level reported
+        self.raw = level  # level read on the last edge
+        self.raw_ts = 0.0
+        self.first_edge = None  # type: float
+        self.pulse = False  # a pulse longer than policy.glitch happened since the last report
+        self.timer = None  # type: asyncio.TimerHandle
+
+
+class EdgePipeline(object):
+    """
+    Usage: add_pin() each pin, start(), then give on_edge() as the GPIO edge callback (both edges)
+    """
+
+    LOG = logging.getLogger('GPIO')
+
+    def __init__(self, read: callable, event_loop: asyncio.AbstractEventLoop = None):
+        """
+        :param read: returns the current level of a GPIO, e.g. RPi.GPIO.input
+        """
+        self.read = read
+        self.event_loop = event_loop if event_loop else asyncio.get_event_loop()
+        self.__pins = {}  # type: Dict[int, EdgePin]
+        self.__queue = asyncio.Queue()
+        self.__batches = {}  # type: Dict[callable, List[Change]]
+        self.__task = None  # type: asyncio.Task
+
+        self.edges = 0
+        self.changes = 0
+        self.glitches = 0
+        self.pulses = 0
+        self.queue_max = 0
+        self.latency_count = 0
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+
+    def add_pin(self, gpio: int, callback: callable, policy: EdgePolicy = EdgePolicy()):
+        """
+        :param callback: called on the event loop with the list of the debounced changes, in order
+        """
+        self.__pins[gpio] = EdgePin(gpio, self.read(gpio), callback, policy)
+
+    def start(self):
+        if self.__task is None:
+            self.__task = self.event_loop.create_task(self.__consume_task())
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        for pin in self.__pins.values():
+            if pin.timer is not None:
+                pin.timer.cancel()
+                pin.timer = None
+
+    def on_edge(self, gpio: int):
+        """
+        GPIO edge callback, called from the GPIO thread: no blocking, no shared state
+        """
+        edge = Edge(gpio, self.read(gpio), self.event_loop.time())
+        self.event_loop.call_soon_threadsafe(self.__queue.put_nowait, edge)
+
+    async def __consume_task(self):
+        while True:
+            self.queue_max = max(self.queue_max, self.__queue.qsize())
+            self.process(await self.__queue.get())
+
+    def process(self, edge: Edge):
+        pin = self.__pins.get(edge.gpio)
+        if pin is None:
+            self.LOG.warning('Unexpected GPIO: %d', edge.gpio)
+            return
+
+        self.edges += 1
+        if pin.first_edge is None:
+            pin.first_edge = edge.ts
+        elif pin.raw != pin.stable and edge.ts - pin.raw_ts >= pin.policy.glitch:
+            pin.pulse = True
+        pin.raw = edge.level
+        pin.raw_ts = edge.ts
+
+        if pin.timer is not None:
+            pin.timer.cancel()
+        pin.timer = self.event_loop.call_at(edge.ts + pin.policy.debounce, self.__settle, pin)
+
+    def __settle(self, pin: EdgePin):
+        level = self.read(pin.gpio)
+        if level != pin.stable:
+            levels = [level]
+        elif pin.pulse:
+            self.pulses += 1
+            levels = [1 - level, level]
+        else:
+            self.glitches += 1
+            levels = []
+
+        for l in levels:
+            self.__report(pin, Change(pin.gpio, l, pin.first_edge))
+        pin.stable = level
+        pin.raw = level
+        pin.first_edge = None
+        pin.pulse = False
+        pin.timer = None
+
+    def __report(self, pin: EdgePin, change: Change):
+        self.changes += 1
+        batch = self.__batches.get(pin.callback)
+        if batch is not None:
+            batch.append(change)
+            return
+
+        self.__batches[pin.callback] = [change]
+        if pin.policy.coalesce > 0:
+            self.event_loop.call_later(pin.policy.coalesce, self.__deliver, pin.callback)
+        else:
+            self.event_loop.call_soon(self.__deliver, pin.callback)
+
+    def __deliver(self, callback: callable):
+        changes = self.__batches.pop(callback)
+        now = self.event_loop.time()
+        for change in changes:
+            self.latency_count += 1
+            self.latency_last = now - change.ts
+            self.latency_max = max(self.latency_max, self.latency_last)
+            self.latency_total += self.latency_last
+        try:
+            callback(changes)
+        except Exception as e:
+            self.LOG.error('GPIO callback failed: %r', e)
+
+    def stats(self) -> dict:
+        """
+        :return: counters, and latency from the first edge to the delivery of a change, in seconds
+        """
+        return {
+            "edges": self.edges,
+            "changes": self.changes,
+            "glitches": self.glitches,
+            "pulses": self.pulses,
+            "queue_max": self.queue_max,
+            "latency_last": self.latency_last,
+            "latency_max": self.latency_max,
+            "latency_avg": self.latency_total / self.latency_count if self.latency_count else 0.0,
+        }
+
+    def log_stats(self):
+        s = self.stats()
+        self.LOG.info('%d edges, %d changes, %d glitches, %d short pulses, queue max %d, latency avg/max %.1f/%.1f ms',
+                      s['edges'], s['changes'], s['glitches'], s['pulses'], s['queue_max'],
+                      s['latency_avg'] * 1000, s['latency_max'] * 1000)
@@ -0,0 +1,100 @@
+import importlib
+import logging
+
+"""
+Hardware abstraction layer: the firmware reaches GPIO, SPI, UART and the LED strip driver through
+this package, never through the hardware modules themselves, so it also runs off a Raspberry Pi.
+
+Backends:
+- rpi: the board hardware (RPi.GPIO, spidev, pyserial, rpi_ws281x)
+- sim: simulated hardware, see hal/sim.py
+
+The backend is selected once with load(), before the hardware is used. GPIO and ws are proxies to the
+selected backend: the modules importing them load before the configuration does.
+"""
+
+BACKENDS = {
+    'rpi': 'hal.rpi',
+    'sim': 'hal.sim',
+}
+
+# RPi.GPIO constants
+GPIO_CONSTANTS = {
+    'BOARD': 10, 'BCM': 11,
+    'OUT': 0, 'IN': 1,
+    'LOW': 0, 'HIGH': 1,
+    'PUD_OFF': 20, 'PUD_DOWN': 21, 'PUD_UP': 22,
+    'RISING': 31, 'FALLING': 32, 'BOTH': 33,
+}
+
+# rpi_ws281x constants, from ws2811.h
+WS2811_CONSTANTS = {
+    'WS2811_SUCCESS': 0,
+    'SK6812_STRIP_RGBW': 0x18100800, 'SK6812_STRIP_RBGW': 0x18100008, 'SK6812_STRIP_GRBW': 0x18081000,
+    'SK6812_STRIP_GBRW': 0x18080010, 'SK6812_STRIP_BRGW': 0x18001008, 'SK6812_STRIP_BGRW': 0x18000810,
+    'WS2811_STRIP_RGB': 0x00100800, 'WS2811_STRIP_RBG': 0x00100008, 'WS2811_STRIP_GRB': 0x00081000,
+    'WS2811_STRIP_GBR': 0x00080010, 'WS2811_STRIP_BRG': 0x00001008, 'WS2811_STRIP_BGR': 0x00000810,
+}
+
+LOG = logging.getLogger('HAL')
+
+_backend = None
+
+
+def load(name: str = 'rpi', cfg=None):
+    """
+    Select the backend
+
+    :param cfg: the backend configuration, optional
+    :return: the backend
+    """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError('Unknown HAL backend {!r}: expected one of {}'.format(name, ', '.join(sorted(BACKENDS))))
+    if _backend is not None:
+        if _backend.name == name:
+            return _backend
+        raise RuntimeError('HAL backend {} already loaded'.format(_backend.name))
+
+    _backend = importlib.import_module(BACKENDS[name]).Backend(cfg)
+    LOG.info('Using the %s HAL backend', name)
+    return _backend
+
+
+def backend():
+    """
+    :return: the selected backend, the rpi one if none was selected
+    """
+    return _backend if _backend is not None else load()
+
+
+class _Proxy(object):
+    def __init__(self, attribute: str, constants: dict):
+        self.__attribute = attribute
+        self.__constants = constants
+
+    def __getattr__(self, name: str):
+        if name in self.__constants:
+            return self.__constants[name]
+        return getattr(getattr(backend(), self.__attribute), name)
+
+
+# RPi.GPIO like module of the backend
+GPIO = _Proxy('gpio', GPIO_CONSTANTS)
+
+# _rpi_ws281x like module of the backend
+ws = _Proxy('ws', WS2811_CONSTANTS)
+
+
+def spi(bus: int, device: int):
+    """
+    :return: an opened spidev.SpiDev like object
+    """
+    return backend().spi(bus, device)
+
+
+def serial(port: str, baudrate: int):
+    """
+    :return: an opened serial.Serial like object, with a fileno() to be polled by the event loop
+    """
+    return backend().serial(port, baudrate)
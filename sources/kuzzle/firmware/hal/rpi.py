@@ -0,0 +1,31 @@
+import RPi.GPIO
+import _rpi_ws281x
+import serial
+import spidev
+
+"""
+Raspberry Pi HAL backend: the board hardware
+"""
+
+
+class Backend(object):
+    name = 'rpi'
+    real = True
+
+    def __init__(self, cfg=None):
+        self.gpio = RPi.GPIO
+        self.ws = _rpi_ws281x
+
+    def spi(self, bus: int, device: int):
+        spi = spidev.SpiDev()
+        spi.open(bus, device)
+        return spi
+
+    def serial(self, port: str, baudrate: int):
+        return serial.Serial(port, baudrate)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
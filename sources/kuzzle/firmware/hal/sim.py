@@ -0,0 +1,550 @@
+import collections
+import ctypes
+import errno
+import logging
+import math
+import os
+import random
+import struct
+import threading
+import time
+from typing import *
+
+from frametrace import FrameCapture
+from hal import WS2811_CONSTANTS
+from pn532transport import FrameParser, Pn532Transport
+
+"""
+Simulated HAL backend, to run and load test the firmware on any Linux host:
+- GPIO: inputs driven by a script of timed levels, edges delivered from a thread like RPi.GPIO does
+- SPI: an MCP3208 returning synthetic waveforms
+- UART: a Pn532 emulator answering with scripted cards, or the replay of a frametrace capture
+- LED strip: rpi_ws281x binding rendering into memory
+
+Configuration (hal.sim section of config.yaml), all optional:
+    gpio:
+      script: [{at: 1.0, gpio: 6, level: 0}, {at: 1.2, gpio: 6, level: 1}]  # seconds from start()
+      repeat: 0  # seconds, play the script again every repeat seconds
+    adc:
+      channels: [{channel: 0, waveform: sine, offset: 2048, amplitude: 1000, period: 60, noise: 4}]
+    pn532:
+      replay: /path/to/capture.bin  # replay a capture instead of emulating the Pn532
+      poll_period: 0.15  # seconds, duration of an InAutoPoll poll
+      cards: [{card_id: '04A23BC2', at: 5.0, duration: 2.0, every: 20.0}]
+"""
+
+LOG = logging.getLogger('HAL')
+
+# struct spi_ioc_transfer from linux/spi/spidev.h
+SPI_IOC_TRANSFER = struct.Struct('QQIIHBBBBBB')
+SPIDEV_BUFSIZ = 4096  # spidev bufsiz module parameter default
+
+
+class SimGpio(object):
+    """
+    RPi.GPIO stand-in. Inputs are driven with set_input() or a script played by play()
+    """
+
+    BOARD, BCM = 10, 11
+    OUT, IN = 0, 1
+    LOW, HIGH = 0, 1
+    PUD_OFF, PUD_DOWN, PUD_UP = 20, 21, 22
+    RISING, FALLING, BOTH = 31, 32, 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}  # type: Dict[int, int]
+        self.directions = {}  # type: Dict[int, int]
+        self.__detects = {}  # type: Dict[int, Tuple[int, callable]]
+        self.__player = None  # type: threading.Thread
+        self.__stopped = threading.Event()
+        self.edges = 0
+
+    @staticmethod
+    def __channels(channel) -> List[int]:
+        return list(channel) if isinstance(channel, (list, tuple)) else [channel]
+
+    def setmode(self, mode: int):
+        self.mode = mode
+
+    def setwarnings(self, flag: bool):
+        pass
+
+    def setup(self, channel, direction: int, pull_up_down: int = PUD_OFF, initial: int = None):
+        for c in self.__channels(channel):
+            self.directions[c] = direction
+            if initial is not None:
+                self.levels[c] = int(initial)
+            else:
+                self.levels.setdefault(c, 1 if pull_up_down == SimGpio.PUD_UP else 0)
+
+    def output(self, channel, level):
+        for c in self.__channels(channel):
+            self.levels[c] = int(bool(level))
+
+    def input(self, channel: int) -> int:
+        return self.levels.get(channel, 0)
+
+    def add_event_detect(self, channel: int, edge: int, callback: callable = None, bouncetime: int = None):
+        self.__detects[channel] = (edge, callback)
+
+    def remove_event_detect(self, channel: int):
+        self.__detects.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        self.stop()
+        for c in self.__channels(channel) if channel is not None else list(self.levels):
+            self.levels.pop(c, None)
+            self.directions.pop(c, None)
+            self.__detects.pop(c, None)
+
+    def set_input(self, channel: int, level: int):
+        """
+        Drive an input, the edge callback is called from the calling thread
+        """
+        level = int(bool(level))
+        previous = self.levels.get(channel)
+        self.levels[channel] = level
+        if previous == level:
+            return
+
+        edge, callback = self.__detects.get(channel, (None, None))
+        if callback is not None and (edge == SimGpio.BOTH or edge == (SimGpio.RISING if level else SimGpio.FALLING)):
+            self.edges += 1
+            callback(channel)
+
+    def play(self, script: Sequence, repeat: float = 0.0):
+        """
+        Play a script of steps with at, gpio and level attributes from a thread
+
+        :param repeat: play the script again every repeat seconds, once if 0
+        """
+        steps = sorted((s.at, s.gpio, s.level) for s in script)
+        self.__stopped.clear()
+        self.__player = threading.Thread(target=self.__play, args=(steps, repeat), name='sim-gpio', daemon=True)
+        self.__player.start()
+
+    def __play(self, steps: List[Tuple[float, int, int]], repeat: float):
+        start = time.monotonic()
+        while True:
+            for at, gpio, level in steps:
+                if self.__stopped.wait(max(start + at - time.monotonic(), 0)):
+                    return
+                self.set_input(gpio, level)
+            if not repeat:
+                return
+            start += repeat
+
+    def stop(self):
+        self.__stopped.set()
+
+
+class SimAdcChannel(object):
+    """
+    Synthetic waveform of an MCP3208 channel, in 12 bits codes
+    """
+
+    WAVEFORMS = ['constant', 'sine', 'square', 'ramp']
+
+    def __init__(self, waveform: str = 'constant', offset: float = 2048, amplitude: float = 0, period: float = 1.0,
+                 noise: float = 0.0):
+        """
+        :param period: waveform period, in seconds
+        :param noise: standard deviation of the gaussian noise added, in codes
+        """
+        assert waveform in SimAdcChannel.WAVEFORMS, 'waveform must be one of {}'.format(SimAdcChannel.WAVEFORMS)
+        assert period > 0, "period must be > 0"
+
+        self.waveform = waveform
+        self.offset = offset
+        self.amplitude = amplitude
+        self.period = period
+        self.noise = noise
+
+    def code(self, t: float) -> int:
+        phase = (t % self.period) / self.period
+        if self.waveform == 'sine':
+            value = self.offset + self.amplitude * math.sin(2 * math.pi * phase)
+        elif self.waveform == 'square':
+            value = self.offset + (self.amplitude if phase < 0.5 else -self.amplitude)
+        elif self.waveform == 'ramp':
+            value = self.offset + self.amplitude * (2 * phase - 1)
+        else:
+            value = self.offset
+        if self.noise:
+            value += random.gauss(0, self.noise)
+        return min(max(int(round(value)), 0), 4095)
+
+
+class SimSpi(object):
+    """
+    spidev.SpiDev stand-in with an MCP3208 on the bus. Besides xfer2, it emulates the SPI_IOC_MESSAGE
+    ioctl of the spidev driver, with the argument limits of fcntl.ioctl and spidev
+    """
+
+    def __init__(self, channels: Dict[int, SimAdcChannel] = None):
+        self.channels = channels or {}
+        self.mode = 0
+        self.max_speed_hz = 1000000
+        self.lsbfirst = False
+        self.bus = None
+        self.device = None
+        self.started = time.monotonic()
+        self.conversions = 0
+
+    def open(self, bus: int, device: int):
+        self.bus = bus
+        self.device = device
+
+    def close(self):
+        pass
+
+    def fileno(self) -> int:
+        return -1
+
+    def ioctl(self, fd: int, request: int, arg, mutate_flag: bool = True):
+        """
+        SPI_IOC_MESSAGE(n): run the transfers described by the spi_ioc_transfer structs of arg, the
+        tx and rx buffers are read and written in place, as the kernel does
+        """
+        if isinstance(arg, (bytes, str)) and len(arg) > 1024:
+            raise ValueError('ioctl string arg too long')  # As fcntl.ioctl
+        size = (request >> 16) & 0x3FFF
+        if len(arg) != size or size % SPI_IOC_TRANSFER.size:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+        transfers = [SPI_IOC_TRANSFER.unpack_from(arg, i) for i in range(0, size, SPI_IOC_TRANSFER.size)]
+        if sum(tr[2] for tr in transfers) > SPIDEV_BUFSIZ:
+            raise OSError(errno.EMSGSIZE, os.strerror(errno.EMSGSIZE))
+
+        for tx_buf, rx_buf, length, *_ in transfers:
+            resp = bytes(self.xfer2(list(ctypes.string_at(tx_buf, length))))
+            if rx_buf:
+                ctypes.memmove(rx_buf, resp, length)
+        return 0
+
+    def xfer2(self, data: List[int]) -> List[int]:
+        """
+        Answer the 3 bytes MCP3208 conversion frames of data
+        """
+        t = time.monotonic() - self.started
+        resp = []
+        for i in range(0, len(data) - 2, 3):
+            cmd = data[i]
+            if not cmd & 0b100000:  # No start bit
+                resp += [0, 0, 0]
+                continue
+            channel = self.channels.get((cmd >> 1) & 0x07)
+            code = channel.code(t) if channel is not None else 0
+            self.conversions += 1
+            resp += [0, (code << 3) >> 8, (code << 3) & 0xFF]
+        return resp
+
+
+class SimSerial(object):
+    """
+    serial.Serial stand-in: bytes written go to a responder, its answers are read from a pipe so the
+    event loop can poll fileno()
+    """
+
+    def __init__(self, responder, port: str = None):
+        """
+        :param responder: object with a receive(data, send) method, send(data) answers. Answers may
+                          be sent from any thread
+        """
+        self.port = port
+        self.responder = responder
+        self.timeout = None
+        self.is_open = True
+        self.__rfd, self.__wfd = os.pipe()
+        os.set_blocking(self.__rfd, False)
+
+    def fileno(self) -> int:
+        return self.__rfd
+
+    def read(self, size: int = 1) -> bytes:
+        try:
+            return os.read(self.__rfd, size)
+        except BlockingIOError:
+            return b''
+
+    def write(self, data: bytes) -> int:
+        self.responder.receive(bytes(data), self.send)
+        return len(data)
+
+    def send(self, data: bytes):
+        if self.is_open:
+            os.write(self.__wfd, data)
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            os.close(self.__rfd)
+            os.close(self.__wfd)
+
+
+# A card put in the field of the emulated Pn532 at start + at for duration seconds, every every seconds if set
+SimCard = collections.namedtuple('SimCard', ['card_id', 'at', 'duration', 'every'])
+
+
+class Pn532Emulator(object):
+    """
+    Answers the Pn532 commands used by the firmware. InAutoPoll answers with the scripted cards in the
+    field, or once a card enters the field or the polls are over
+    """
+
+    CMD_GET_FIRMWARE_VERSION = 0x02
+    CMD_IN_AUTO_POLL = 0x60
+    FIRMWARE_VERSION = bytes([0x32, 0x01, 0x06, 0x07])
+
+    def __init__(self, cards: Sequence[SimCard] = (), poll_period: float = 0.15):
+        self.cards = list(cards)
+        self.poll_period = poll_period
+        self.parser = FrameParser()
+        self.started = time.monotonic()
+        self.__timer = None  # type: threading.Timer
+        self.commands = 0
+
+    @staticmethod
+    def response(cmd: int, data: bytes = b'') -> bytes:
+        body = bytes([Pn532Transport.TFI_PN532, cmd + 1]) + data
+        return bytes([0x00, 0x00, 0xFF, len(body), (-len(body)) & 0xFF]) + body + bytes([(-sum(body)) & 0xFF, 0x00])
+
+    def in_field(self, t: float) -> List[SimCard]:
+        cards = []
+        for card in self.cards:
+            if t < card.at:
+                continue
+            elapsed = (t - card.at) % card.every if card.every else t - card.at
+            if elapsed < card.duration:
+                cards.append(card)
+        return cards
+
+    def next_enter(self, t: float) -> float:
+        """
+        :return: the time the next card enters the field after t, inf if none will
+        """
+        enters = []
+        for card in self.cards:
+            if t < card.at:
+                enters.append(card.at)
+            elif card.every:
+                enters.append(card.at + (math.floor((t - card.at) / card.every) + 1) * card.every)
+        return min(enters) if enters else math.inf
+
+    def targets(self, cards: List[SimCard]) -> bytes:
+        data = bytes([len(cards)])
+        for i, card in enumerate(cards):
+            nfcid = bytes.fromhex(card.card_id)
+            target = bytes([i + 1, 0x00, 0x04, 0x08, len(nfcid)]) + nfcid
+            data += bytes([0x10, len(target)]) + target
+        return data
+
+    def receive(self, data: bytes, send: callable):
+        for frame in self.parser.feed(data):
+            if frame.kind == FrameParser.ACK:
+                # The host cancels the pending command
+                if self.__timer is not None:
+                    self.__timer.cancel()
+                    self.__timer = None
+            elif frame.kind == FrameParser.DATA and frame.tfi == Pn532Transport.TFI_HOST and frame.data:
+                self.commands += 1
+                send(Pn532Transport.ACK)
+                self.__command(frame.data[0], frame.data[1:], send)
+
+    def __command(self, cmd: int, data: bytes, send: callable):
+        if cmd == Pn532Emulator.CMD_GET_FIRMWARE_VERSION:
+            send(self.response(cmd, Pn532Emulator.FIRMWARE_VERSION))
+        elif cmd == Pn532Emulator.CMD_IN_AUTO_POLL:
+            t = time.monotonic() - self.started
+            cards = self.in_field(t)
+            if cards:
+                send(self.response(cmd, self.targets(cards)))
+                return
+            polls = data[0] * data[1] * self.poll_period if data[0] != 0xFF else math.inf
+            delay = min(polls, self.next_enter(t) - t)
+            if delay == math.inf:
+                return
+            self.__timer = threading.Timer(delay, self.__poll_over, args=(cmd, send))
+            self.__timer.daemon = True
+            self.__timer.start()
+        else:
+            send(self.response(cmd))
+
+    def __poll_over(self, cmd: int, send: callable):
+        self.__timer = None
+        send(self.response(cmd, self.targets(self.in_field(time.monotonic() - self.started))))
+
+
+class Pn532Replay(object):
+    """
+    Replays a frametrace capture: each chunk written is answered with the chunks received after the
+    next chunk sent in the capture, with their captured delays
+    """
+
+    def __init__(self, path: str):
+        self.frames = list(FrameCapture.load(path))
+        self.position = 0
+        LOG.info('Replaying %d Pn532 captured chunks from %s', len(self.frames), path)
+
+    def receive(self, data: bytes, send: callable):
+        frames = self.frames
+        while self.position < len(frames) and frames[self.position].direction != FrameCapture.TX:
+            self.position += 1
+        if self.position >= len(frames):
+            return
+        sent = frames[self.position]
+        self.position += 1
+        while self.position < len(frames) and frames[self.position].direction == FrameCapture.RX:
+            received = frames[self.position]
+            timer = threading.Timer(max(received.timestamp - sent.timestamp, 0), send, args=(received.data,))
+            timer.daemon = True
+            timer.start()
+            self.position += 1
+
+
+class SimWsChannel(object):
+    def __init__(self):
+        self.count = 0
+        self.gpionum = 0
+        self.invert = 0
+        self.brightness = 0
+        self.strip_type = 0
+        self.leds = []  # type: List[int]
+        self.shown = []  # type: List[int]  LED colors at the last render
+
+
+class SimWsStrip(object):
+    def __init__(self):
+        self.freq = 0
+        self.dmanum = 0
+        self.channels = [SimWsChannel(), SimWsChannel()]
+        self.renders = 0
+
+
+class SimWs281x(object):
+    """
+    _rpi_ws281x stand-in rendering into memory
+    """
+
+    WS2811_SUCCESS = 0
+
+    def __init__(self):
+        self.strips = []  # type: List[SimWsStrip]
+        self.leds_set = 0
+
+    def new_ws2811_t(self) -> SimWsStrip:
+        strip = SimWsStrip()
+        self.strips.append(strip)
+        return strip
+
+    def delete_ws2811_t(self, strip: SimWsStrip):
+        if strip in self.strips:
+            self.strips.remove(strip)
+
+    def ws2811_channel_get(self, strip: SimWsStrip, channum: int) -> SimWsChannel:
+        return strip.channels[channum]
+
+    def ws2811_channel_t_count_set(self, channel: SimWsChannel, count: int):
+        channel.count = count
+        channel.leds = [0] * count
+        channel.shown = [0] * count
+
+    def ws2811_channel_t_count_get(self, channel: SimWsChannel) -> int:
+        return channel.count
+
+    def ws2811_channel_t_gpionum_set(self, channel: SimWsChannel, gpionum: int):
+        channel.gpionum = gpionum
+
+    def ws2811_channel_t_invert_set(self, channel: SimWsChannel, invert: int):
+        channel.invert = invert
+
+    def ws2811_channel_t_brightness_set(self, channel: SimWsChannel, brightness: int):
+        channel.brightness = brightness
+
+    def ws2811_channel_t_strip_type_set(self, channel: SimWsChannel, strip_type: int):
+        channel.strip_type = strip_type
+
+    def ws2811_t_freq_set(self, strip: SimWsStrip, freq: int):
+        strip.freq = freq
+
+    def ws2811_t_dmanum_set(self, strip: SimWsStrip, dmanum: int):
+        strip.dmanum = dmanum
+
+    def ws2811_init(self, strip: SimWsStrip) -> int:
+        return SimWs281x.WS2811_SUCCESS
+
+    def ws2811_fini(self, strip: SimWsStrip):
+        pass
+
+    def ws2811_render(self, strip: SimWsStrip) -> int:
+        for channel in strip.channels:
+            channel.shown[:] = channel.leds
+        strip.renders += 1
+        return SimWs281x.WS2811_SUCCESS
+
+    def ws2811_get_return_t_str(self, code: int) -> str:
+        return 'ws2811 error {}'.format(code)
+
+    def ws2811_led_set(self, channel: SimWsChannel, n: int, color: int):
+        self.leds_set += 1
+        channel.leds[n] = color
+
+    def ws2811_led_get(self, channel: SimWsChannel, n: int) -> int:
+        return channel.leds[n]
+
+    def __getattr__(self, name: str):
+        # Strip types and other constants of the real binding
+        if name in WS2811_CONSTANTS:
+            return WS2811_CONSTANTS[name]
+        raise AttributeError(name)
+
+
+class Backend(object):
+    name = 'sim'
+    real = False
+
+    def __init__(self, cfg=None):
+        self.cfg = cfg
+        self.gpio = SimGpio()
+        self.ws = SimWs281x()
+
+        adc_cfg = getattr(cfg, 'adc', None)
+        self.adc_channels = {
+            c.channel: SimAdcChannel(getattr(c, 'waveform', 'constant'), getattr(c, 'offset', 2048),
+                                     getattr(c, 'amplitude', 0), getattr(c, 'period', 1.0), getattr(c, 'noise', 0.0))
+            for c in getattr(adc_cfg, 'channels', None) or []
+        }
+        self.spis = []  # type: List[SimSpi]
+        self.serials = []  # type: List[SimSerial]
+
+    def spi(self, bus: int, device: int) -> SimSpi:
+        spi = SimSpi(self.adc_channels)
+        spi.open(bus, device)
+        self.spis.append(spi)
+        return spi
+
+    def serial(self, port: str, baudrate: int) -> SimSerial:
+        pn532_cfg = getattr(self.cfg, 'pn532', None)
+        replay = getattr(pn532_cfg, 'replay', None)
+        if replay:
+            responder = Pn532Replay(replay)
+        else:
+            cards = [SimCard(c.card_id, getattr(c, 'at', 0.0), getattr(c, 'duration', 1.0), getattr(c, 'every', 0.0))
+                     for c in getattr(pn532_cfg, 'cards', None) or []]
+            responder = Pn532Emulator(cards, getattr(pn532_cfg, 'poll_period', 0.15))
+        s = SimSerial(responder, port)
+        self.serials.append(s)
+        return s
+
+    def start(self):
+        """
+        Start the GPIO script, once the firmware has set its edge callbacks up
+        """
+        gpio_cfg = getattr(self.cfg, 'gpio', None)
+        script = getattr(gpio_cfg, 'script', None)
+        if script:
+            self.gpio.play(script, getattr(gpio_cfg, 'repeat', 0.0))
+
+    def stop(self):
+        self.gpio.stop()
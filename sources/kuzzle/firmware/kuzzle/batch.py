@@ -0,0 +1,109 @@
+import time
+import logging
+
+from .serializer import EncodedState, DocumentEnvelope
+
+
+class StateBatcher(object):
+    """
+    Buffers device states and flushes them to Kuzzle as a single document:mCreate request.
+
+    A flush happens when max_count states are buffered or max_delay seconds after the first
+    buffered state, whichever comes first. States are flushed in the order they were published so
+    per-device ordering is kept.
+    """
+
+    LOG = logging.getLogger('Kuzzle-IoT')
+
+    def __init__(self, connection, index: str, collection: str, max_count: int = 50, max_delay: float = 1.0):
+        """
+        :param connection: the KuzzleConnection used to send the mCreate requests
+        :param max_count: flush as soon as this number of states is buffered
+        :param max_delay: flush at most max_delay seconds after the first state has been buffered
+        """
+        assert max_count > 0, "max_count must be > 0"
+        assert max_delay > 0, "max_delay must be > 0"
+
+        self.connection = connection
+        self.index = index
+        self.collection = collection
+        self.envelope = DocumentEnvelope(index, collection)
+        self.max_count = max_count
+        self.max_delay = max_delay
+
+        self.__buffer = []
+        self.__first_ts = None
+        self.__timer = None
+
+        self.flush_count = 0
+        self.flushed_states = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.acked_flushes = 0
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def add(self, state: EncodedState):
+        """
+        Buffer a device state document, must be called from the event loop thread
+        """
+        self.__buffer.append(state)
+
+        if len(self.__buffer) >= self.max_count:
+            self.flush()
+        elif self.__timer is None:
+            self.__first_ts = time.monotonic()
+            self.__timer = self.connection.event_loop.call_later(self.max_delay, self.flush)
+
+    def flush(self):
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+
+        if not self.__buffer:
+            return None
+
+        states = self.__buffer
+        first_ts = self.__first_ts if self.__first_ts else time.monotonic()
+        self.__buffer = []
+        self.__first_ts = None
+
+        if not self.connection.connected and self.connection.defer_states(states):
+            return None
+
+        self.flush_count += 1
+        self.flushed_states += len(states)
+        self.last_flush_size = len(states)
+        self.max_flush_size = max(self.max_flush_size, len(states))
+
+        self.LOG.debug("Flushing %d states", len(states))
+        f = self.connection.send_states(self.envelope, states)
+        f.add_done_callback(lambda _f: self.__on_flush_done(_f, first_ts, states))
+        return f
+
+    def __on_flush_done(self, f, first_ts, states):
+        self.connection.on_publish_done(f, states)
+        if f.cancelled() or f.exception():
+            return
+
+        self.last_flush_latency = time.monotonic() - first_ts
+        self.total_flush_latency += self.last_flush_latency
+        self.acked_flushes += 1
+
+    def stats(self) -> dict:
+        """
+        :return: flush size and latency (oldest buffered state to Kuzzle ack) statistics
+        """
+        return {
+            "flush_count": self.flush_count,
+            "flushed_states": self.flushed_states,
+            "buffered_states": len(self.__buffer),
+            "last_flush_size": self.last_flush_size,
+            "max_flush_size": self.max_flush_size,
+            "avg_flush_size": self.flushed_states / self.flush_count if self.flush_count else 0.0,
+            "last_flush_latency": self.last_flush_latency,
+            "avg_flush_latency": self.total_flush_latency / self.acked_flushes if self.acked_flushes else 0.0,
+        }
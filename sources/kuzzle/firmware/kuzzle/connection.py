@@ -0,0 +1,581 @@
+import time
+import uuid
+import random
+import collections
+import websockets
+import websockets.exceptions as wse
+
+import asyncio
+import logging
+from typing import *
+
+import metrics
+from . import serializer
+from .serializer import EncodedState, DocumentEnvelope
+from .batch import StateBatcher
+from .offline import OfflineQueue
+
+
+REQUEST_TIMEOUT = 30.0
+
+MESSAGES_SENT = metrics.counter('kuzzle_messages_sent_total', 'Messages sent to Kuzzle')
+BYTES_SENT = metrics.counter('kuzzle_sent_bytes_total', 'Size of the messages sent to Kuzzle')
+SEND_ERRORS = metrics.counter('kuzzle_send_errors_total', 'Messages that could not be sent to Kuzzle')
+MESSAGES_RECEIVED = metrics.counter('kuzzle_messages_received_total', 'Responses and notifications received')
+BYTES_RECEIVED = metrics.counter('kuzzle_received_bytes_total', 'Size of the messages received from Kuzzle')
+REQUEST_DURATION = metrics.histogram('kuzzle_request_duration_seconds', 'Round trip time of the Kuzzle requests',
+                                     buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+REQUEST_TIMEOUTS = metrics.counter('kuzzle_request_timeouts_total', 'Requests without response in time')
+RECONNECTIONS = metrics.counter('kuzzle_reconnections_total', 'Successful reconnections to Kuzzle')
+STATES_PUBLISHED = metrics.counter('kuzzle_states_published_total', 'Device states taken from the ingress queue')
+CONNECTED = metrics.gauge('kuzzle_connected', '1 while connected to Kuzzle')
+INGRESS_DEPTH = metrics.gauge('kuzzle_ingress_queue_depth', 'Device states waiting for the sender coroutine')
+IN_FLIGHT = metrics.gauge('kuzzle_requests_in_flight', 'Requests waiting for their Kuzzle response')
+OFFLINE_DEPTH = metrics.gauge('kuzzle_offline_queue_depth', 'Device states in the offline queue')
+
+
+class PendingRequest(object):
+    """
+    A query sent to Kuzzle and waiting for its response
+    """
+
+    def __init__(self, connection, request_id: str, device, timeout: float):
+        self.connection = connection
+        self.request_id = request_id
+        self.device = device
+        self.timeout = timeout
+        self.sent_ts = time.monotonic()
+        self.latency = None
+
+        loop = connection.event_loop
+        self.future = loop.create_future()
+        self.future.add_done_callback(self.__on_done)
+        self.__timer = loop.call_later(timeout, connection.on_request_timeout, self) if timeout else None
+
+    def resolve(self, resp: dict):
+        self.latency = time.monotonic() - self.sent_ts
+        if not self.future.done():
+            self.future.set_result(resp)
+
+    def fail(self, e: Exception):
+        if not self.future.done():
+            self.future.set_exception(e)
+
+    def __on_done(self, future: asyncio.Future):
+        if self.__timer:
+            self.__timer.cancel()
+
+        # Retrieve the exception so fire and forget queries don't end up with "exception never retrieved"
+        if not future.cancelled() and future.exception():
+            self.connection.LOG.error('Request %s failed: %r', self.request_id, future.exception())
+
+        self.connection.on_request_done(self)
+
+
+class KuzzleConnection(object):
+    """
+    A single WebSocket session to Kuzzle shared by all the KuzzleIOT device handles of a board.
+
+    Every query sent through the connection gets a unique requestId, responses are routed back to
+    the device that sent the query by requestId and realtime notifications are routed to the
+    subscribed device by channel.
+    """
+
+    DISCONNECTED = 'disconnected'
+    CONNECTING = 'connecting'
+    CONNECTED = 'connected'
+    RECONNECTING = 'reconnecting'
+    CLOSED = 'closed'
+
+    INDEX_IOT = "iot"
+    COLLECTION_DEVICE_STATES = "device-state"
+
+    LOG = logging.getLogger('Kuzzle-IoT')
+
+    def __init__(self, host='localhost', port='7512', reconnect_min_delay: float = 1.0,
+                 reconnect_max_delay: float = 60.0):
+        """
+        :param reconnect_min_delay: delay before the first reconnection attempt, in seconds
+        :param reconnect_max_delay: upper bound of the exponential backoff between reconnection attempts
+        """
+        self.event_loop = None
+        self.host = host
+        self.port = port
+        self.url = "ws://{}:{}".format(self.host, self.port)
+        self.ws = None
+        self.state = KuzzleConnection.DISCONNECTED
+        self.__state_listeners = []
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnect_count = 0
+
+        self.devices = []
+        self.session_id = uuid.uuid4().hex[:12]
+        self.__request_count = 0
+        self.__pending = {}  # requestId => PendingRequest
+        self.__channels = {}  # channel => device
+        self.__connecting = None
+        self.batcher = None
+        self.offline_queue = None
+        self.replay_batch_size = 100
+        self.replay_max_attempts = 3
+        self.__replaying = False
+        self.__replay_envelope = None
+        self.state_envelope = DocumentEnvelope(KuzzleConnection.INDEX_IOT, KuzzleConnection.COLLECTION_DEVICE_STATES)
+
+        # States published from sensor threads, drained by a single sender coroutine
+        self.__ingress = collections.deque()
+        self.__ingress_event = None
+        self.__wakeup_pending = False
+        self.__sender = None
+        self.ingress_wakeups = 0
+        self.ingress_states = 0
+        # States per request of the sender coroutine, Kuzzle limits the documents written by a request
+        # (limits.documentsWriteCount, 200 by default)
+        self.send_batch_size = 100
+
+        self.rtt_count = 0
+        self.rtt_total = 0.0
+        self.rtt_last = 0.0
+        self.rtt_max = 0.0
+        self.rtt_samples = None  # type: List[float]  every round trip time is appended to it when set
+
+    @property
+    def connected(self) -> bool:
+        return self.state == KuzzleConnection.CONNECTED
+
+    def enable_batching(self, index: str, collection: str, max_count: int = 50, max_delay: float = 1.0):
+        """
+        Publish device states in batches with document:mCreate instead of one document:create per state
+        """
+        self.batcher = StateBatcher(self, index, collection, max_count=max_count, max_delay=max_delay)
+        return self.batcher
+
+    def enable_offline_queue(self, index: str, collection: str, path: str, max_size: int = 10000,
+                             drop_policy: str = OfflineQueue.DROP_OLDEST, replay_batch_size: int = 100,
+                             replay_max_attempts: int = 3):
+        """
+        Keep device states published while disconnected in a disk-backed queue and replay them
+        with document:mCreate, replay_batch_size states at a time, once connected again
+
+        :param replay_max_attempts: a batch rejected by Kuzzle that many times is dropped, so that it
+                                    does not block the states queued behind it
+        """
+        assert replay_max_attempts > 0, "replay_max_attempts must be > 0"
+        self.offline_queue = OfflineQueue(index, collection, path, max_size=max_size, drop_policy=drop_policy)
+        self.__replay_envelope = DocumentEnvelope(index, collection)
+        self.replay_batch_size = replay_batch_size
+        self.replay_max_attempts = replay_max_attempts
+        return self.offline_queue
+
+    def defer_states(self, states: List[EncodedState]) -> bool:
+        """
+        Queue device states that could not be sent to Kuzzle
+
+        :return: False if there is no offline queue and the states are lost
+        """
+        if self.offline_queue is None:
+            self.LOG.error('Not connected to Kuzzle: %d states lost', len(states))
+            return False
+
+        self.offline_queue.put_many(states)
+        self.LOG.debug('Not connected to Kuzzle: %d states queued (%d in queue)', len(states), len(self.offline_queue))
+        return True
+
+    def on_publish_done(self, f: asyncio.Future, states: List[EncodedState]):
+        """
+        Queue the published states again if the request could not be sent because of a disconnection.
+        A timed out request is not replayed as Kuzzle may have stored the states anyway.
+        """
+        if f.cancelled():
+            return
+        if isinstance(f.exception(), wse.ConnectionClosed):
+            self.defer_states(states)
+        elif f.exception() is None and f.result()["status"] not in (200, 206):
+            self.LOG.error('Publishing %d states failed: %s', len(states),
+                           (f.result().get("error") or {}).get("message"))
+
+    async def __replay_task(self):
+        try:
+            queue = self.offline_queue
+            attempt = 0
+            while self.connected and len(queue):
+                batch = queue.peek(self.replay_batch_size)
+                try:
+                    resp = await self.send_states(self.__replay_envelope, [state for _, state in batch])
+                except Exception:
+                    break  # Already logged, the queue is replayed again on next reconnection
+
+                if resp["status"] not in (200, 206):
+                    attempt += 1
+                    error = (resp.get("error") or {}).get("message")
+                    if attempt < self.replay_max_attempts:
+                        self.LOG.error('Offline queue replay failed, attempt %d/%d: %s', attempt,
+                                       self.replay_max_attempts, error)
+                        await asyncio.sleep(self.backoff_delay(attempt))
+                        continue
+
+                    self.LOG.error('Offline queue replay: %d states rejected %d times by Kuzzle, dropped: %s',
+                                   len(batch), attempt, error)
+                    queue.drop([i for i, _ in batch])
+                    attempt = 0
+                    continue
+
+                attempt = 0
+                queue.remove([i for i, _ in batch])
+                self.LOG.info('Replayed %d queued states, %d remaining', len(batch), len(queue))
+        finally:
+            self.__replaying = False
+
+    def replay_offline_queue(self):
+        """
+        Replay the offline queue. Until it is drained, live states are queued behind the replayed ones
+        so that Kuzzle receives them in order
+        """
+        if self.offline_queue is not None and len(self.offline_queue) and not self.__replaying:
+            self.__replaying = True
+            return self.event_loop.create_task(self.__replay_task())
+        return None
+
+    def next_request_id(self) -> str:
+        self.__request_count += 1
+        return "{}-{}".format(self.session_id, self.__request_count)
+
+    def is_own_request(self, request_id: str) -> bool:
+        """
+        Tells if a requestId has been issued by this connection, used to ignore notifications
+        triggered by our own queries
+        """
+        return bool(request_id) and request_id.startswith(self.session_id + '-')
+
+    def attach(self, device):
+        if device not in self.devices:
+            self.devices.append(device)
+
+    def detach(self, device):
+        if device in self.devices:
+            self.devices.remove(device)
+
+        for rid in [rid for rid, r in self.__pending.items() if r.device is device]:
+            self.__pending.pop(rid).future.cancel()
+
+        for channel in [c for c, d in self.__channels.items() if d is device]:
+            del self.__channels[channel]
+
+    def add_channel(self, channel: str, device):
+        self.__channels[channel] = device
+
+    async def __connect_task(self):
+        self.LOG.debug("<Connecting.... url = %s>", self.url)
+        self.__set_state(KuzzleConnection.CONNECTING)
+        try:
+            self.ws = await websockets.connect(self.url)
+        except Exception as e:
+            # Kuzzle is down at boot: retry with backoff, as after a disconnection
+            self.LOG.error('Unable to connect to %s: %s', self.url, str(e))
+            await self.__reconnect()
+            if not self.connected:
+                self.__connecting = None
+                return None
+        else:
+            self.LOG.info("<Connected to %s>", self.url)
+            self.__set_state(KuzzleConnection.CONNECTED)
+            self.replay_offline_queue()
+
+        self.event_loop.create_task(self.__run_loop_task())
+        return self.ws
+
+    def connect(self):
+        """
+        Open the WebSocket, several devices can call it: they will all wait for the same connection
+        """
+        if self.event_loop is None:
+            self.event_loop = asyncio.get_event_loop()
+            assert self.event_loop, "No event loop found"
+
+        if self.__connecting is None:
+            self.__connecting = self.event_loop.create_task(self.__connect_task())
+
+        if self.__sender is None:
+            self.__ingress_event = asyncio.Event()
+            if self.__ingress:
+                self.__ingress_event.set()  # States published before connect(): nothing else would wake the sender
+            self.__sender = self.event_loop.create_task(self.__sender_task())
+        return self.__connecting
+
+    def publish_state(self, state: EncodedState):
+        """
+        Queue a device state document for publishing, can be called from any thread.
+
+        Only the first state queued since the sender coroutine last ran wakes the event loop up,
+        the following ones are drained in the same batch.
+        """
+        self.__ingress.append(state)
+        if not self.__wakeup_pending and self.__ingress_event is not None:
+            self.__wakeup_pending = True
+            self.event_loop.call_soon_threadsafe(self.__ingress_event.set)
+
+    async def __sender_task(self):
+        while self.state != KuzzleConnection.CLOSED:
+            await self.__ingress_event.wait()
+            if self.state == KuzzleConnection.CLOSED:
+                break
+            self.__ingress_event.clear()
+            self.__wakeup_pending = False
+            if self.state == KuzzleConnection.CONNECTING:
+                continue  # Drained once the first connection attempt is over, see __set_state
+
+            states = []
+            while self.__ingress:
+                states.append(self.__ingress.popleft())
+
+            if states:
+                self.ingress_wakeups += 1
+                self.ingress_states += len(states)
+                STATES_PUBLISHED.inc(len(states))
+                for i in range(0, len(states), self.send_batch_size):
+                    self.__publish_states(states[i:i + self.send_batch_size])
+
+    def __publish_states(self, states: List[EncodedState]):
+        if (not self.connected or self.__replaying) and self.offline_queue is not None:
+            self.defer_states(states)
+            return
+
+        if self.batcher is not None:
+            for state in states:
+                self.batcher.add(state)
+            return
+
+        f = self.send_states(self.state_envelope, states)
+        f.add_done_callback(lambda _f: self.on_publish_done(_f, states))
+        self.LOG.debug("PUBLISH >>>> %d states", len(states))
+
+    def resubscribe(self):
+        self.__channels.clear()
+        for device in self.devices:
+            if device.on_state_changed:
+                self.LOG.debug('%s: Re subscribing to own state...', device.device_type)
+                device.subscribe_state(device.on_state_changed)
+
+    def __set_state(self, state: str):
+        if state == self.state:
+            return
+
+        self.LOG.info('Kuzzle connection: %s => %s', self.state, state)
+        previous, self.state = self.state, state
+        if previous == KuzzleConnection.CONNECTING and self.__ingress and self.__ingress_event is not None:
+            self.__ingress_event.set()  # States held while connecting
+        CONNECTED.set(1 if state == KuzzleConnection.CONNECTED else 0)
+        for listener in self.__state_listeners:
+            try:
+                listener(self, state)
+            except Exception as e:
+                self.LOG.error('Connection state listener failed: %r', e)
+
+    def add_state_listener(self, listener: callable):
+        """
+        :param listener: called with (connection, state) each time the connection state changes
+        """
+        self.__state_listeners.append(listener)
+
+    def remove_state_listener(self, listener: callable):
+        self.__state_listeners.remove(listener)
+
+    def backoff_delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with jitter: the delay doubles on each failed attempt up to
+        reconnect_max_delay, a random half of it is skipped so a fleet of boards doesn't hit Kuzzle
+        in the same second after a broker restart
+        """
+        # The exponent is bounded: 2 ** 1024 overflows a float after a long outage
+        delay = min(self.reconnect_max_delay, self.reconnect_min_delay * (2 ** min(attempt, 16)))
+        return random.uniform(delay / 2, delay)
+
+    async def __reconnect(self):
+        self.__set_state(KuzzleConnection.RECONNECTING)
+        attempt = 0
+
+        while self.state == KuzzleConnection.RECONNECTING:
+            delay = self.backoff_delay(attempt)
+            self.LOG.info('reconnecting in %.2fs...', delay)
+            await asyncio.sleep(delay)
+            if self.state != KuzzleConnection.RECONNECTING:
+                break  # Closed in the meantime
+
+            try:
+                self.ws = await websockets.connect(self.url)
+            except Exception as e:
+                self.LOG.error('Reconnection attempt %d failed: %s', attempt + 1, str(e))
+                attempt += 1
+                continue
+
+            self.reconnect_count += 1
+            RECONNECTIONS.inc()
+            self.__set_state(KuzzleConnection.CONNECTED)
+            self.resubscribe()
+            self.replay_offline_queue()
+
+    async def __ping(self) -> bool:
+        try:
+            self.LOG.info("PING Kuzzle")
+            pong_waiter = await self.ws.ping()
+            await asyncio.wait_for(pong_waiter, timeout=10)
+            self.LOG.info("PONG Kuzzle")
+            return True
+        except asyncio.TimeoutError:
+            self.LOG.critical("No PONG from Kuzzle")
+        except wse.ConnectionClosed as e:
+            self.LOG.error('PING failed: %s', str(e))
+        return False
+
+    async def __run_loop_task(self):
+        while self.state != KuzzleConnection.CLOSED:
+            self.LOG.debug("<<Waiting for data from Kuzzle...>>")
+            try:
+                resp = await asyncio.wait_for(self.ws.recv(), timeout=60)
+            except wse.ConnectionClosed as e:
+                if self.state == KuzzleConnection.CLOSED:
+                    break
+                self.LOG.error('__run_loop_task: ws disconnection: %s', str(e))
+                await self.__reconnect()
+                continue
+            except asyncio.TimeoutError:
+                if not await self.__ping():
+                    self.event_loop.create_task(self.ws.close())
+                    await self.__reconnect()
+                continue
+            except Exception as e:
+                if self.state == KuzzleConnection.CLOSED:
+                    break
+                # Unknown state of the socket: start over with a new connection rather than spin on it
+                self.LOG.error('__run_loop_task: ws except: %r', e)
+                self.event_loop.create_task(self.ws.close())
+                await self.__reconnect()
+                continue
+
+            self.LOG.debug("<<Received data from Kuzzle...>>")
+            MESSAGES_RECEIVED.inc()
+            BYTES_RECEIVED.inc(len(resp))
+            try:
+                self.dispatch(serializer.loads(resp))
+            except Exception as e:
+                # A malformed message or a failing handler must not stop the receive loop
+                self.LOG.exception('__run_loop_task: dropping message from Kuzzle: %r', e)
+
+    def dispatch(self, resp: dict):
+        """
+        Route a message received from Kuzzle: realtime notifications go to the device subscribed to
+        the channel, query responses go to the device that posted the query. Errors are logged by the
+        requester, which knows whether they are expected (e.g. a 404 on document:get)
+        """
+        if resp["status"] != 200:
+            self.LOG.debug('Kuzzle error %s on %s:%s: %s', resp["status"], resp.get("controller"), resp.get("action"),
+                           (resp.get("error") or {}).get("message"))
+
+        device = self.__channels.get(resp.get("room"))
+        if device:
+            if not self.is_own_request(resp.get("requestId")):
+                device.on_notification(resp)
+            return
+
+        request = self.__pending.pop(resp.get("requestId"), None)
+        if request:
+            request.resolve(resp)
+
+    async def __send_task(self, request: PendingRequest, message: str):
+        try:
+            await self.ws.send(message)
+        except Exception as e:
+            SEND_ERRORS.inc()
+            self.__pending.pop(request.request_id, None)
+            request.fail(e)
+            return
+        MESSAGES_SENT.inc()
+        BYTES_SENT.inc(len(message))
+
+    def send(self, device, query: dict, timeout: float = REQUEST_TIMEOUT) -> asyncio.Future:
+        """
+        Send a query to Kuzzle on behalf of a device
+
+        :param device: the KuzzleIOT handle sending the query
+        :param query: the Kuzzle query, a unique requestId will be assigned to it
+        :param timeout: delay in seconds after which the request fails with asyncio.TimeoutError
+        :return: a future resolved with the Kuzzle response to this query
+        """
+        request = self.__register_request(device, timeout)
+        query["requestId"] = request.request_id
+        self.event_loop.create_task(self.__send_task(request, serializer.dumps(query)))
+        return request.future
+
+    def send_states(self, envelope: DocumentEnvelope, states: List[EncodedState],
+                    timeout: float = REQUEST_TIMEOUT) -> asyncio.Future:
+        """
+        Send pre-serialized state documents: with document:create for a single state, with
+        document:mCreate otherwise
+
+        :return: a future resolved with the Kuzzle response
+        """
+        request = self.__register_request(None, timeout)
+        if len(states) == 1:
+            message = envelope.create(request.request_id, states[0])
+        else:
+            message = envelope.m_create(request.request_id, states)
+        self.event_loop.create_task(self.__send_task(request, message))
+        return request.future
+
+    def __register_request(self, device, timeout: float) -> PendingRequest:
+        request = PendingRequest(self, self.next_request_id(), device, timeout)
+        self.__pending[request.request_id] = request
+        return request
+
+    def on_request_timeout(self, request: PendingRequest):
+        if self.__pending.pop(request.request_id, None):
+            REQUEST_TIMEOUTS.inc()
+            request.fail(asyncio.TimeoutError('No response after {}s'.format(request.timeout)))
+
+    def on_request_done(self, request: PendingRequest):
+        if request.latency is not None:
+            self.rtt_count += 1
+            self.rtt_total += request.latency
+            self.rtt_last = request.latency
+            self.rtt_max = max(self.rtt_max, request.latency)
+            if self.rtt_samples is not None:
+                self.rtt_samples.append(request.latency)
+            REQUEST_DURATION.observe(request.latency)
+
+    def rtt_stats(self) -> dict:
+        """
+        :return: round trip time statistics of the requests answered by Kuzzle, in seconds
+        """
+        return {
+            "count": self.rtt_count,
+            "in_flight": len(self.__pending),
+            "last": self.rtt_last,
+            "max": self.rtt_max,
+            "avg": self.rtt_total / self.rtt_count if self.rtt_count else 0.0,
+        }
+
+    def update_metrics(self):
+        """
+        Metrics collector: samples the queue depths
+        """
+        INGRESS_DEPTH.set(len(self.__ingress))
+        IN_FLIGHT.set(len(self.__pending))
+        OFFLINE_DEPTH.set(len(self.offline_queue) if self.offline_queue is not None else 0)
+
+    async def __close_task(self):
+        if self.batcher is not None:
+            flushing = self.batcher.flush()
+            if flushing:
+                await flushing
+        self.__set_state(KuzzleConnection.CLOSED)
+        if self.__ingress_event is not None:
+            self.__ingress_event.set()  # Let the sender coroutine exit
+        if self.ws:
+            await self.ws.close()
+            self.ws = None
+        if self.offline_queue is not None:
+            self.offline_queue.close()
+
+    def close(self):
+        return self.event_loop.create_task(self.__close_task())
@@ -1,6 +1,3 @@
-import time
-import websockets
-import websockets.exceptions as wse
 import requests
 
 import asyncio
@@ -8,24 +5,30 @@ import json
 import logging
 import coloredlogs
 import sys
+import time
+import threading
+
+from .connection import KuzzleConnection, REQUEST_TIMEOUT
+from .serializer import StateEncoder
 
 
 class KuzzleIOT(object):
     """ Device state publishing Kuzzle query fmt string"""
 
-    INDEX_IOT = "iot"
-    COLLECTION_DEVICE_STATES = "device-state"
+    INDEX_IOT = KuzzleConnection.INDEX_IOT
+    COLLECTION_DEVICE_STATES = KuzzleConnection.COLLECTION_DEVICE_STATES
     COLLECTION_DEVICE_INFO = "device-info"
 
-    REQUEST_PUBLISH_DEVICE_INFO = "publish_device_info"
-    REQUEST_GET_DEVICE_INFO = "get_device_info"
-
     LOG = logging.getLogger('Kuzzle-IoT')
     JSON_DEC = json.JSONDecoder()
 
     def __init__(self, device_uid, device_type, host='localhost', port='7512',
                  user: str = '', pwd: str = '', owner: str = None, friendly_name: str = None,
-                 additional_info: dict = None):
+                 additional_info: dict = None, connection: KuzzleConnection = None):
+        """
+        :param connection: the Kuzzle connection shared with the other devices of the board, a
+                           dedicated one is opened if not provided
+        """
         self.event_loop = None
         self.host = host
         self.port = port
@@ -39,10 +42,20 @@ class KuzzleIOT(object):
 
         self.device_uid = device_uid
         self.device_type = device_type
-        self.ws = None
+        self.state_encoder = StateEncoder(device_uid, device_type)
+        self.connection = connection if connection else KuzzleConnection(host, port)
+        self.connection.attach(self)
         self.on_connected = None
         self.on_state_changed = None
 
+        self.delta = False
+        self.snapshot_every = 0
+        self.snapshot_period = 0.0
+        self.__last_state = None
+        self.__last_snapshot_ts = 0.0
+        self.__deltas_since_snapshot = 0
+        self.__state_lock = threading.Lock()
+
         coloredlogs.install(logger=KuzzleIOT.LOG,
                             fmt='[%(thread)X] - %(asctime)s - %(name)s - %(levelname)s - %(message)s',
                             level=logging.DEBUG,
@@ -70,17 +83,23 @@ class KuzzleIOT(object):
             KuzzleIOT.LOG.critical('Unable to connect to Kuzzle: http://%s:%s', host, port)
             return None
 
-    def get_device_info(self):
+    async def __get_device_info_task(self):
 
         query = {
             "index": KuzzleIOT.INDEX_IOT,
             "collection": KuzzleIOT.COLLECTION_DEVICE_INFO,
-            "requestId": KuzzleIOT.REQUEST_GET_DEVICE_INFO,
             "controller": "document",
             "action": "get",
             '_id': self.device_uid
         }
-        self.post_query(query)
+        try:
+            resp = await self.post_query(query)
+        except Exception:
+            return  # Already logged by the connection
+        self.on_device_info_resp(resp)
+
+    def get_device_info(self):
+        return self.event_loop.create_task(self.__get_device_info_task())
 
     def publish_device_info(self):
         self.LOG.info("Publishing device info...")
@@ -97,34 +116,18 @@ class KuzzleIOT(object):
         query = {
             "index": KuzzleIOT.INDEX_IOT,
             "collection": KuzzleIOT.COLLECTION_DEVICE_INFO,
-            "requestId": KuzzleIOT.REQUEST_PUBLISH_DEVICE_INFO,
             "controller": "document",
             "action": "createOrReplace",
             "_id": self.device_uid,
             "body": body
         }
         self.LOG.info("%s", query)
-        self.post_query(query)
+        self.post_query(query).add_done_callback(self.on_device_info_published)
 
-    async def __publish_state_task(self, state, partial):
-        body = {
-            "device_id": self.device_uid,
-            "device_type": self.device_type,
-            "partial_state": partial,
-            "state": state
-        }
-
-        req = {
-            "index": KuzzleIOT.INDEX_IOT,
-            "collection": KuzzleIOT.COLLECTION_DEVICE_STATES,
-            "requestId": "publish_" + self.device_uid,
-            "controller": "document",
-            "action": "create",
-            "body": body
-        }
-        t = self.post_query(req)
-        self.LOG.debug("PUBLISH >>>>")
-        return t
+    def on_device_info_published(self, f: asyncio.Future):
+        if not f.cancelled() and f.exception() is None and f.result()['status'] != 200:
+            self.LOG.error('%s: publishing device info failed: %s', self.device_type,
+                           (f.result().get('error') or {}).get('message'))
 
     async def __subscribe_state_task(self, on_state_changed: callable):
         self.on_state_changed = on_state_changed
@@ -140,18 +143,18 @@ class KuzzleIOT(object):
             }
         }
 
-        return self.post_query(subscribe_msg)
+        try:
+            resp = await self.post_query(subscribe_msg)
+        except Exception:
+            return None  # Already logged by the connection
+        self.on_subscribe_resp(resp)
+        return resp
 
     async def __connect_task(self, on_connected: callable):
-        self.LOG.debug("<Connecting.... url = %s>", self.url)
-        try:
-            self.ws = await websockets.connect(self.url)
-        except Exception as e:
-            self.LOG.critical(e)
+        await self.connection.connect()
+        if not self.connection.ws:
             return
 
-        self.LOG.info("<Connected to %s>", self.url)
-
         self.on_connected = on_connected
 
         if self.on_connected:
@@ -159,90 +162,111 @@ class KuzzleIOT(object):
 
         self.get_device_info()
 
-        self.__run_loop_start()
-
     def __connect(self, on_connected: callable):
         return self.event_loop.create_task(self.__connect_task(on_connected))
 
-    def __run_loop_start(self):
-        self.event_loop.create_task(self.__run_loop_task())
-
     def on_device_info_resp(self, resp):
         self.LOG.debug("device info result")
+        if resp['status'] == 404:
+            self.LOG.info('%s: device %s not registered yet', self.device_type, self.device_uid)
+        elif resp['status'] != 200:
+            self.LOG.error('%s: device info lookup failed: %s', self.device_type,
+                           (resp.get('error') or {}).get('message'))
         if resp['status'] != 200:
             self.publish_device_info()
 
-    async def __run_loop_task(self):
-        while 1:
-            self.LOG.debug("%s: <<Waiting for data from Kuzzle...>>", self.device_type)
-            try:
-                resp = await asyncio.wait_for(self.ws.recv(), timeout=60)
-            except wse.ConnectionClosed as e:
-                self.LOG.error('__publish_state_task: ws disconnection: %s', str(e))
-                self.LOG.info('reconnecting in 5s...')
-                time.sleep(5)
-
-                try:
-                    self.ws = await websockets.connect(self.url)
-                    self.LOG.debug('Re subscribing to own state...')
-                    self.subscribe_state(self.on_state_changed)
-                except Exception as e:
-                    self.LOG.critical(e)
-                continue
-            except asyncio.TimeoutError:
-                try:
-                    self.LOG.info("PING Kuzzle")
-                    pong_waiter = await self.ws.ping()
-                    await asyncio.wait_for(pong_waiter, timeout=10)
-                    self.LOG.info("PONG Kuzzle")
-                except asyncio.TimeoutError:
-                    self.LOG.critical("No PONG from Kuzzle")
-                    break
-                continue
-            except Exception as e:
-                self.LOG.error('__publish_state_task: ws except: %s', str(e))
-
-            self.LOG.debug("%s: <<Received data from Kuzzle...>>", self.device_type)
-            resp = json.loads(resp)
-            # print(json.dumps(resp, indent=2, sort_keys=True))
-
-            if resp["status"] != 200:
-                print(json.dumps(resp, indent=2, sort_keys=True))
-
-            if resp["action"] in ['replace', 'create'] and self.on_state_changed and resp[
-                "requestId"] != "publish_" + self.device_uid:
-                source = resp["result"]["_source"]
-
-                is_partial = source["is_partial"] if "state_partial" in source else False
-                self.on_state_changed(source["state"], is_partial)
-            elif resp['requestId'] == KuzzleIOT.REQUEST_GET_DEVICE_INFO:
-                self.on_device_info_resp(resp)
+    def on_subscribe_resp(self, resp):
+        if resp['status'] == 200:
+            self.connection.add_channel(resp["result"]["channel"], self)
+        else:
+            self.LOG.error('%s: state subscription failed: %s', self.device_type,
+                           (resp.get('error') or {}).get('message'))
+
+    def on_notification(self, resp):
+        if resp["action"] in ['replace', 'create', 'mCreate'] and self.on_state_changed:
+            source = resp["result"]["_source"]
+
+            self.on_state_changed(source["state"], source.get("partial_state", False))
 
     def subscribe_state(self, on_state_changed: callable):
         self.LOG.debug("%s: <<Adding task to subscribe state>>", self.device_type)
         return self.event_loop.create_task(self.__subscribe_state_task(on_state_changed))
 
-    async def __post_query_task(self, query: dict, cb: callable = None):
-        self.LOG.debug("%s: Posting query", self.device_type)
-        await self.ws.send(json.dumps(query))
-        if cb:
-            cb()
-        self.LOG.debug("%s: Query posted", self.device_type)
+    def post_query(self, query: dict, timeout: float = REQUEST_TIMEOUT) -> asyncio.Future:
+        """
+        Post a query to Kuzzle, many queries can be in flight at the same time
 
-    def post_query(self, query: dict, cb: callable = None):
+        :return: a future resolved with the Kuzzle response, or failing with asyncio.TimeoutError
+        """
         self.LOG.debug("%s: <<Adding task to post a query>>", self.device_type)
-        return self.event_loop.create_task(self.__post_query_task( query, cb))
+        return self.connection.send(self, query, timeout)
+
+    def enable_delta(self, snapshot_every: int = 20, snapshot_period: float = 300.0):
+        """
+        Only publish the keys of the state that changed since the last publish, as partial states.
+        A full state snapshot is still published every snapshot_every publishes or every
+        snapshot_period seconds, whichever comes first (0 disables the criterion)
+        """
+        self.delta = True
+        self.snapshot_every = snapshot_every
+        self.snapshot_period = snapshot_period
+
+    def __delta(self, state: dict, partial: bool) -> (dict, bool):
+        """
+        :return: the state to publish and whether it is partial, None if nothing changed
+        """
+        with self.__state_lock:
+            now = time.monotonic()
+            last = self.__last_state
+
+            snapshot_due = (last is None or
+                            (self.snapshot_every and self.__deltas_since_snapshot >= self.snapshot_every) or
+                            (self.snapshot_period and now - self.__last_snapshot_ts >= self.snapshot_period))
+
+            if snapshot_due:
+                full = dict(last) if last and partial else {}
+                full.update(state)
+                self.__last_state = full
+                self.__last_snapshot_ts = now
+                self.__deltas_since_snapshot = 0
+                return dict(full), False
+
+            changed = {k: v for k, v in state.items() if k not in last or last[k] != v}
+            removed = not partial and any(k not in state for k in last)
+            if not partial and (removed or len(changed) == len(state)):
+                # Keys removed, which a delta can't express, or everything changed: publish the full state
+                self.__last_state = dict(state)
+                self.__last_snapshot_ts = now
+                self.__deltas_since_snapshot = 0
+                return state, False
+
+            if not changed:
+                return None, True
+
+            last.update(changed)
+            self.__deltas_since_snapshot += 1
+            return changed, True
 
     def publish_state(self, state, partial=False):
-        self.LOG.debug("%s: <<Adding task to publish state>>", self.device_type)
-        return asyncio.run_coroutine_threadsafe(self.__publish_state_task(state, partial), self.event_loop)
+        """
+        Publish a new device state, can be called from any thread
+        """
+        if self.delta:
+            state, partial = self.__delta(state, partial)
+            if state is None:
+                return
+
+        self.LOG.debug("%s: <<Queuing state to publish>>", self.device_type)
+        self.connection.publish_state(self.state_encoder.encode(state, partial))
 
     def connect(self, on_connected: callable):
-        print("<Connect>")
+        self.LOG.debug("%s: <Connect>", self.device_type)
         self.event_loop = asyncio.get_event_loop()
         assert self.event_loop, "No event loop found"
         # return self.event_loop.run_in_executor(None, self.__connect, on_connected)
         return self.__connect(on_connected)
 
     def disconnect(self):
-        self.ws.close()
+        self.connection.detach(self)
+        if not self.connection.devices:
+            self.connection.close()
@@ -0,0 +1,129 @@
+import os
+import logging
+import sqlite3
+from typing import *
+
+from .serializer import EncodedState
+
+
+class OfflineQueue(object):
+    """
+    Bounded, disk-backed queue (sqlite) holding device states published while Kuzzle is unreachable.
+
+    States are replayed oldest first once the connection is back. When the queue is full, the drop
+    policy decides what is lost:
+    - DROP_OLDEST: the oldest queued state is dropped to make room for the new one
+    - DROP_NEWEST: the new state is dropped
+    - COALESCE: the oldest queued state of the same device (device_id and device_type) is dropped, it
+      is superseded by the new one. The oldest state is dropped if the device had none queued
+    """
+
+    DROP_OLDEST = 'oldest'
+    DROP_NEWEST = 'newest'
+    COALESCE = 'coalesce'
+
+    LOG = logging.getLogger('Kuzzle-IoT')
+
+    def __init__(self, index: str, collection: str, path: str, max_size: int = 10000,
+                 drop_policy: str = DROP_OLDEST):
+        """
+        :param path: sqlite database file, created if needed. ':memory:' keeps the queue in memory
+        :param max_size: maximum number of queued states
+        :param drop_policy: one of DROP_OLDEST, DROP_NEWEST or COALESCE
+        """
+        assert max_size > 0, "max_size must be > 0"
+        assert drop_policy in [OfflineQueue.DROP_OLDEST, OfflineQueue.DROP_NEWEST, OfflineQueue.COALESCE], \
+            'drop_policy must be one of OfflineQueue.DROP_OLDEST, DROP_NEWEST or COALESCE'
+
+        self.index = index
+        self.collection = collection
+        self.path = path
+        self.max_size = max_size
+        self.drop_policy = drop_policy
+        self.dropped = 0
+
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')  # Spare the SD card: no fsync on every state
+        self.db.execute('CREATE TABLE IF NOT EXISTS states ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, device_id TEXT, device_type TEXT, body TEXT)')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(states)')]
+        if 'device_type' not in columns:  # Queue left by a previous version
+            self.db.execute("ALTER TABLE states ADD COLUMN device_type TEXT DEFAULT ''")
+        self.db.execute('CREATE INDEX IF NOT EXISTS states_device ON states (device_id, device_type)')
+        self.db.commit()
+        self.__size = self.db.execute('SELECT COUNT(*) FROM states').fetchone()[0]
+
+        if self.__size:
+            self.LOG.info('Offline queue: %d states left from a previous run', self.__size)
+
+    def __len__(self):
+        return self.__size
+
+    def put(self, state: EncodedState) -> bool:
+        """
+        Queue a device state document
+
+        :return: False if the state has been dropped
+        """
+        return self.put_many([state]) == 1
+
+    def put_many(self, states: List[EncodedState]) -> int:
+        """
+        Queue device state documents in a single transaction: one commit for the whole batch
+
+        :return: the number of states queued, the others have been dropped
+        """
+        queued = 0
+        for state in states:
+            if self.__size >= self.max_size:
+                if self.drop_policy == OfflineQueue.DROP_NEWEST:
+                    self.dropped += 1
+                    continue
+
+                deleted = 0
+                if self.drop_policy == OfflineQueue.COALESCE:
+                    deleted = self.db.execute(
+                        'DELETE FROM states WHERE id = '
+                        '(SELECT MIN(id) FROM states WHERE device_id = ? AND device_type = ?)',
+                        (state.device_id, state.device_type)).rowcount
+
+                if not deleted:
+                    self.db.execute('DELETE FROM states WHERE id = (SELECT MIN(id) FROM states)')
+                self.__size -= 1
+                self.dropped += 1
+
+            self.db.execute('INSERT INTO states (device_id, device_type, body) VALUES (?, ?, ?)',
+                            (state.device_id, state.device_type, state.body))
+            self.__size += 1
+            queued += 1
+
+        if queued:
+            self.db.commit()
+        return queued
+
+    def peek(self, count: int) -> List[Tuple[int, EncodedState]]:
+        """
+        :return: the count oldest queued states as (id, state) tuples, they stay queued until removed
+        """
+        rows = self.db.execute('SELECT id, device_id, device_type, body FROM states ORDER BY id LIMIT ?',
+                               (count,)).fetchall()
+        return [(row[0], EncodedState(row[1], row[2], row[3])) for row in rows]
+
+    def remove(self, ids: List[int]):
+        self.db.executemany('DELETE FROM states WHERE id = ?', [(i,) for i in ids])
+        self.db.commit()
+        self.__size = self.db.execute('SELECT COUNT(*) FROM states').fetchone()[0]
+
+    def drop(self, ids: List[int]):
+        """
+        Remove queued states that will never be accepted by Kuzzle, they are counted as dropped
+        """
+        self.remove(ids)
+        self.dropped += len(ids)
+
+    def close(self):
+        self.db.close()
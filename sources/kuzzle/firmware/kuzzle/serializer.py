@@ -0,0 +1,76 @@
+import json
+import collections
+from typing import *
+
+"""
+JSON encoding/decoding of the messages exchanged with Kuzzle.
+
+Uses the fastest encoder available: orjson, then ujson, then the standard library json module.
+Device state documents are pre-serialized: the static part of the envelope (index, collection,
+controller, action, device_id, device_type) is encoded once per device and only the state is
+encoded on each publish.
+"""
+
+try:
+    import orjson
+
+    ENCODER = 'orjson'
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        ENCODER = 'ujson'
+
+        def dumps(obj) -> str:
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+        loads = ujson.loads
+    except ImportError:
+        ENCODER = 'json'
+        _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        dumps = _encoder.encode
+        loads = json.loads
+
+
+# A device state document body already serialized to JSON
+EncodedState = collections.namedtuple('EncodedState', ['device_id', 'device_type', 'body'])
+
+
+class StateEncoder(object):
+    """
+    Pre-serializes the static part of the state documents of one device
+    """
+
+    def __init__(self, device_id: str, device_type: str):
+        self.device_id = device_id
+        self.device_type = device_type
+        self.__head = '{{"device_id":{},"device_type":{},"partial_state":'.format(dumps(device_id), dumps(device_type))
+        self.__head_full = self.__head + 'false,"state":'
+        self.__head_partial = self.__head + 'true,"state":'
+
+    def encode(self, state: dict, partial: bool = False) -> EncodedState:
+        head = self.__head_partial if partial else self.__head_full
+        return EncodedState(self.device_id, self.device_type, head + dumps(state) + '}')
+
+
+class DocumentEnvelope(object):
+    """
+    Pre-serialized document:create and document:mCreate envelopes for one index/collection
+    """
+
+    def __init__(self, index: str, collection: str):
+        head = '{{"index":{},"collection":{},"controller":"document","action":'.format(dumps(index), dumps(collection))
+        self.__create_head = head + '"create","requestId":"'
+        self.__m_create_head = head + '"mCreate","requestId":"'
+
+    def create(self, request_id: str, state: EncodedState) -> str:
+        return self.__create_head + request_id + '","body":' + state.body + '}'
+
+    def m_create(self, request_id: str, states: List[EncodedState]) -> str:
+        return (self.__m_create_head + request_id + '","body":{"documents":[' +
+                ','.join(['{"body":' + s.body + '}' for s in states]) + ']}}')
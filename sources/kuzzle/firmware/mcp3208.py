@@ -1,33 +1,152 @@
-import spidev
+import array
+import collections
+import ctypes
+import fcntl
+import statistics
+import struct
+from typing import *
+
+import hal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
 MCP3208 is as 12bits ADC from Microchip
 Datasheet can be found here: http://ww1.microchip.com/downloads/en/DeviceDoc/21298c.pdf
 """
 
+# Result of a burst read on one channel: mean and median voltages, median and raw 12 bits codes
+BurstReading = collections.namedtuple('BurstReading', ['voltage', 'median_voltage', 'median_code', 'codes'])
+
+# struct spi_ioc_transfer from linux/spi/spidev.h
+_SPI_IOC_TRANSFER = struct.Struct('QQIIHBBBBBB')
+_SPI_IOC_MAGIC = ord('k')
+# Max transfers in one SPI_IOC_MESSAGE: the ioctl size field is 14 bits, spidev buffer is 4096 bytes
+_MAX_FRAMES_PER_MESSAGE = 500
+# fcntl.ioctl copies an immutable argument into a 1024 bytes buffer: the requests must be mutable
+_IOCTL_IMMUTABLE_ARG_MAX = 1024
+
+
+def _spi_ioc_message(n: int) -> int:
+    return (1 << 30) | ((n * _SPI_IOC_TRANSFER.size) << 16) | (_SPI_IOC_MAGIC << 8)
+
+
+class _BurstMessage(object):
+    """
+    A pre-built SPI message: one 3 bytes conversion frame per sample, chip select released between
+    frames as required by the MCP3208 to start a new conversion
+    """
+
+    def __init__(self, tx: bytes, speed_hz: int):
+        self.frames = len(tx) // 3
+        self.tx = ctypes.create_string_buffer(tx, len(tx))
+        self.rx = ctypes.create_string_buffer(len(tx))
+        self.requests = []
+
+        tx_addr = ctypes.addressof(self.tx)
+        rx_addr = ctypes.addressof(self.rx)
+        for first in range(0, self.frames, _MAX_FRAMES_PER_MESSAGE):
+            last = min(first + _MAX_FRAMES_PER_MESSAGE, self.frames)
+            transfers = bytearray(b''.join(
+                _SPI_IOC_TRANSFER.pack(tx_addr + 3 * i, rx_addr + 3 * i, 3, speed_hz, 0, 8,
+                                       1 if i < last - 1 else 0, 0, 0, 0, 0)
+                for i in range(first, last)
+            ))
+            self.requests.append((_spi_ioc_message(last - first), transfers))
+
+        assert all(isinstance(t, bytearray) or len(t) <= _IOCTL_IMMUTABLE_ARG_MAX for _, t in self.requests), \
+            'SPI_IOC_MESSAGE requests over {} bytes must be mutable'.format(_IOCTL_IMMUTABLE_ARG_MAX)
+
 
 class MCP3208(object):
     SINGLE = 1
     DIFF = 0
 
-    def __init__(self, v_ref=3.3, bus=0, device=0):
+    def __init__(self, v_ref=3.3, bus=0, device=0, spi=None):
+        """
+        :param spi: an already opened spidev.SpiDev like object, the HAL opens bus/device if None
+        """
         self.bus = bus
         self.device = device
-        self.spi = spidev.SpiDev()
-        self.spi.open(self.bus, self.device)
+        self.spi = spi if spi else hal.spi(self.bus, self.device)
         self.spi.mode = 0
         self.spi.max_speed_hz = 1000000
         self.spi.lsbfirst = False
         self.v_ref = v_ref
+        self.__bursts = {}
 
-    def read_channel(self, mode: int, channel: int):
+    @staticmethod
+    def command(mode: int, channel: int) -> bytes:
         assert 0 <= channel <= 7, "Channel must be 0 <= channel <= 7"
         assert mode in [MCP3208.SINGLE, MCP3208.DIFF], 'Mode must be one of Mcp3208.SINGLE or Mcp3208.DIFF'
 
         cmd = 0b100000 | mode << 4  # start bit + mode bit + one 0 bit for pad to make reply from Mcp3208 byte aligned
         cmd |= channel << 1
+        return bytes([cmd, 0x00, 0x00])
 
-        resp = self.spi.xfer2([cmd, 0x00, 0x00])
+    def __transfer(self, burst: _BurstMessage) -> bytes:
+        fileno = getattr(self.spi, 'fileno', None)
+        if fileno:
+            fd = fileno()
+            ioctl = getattr(self.spi, 'ioctl', fcntl.ioctl)  # The simulated bus emulates the spidev ioctl
+            for request, transfers in burst.requests:
+                ioctl(fd, request, transfers)
+            return burst.rx.raw
+
+        # spidev stand-in: one xfer2 per conversion
+        tx = burst.tx.raw
+        return b''.join(bytes(self.spi.xfer2(list(tx[i:i + 3]))) for i in range(0, len(tx), 3))
+
+    @staticmethod
+    def decode(rx: bytes):
+        """
+        Decode the 12 bits codes of a sequence of 3 bytes conversion frames
+
+        :return: a numpy array if numpy is available, an array.array otherwise
+        """
+        if numpy is not None:
+            frames = numpy.frombuffer(rx, dtype=numpy.uint8).reshape(-1, 3).astype(numpy.uint16)
+            return ((frames[:, 1] << 8 | frames[:, 2]) >> 3) & 0x0FFF
+
+        return array.array('H', [((rx[i + 1] << 8 | rx[i + 2]) >> 3) & 0x0FFF for i in range(0, len(rx), 3)])
+
+    def read_codes(self, mode: int, channels: Sequence[int], samples: int) -> Dict[int, Any]:
+        """
+        Read samples conversions of each channel in a single SPI message, channels are sampled in turn
+
+        :return: the raw 12 bits codes of each channel
+        """
+        key = (mode, tuple(channels), samples)
+        burst = self.__bursts.get(key)
+        if burst is None:
+            tx = b''.join(self.command(mode, c) for c in channels) * samples
+            burst = self.__bursts[key] = _BurstMessage(tx, self.spi.max_speed_hz)
+
+        codes = self.decode(self.__transfer(burst))
+        n = len(channels)
+        return {c: codes[i::n] for i, c in enumerate(channels)}
+
+    def read_burst(self, mode: int, channels: Sequence[int], samples: int = 16) -> Dict[int, BurstReading]:
+        """
+        Oversampled read of one or more channels: samples conversions per channel in a single SPI message
+
+        :return: the mean and median voltage, the median code and the raw codes of each channel
+        """
+        readings = {}
+        scale = self.v_ref / 4096.0
+        for channel, codes in self.read_codes(mode, channels, samples).items():
+            if numpy is not None:
+                mean, median = float(codes.mean()), float(numpy.median(codes))
+            else:
+                mean, median = statistics.mean(codes), statistics.median(codes)
+            readings[channel] = BurstReading(mean * scale, median * scale, int(round(median)), codes)
+        return readings
+
+    def read_channel(self, mode: int, channel: int):
+        resp = self.spi.xfer2(list(self.command(mode, channel)))
 
         raw_measure = (resp[1] << 8) + resp[2]
         raw_measure = raw_measure >> 3
@@ -48,3 +167,11 @@ if __name__ == '__main__':
     for c in range(0, 8):
         print("| {:7} | {:11.3f} |".format(c, mcp3208.read_channel(MCP3208.SINGLE, c)))
         print("+---------+-------------+")
+
+    print("Burst read, 64 samples per channel")
+    print("+---------+-------------+-------------+")
+    print("| channel |    Mean (V) |  Median (V) |")
+    print("+---------+-------------+-------------+")
+    for c, r in sorted(mcp3208.read_burst(MCP3208.SINGLE, range(0, 8), 64).items()):
+        print("| {:7} | {:11.3f} | {:11.3f} |".format(c, r.voltage, r.median_voltage))
+        print("+---------+-------------+-------------+")
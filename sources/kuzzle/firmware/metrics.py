@@ -0,0 +1,464 @@
+import bisect
+import collections
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from typing import *
+
+"""
+In-process metrics registry: counters, gauges and fixed-bucket histograms.
+
+Metrics always count in memory. Once the registry is opened on a file, every update is also written
+to a memory-mapped slot of that file (a tmpfs file, e.g. /dev/shm), where another process - the
+admin webserver - reads them without any round trip to the firmware, see read() and exposition().
+
+File layout: a header, then capacity slots of SLOT_SIZE bytes. A slot holds a sequence number, odd
+while the writer updates the slot so readers retry instead of reading torn values, the metric kind,
+name, labels and help, then its values.
+"""
+
+LOG = logging.getLogger('Metrics')
+
+DEFAULT_PATH = '/dev/shm/kuzzle-iot-metrics'
+
+COUNTER = 1
+GAUGE = 2
+HISTOGRAM = 3
+KIND_NAMES = {COUNTER: 'counter', GAUGE: 'gauge', HISTOGRAM: 'histogram'}
+
+# Seconds, from a GPIO callback to a Kuzzle request timeout
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_BUCKETS = 16
+
+MAGIC = b'KZMT'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIIId')  # magic, version, slot size, capacity, count, writer pid, start time
+HEADER_SIZE = 64
+HEADER_COUNT = struct.Struct('<I')
+HEADER_COUNT_OFFSET = 16
+
+SEQ = struct.Struct('<I')
+DESCRIPTOR = struct.Struct('<BB2x64s96s88s')  # kind, buckets, name, labels, help
+VALUE = struct.Struct('<d')
+COUNT = struct.Struct('<Q')
+SUM_COUNT = struct.Struct('<dQ')
+BOUNDS = struct.Struct('<{}d'.format(MAX_BUCKETS))
+COUNTS = struct.Struct('<{}Q'.format(MAX_BUCKETS + 1))
+DESCRIPTOR_OFFSET = 4
+VALUE_OFFSET = DESCRIPTOR_OFFSET + DESCRIPTOR.size  # counter, gauge value / histogram sum and count
+BOUNDS_OFFSET = VALUE_OFFSET + SUM_COUNT.size
+COUNTS_OFFSET = BOUNDS_OFFSET + BOUNDS.size
+SLOT_SIZE = COUNTS_OFFSET + COUNTS.size
+
+NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+LABEL_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+
+
+def format_labels(labels: Optional[dict]) -> str:
+    """
+    :return: the labels in the exposition format, sorted by name, e.g. 'device="neo",job="scan"'
+    """
+    if not labels:
+        return ''
+    for name in labels:
+        if not LABEL_RE.match(name):
+            raise ValueError('Invalid label name {!r}'.format(name))
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                    for k, v in sorted(labels.items()))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name: str, help: str, labels: str, lock: threading.Lock):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = lock
+        self._buf = None  # type: mmap.mmap
+        self._offset = 0
+        self._seq = 0
+
+    def bind(self, buf: mmap.mmap, offset: int):
+        """
+        Write the metric into its slot, its updates are written there from now on
+        """
+        with self._lock:
+            self._buf = buf
+            self._offset = offset
+            self._seq = 0
+            self._begin()
+            DESCRIPTOR.pack_into(buf, offset + DESCRIPTOR_OFFSET, self.kind, self._bucket_count(),
+                                 self.name.encode(), self.labels.encode(), self.help.encode()[:88])
+            self._write_all()
+            self._end()
+
+    def unbind(self):
+        with self._lock:
+            self._buf = None
+
+    def __str__(self):
+        return '{}{{{}}}'.format(self.name, self.labels) if self.labels else self.name
+
+    def _begin(self):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        SEQ.pack_into(self._buf, self._offset, self._seq)
+
+    def _end(self):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        SEQ.pack_into(self._buf, self._offset, self._seq)
+
+    def _bucket_count(self) -> int:
+        return 0
+
+    def _write_all(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """
+    A value that only goes up, e.g. messages sent
+    """
+    kind = COUNTER
+
+    def __init__(self, name: str, help: str, labels: str, lock: threading.Lock):
+        super().__init__(name, help, labels, lock)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+            if self._buf is not None:
+                self._begin()
+                VALUE.pack_into(self._buf, self._offset + VALUE_OFFSET, self.value)
+                self._end()
+
+    def _write_all(self):
+        VALUE.pack_into(self._buf, self._offset + VALUE_OFFSET, self.value)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, e.g. a queue depth
+    """
+    kind = GAUGE
+
+    def __init__(self, name: str, help: str, labels: str, lock: threading.Lock):
+        super().__init__(name, help, labels, lock)
+        self.value = 0.0
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = float(value)
+            if self._buf is not None:
+                self._begin()
+                VALUE.pack_into(self._buf, self._offset + VALUE_OFFSET, self.value)
+                self._end()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+            if self._buf is not None:
+                self._begin()
+                VALUE.pack_into(self._buf, self._offset + VALUE_OFFSET, self.value)
+                self._end()
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def _write_all(self):
+        VALUE.pack_into(self._buf, self._offset + VALUE_OFFSET, self.value)
+
+
+class Histogram(Metric):
+    """
+    Observations counted in fixed buckets, e.g. request durations
+    """
+    kind = HISTOGRAM
+
+    def __init__(self, name: str, help: str, labels: str, lock: threading.Lock,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        :param buckets: upper bounds of the buckets, increasing, +Inf is implicit
+        """
+        super().__init__(name, help, labels, lock)
+        buckets = tuple(float(b) for b in buckets)
+        if not buckets or len(buckets) > MAX_BUCKETS or list(buckets) != sorted(set(buckets)):
+            raise ValueError('Invalid buckets {}: expected 1 to {} increasing bounds'.format(buckets, MAX_BUCKETS))
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+            if self._buf is not None:
+                self._begin()
+                SUM_COUNT.pack_into(self._buf, self._offset + VALUE_OFFSET, self.sum, self.count)
+                COUNT.pack_into(self._buf, self._offset + COUNTS_OFFSET + i * COUNT.size, self.counts[i])
+                self._end()
+
+    def _bucket_count(self) -> int:
+        return len(self.buckets)
+
+    def _write_all(self):
+        offset = self._offset
+        SUM_COUNT.pack_into(self._buf, offset + VALUE_OFFSET, self.sum, self.count)
+        BOUNDS.pack_into(self._buf, offset + BOUNDS_OFFSET,
+                         *(self.buckets + (0.0,) * (MAX_BUCKETS - len(self.buckets))))
+        COUNTS.pack_into(self._buf, offset + COUNTS_OFFSET,
+                         *(self.counts + [0] * (MAX_BUCKETS + 1 - len(self.counts))))
+
+
+class Registry(object):
+    """
+    The metrics of a process, created once and updated in place. Metrics sampled on demand, like
+    queue depths, are updated by collectors, see collect()
+    """
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()  # type: Dict[Tuple[str, str], Metric]
+        self.__kinds = {}  # type: Dict[str, int]
+        self.__collectors = []  # type: List[callable]
+        self.__lock = threading.Lock()
+        self.path = None
+        self.capacity = 0
+        self.__buf = None  # type: mmap.mmap
+
+    def __get(self, cls, name: str, help: str, labels: Optional[dict], **kwargs) -> Metric:
+        if not NAME_RE.match(name) or len(name.encode()) > 64:
+            raise ValueError('Invalid metric name {!r}'.format(name))
+        label_str = format_labels(labels)
+        if len(label_str.encode()) > 96:
+            raise ValueError('Labels of {} too long: {}'.format(name, label_str))
+
+        with self.__lock:
+            key = (name, label_str)
+            metric = self.metrics.get(key)
+            if metric is not None:
+                if not isinstance(metric, cls):
+                    raise ValueError('Metric {} already registered as a {}'.format(metric, KIND_NAMES[metric.kind]))
+                return metric
+            if self.__kinds.get(name, cls.kind) != cls.kind:
+                raise ValueError('Metric {} already registered as a {}'.format(name, KIND_NAMES[self.__kinds[name]]))
+
+            metric = cls(name, help, label_str, threading.Lock(), **kwargs)
+            self.metrics[key] = metric
+            self.__kinds[name] = cls.kind
+            if self.__buf is not None:
+                self.__bind(metric, len(self.metrics) - 1)
+            return metric
+
+    def counter(self, name: str, help: str, labels: dict = None) -> Counter:
+        """
+        :return: the counter name with these labels, created if needed
+        """
+        return self.__get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: dict = None) -> Gauge:
+        return self.__get(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS,
+                  labels: dict = None) -> Histogram:
+        return self.__get(Histogram, name, help, labels, buckets=buckets)
+
+    def add_collector(self, collector: callable):
+        """
+        :param collector: called without argument by collect(), sets gauges from the current state
+        """
+        self.__collectors.append(collector)
+
+    def remove_collector(self, collector: callable):
+        self.__collectors.remove(collector)
+
+    def collect(self):
+        for collector in list(self.__collectors):
+            try:
+                collector()
+            except Exception as e:
+                LOG.error('Metrics collector %r failed: %r', collector, e)
+
+    def open(self, path: str = DEFAULT_PATH, capacity: int = 256):
+        """
+        Share the metrics through a new memory-mapped file, replacing any previous one
+
+        :param capacity: maximum number of metrics shared, the others are only kept in memory
+        """
+        self.close()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Readers either see the previous file or a complete new one
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        size = HEADER_SIZE + capacity * SLOT_SIZE
+        with open(tmp_path, 'wb+') as f:
+            f.truncate(size)
+            buf = mmap.mmap(f.fileno(), size)
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, SLOT_SIZE, capacity, 0, os.getpid(), time.time())
+
+        with self.__lock:
+            self.__buf = buf
+            self.path = path
+            self.capacity = capacity
+            for i, metric in enumerate(self.metrics.values()):
+                self.__bind(metric, i)
+        os.replace(tmp_path, path)
+        LOG.info('Sharing %d metrics in %s', min(len(self.metrics), capacity), path)
+
+    def __bind(self, metric: Metric, index: int):
+        if index >= self.capacity:
+            LOG.warning('Metrics file full (%d metrics): %s not shared', self.capacity, metric)
+            return
+        metric.bind(self.__buf, HEADER_SIZE + index * SLOT_SIZE)
+        # The count is updated once the slot is written
+        HEADER_COUNT.pack_into(self.__buf, HEADER_COUNT_OFFSET, index + 1)
+
+    def close(self):
+        with self.__lock:
+            if self.__buf is None:
+                return
+            for metric in self.metrics.values():
+                metric.unbind()
+            self.__buf.close()
+            self.__buf = None
+
+
+# The registry of the firmware
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels: dict = None) -> Counter:
+    return REGISTRY.counter(name, help, labels)
+
+
+def gauge(name: str, help: str, labels: dict = None) -> Gauge:
+    return REGISTRY.gauge(name, help, labels)
+
+
+def histogram(name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS, labels: dict = None) -> Histogram:
+    return REGISTRY.histogram(name, help, buckets, labels)
+
+
+def add_collector(collector: callable):
+    REGISTRY.add_collector(collector)
+
+
+# Reader side, used by the admin webserver
+
+Sample = collections.namedtuple('Sample', ['kind', 'name', 'labels', 'help', 'value', 'buckets', 'counts', 'count'])
+Header = collections.namedtuple('Header', ['pid', 'started', 'count'])
+
+
+def read(path: str = DEFAULT_PATH, retries: int = 100) -> (Header, List[Sample]):
+    """
+    Read the metrics shared by another process
+
+    :return: the file header and the metrics, for histograms value is the sum and counts are cumulative
+    :raise OSError: no metrics file
+    :raise ValueError: not a metrics file, or a version not supported
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER_SIZE:
+            raise ValueError('{}: not a metrics file'.format(path))
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    with buf:
+        magic, version, slot_size, capacity, count, pid, started = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE or size < HEADER_SIZE + capacity * SLOT_SIZE:
+            raise ValueError('{}: unsupported metrics file'.format(path))
+
+        samples = []
+        for i in range(0, min(count, capacity)):
+            offset = HEADER_SIZE + i * SLOT_SIZE
+            for _ in range(0, retries):
+                slot = buf[offset:offset + SLOT_SIZE]
+                seq = SEQ.unpack_from(slot, 0)[0]
+                if not seq & 1 and SEQ.unpack_from(buf, offset)[0] == seq:
+                    samples.append(parse_slot(slot))
+                    break
+                time.sleep(0.0001)  # Let the writer finish
+            else:
+                LOG.warning('%s: metric %d is being updated, skipped', path, i)
+    return Header(pid, started, len(samples)), samples
+
+
+def parse_slot(slot: bytes) -> Sample:
+    kind, nbuckets, name, labels, help = DESCRIPTOR.unpack_from(slot, DESCRIPTOR_OFFSET)
+    name = name.rstrip(b'\0').decode()
+    labels = labels.rstrip(b'\0').decode()
+    help = help.rstrip(b'\0').decode(errors='ignore')
+    if kind != HISTOGRAM:
+        return Sample(kind, name, labels, help, VALUE.unpack_from(slot, VALUE_OFFSET)[0], None, None, None)
+
+    total, count = SUM_COUNT.unpack_from(slot, VALUE_OFFSET)
+    bounds = BOUNDS.unpack_from(slot, BOUNDS_OFFSET)[:nbuckets]
+    counts = COUNTS.unpack_from(slot, COUNTS_OFFSET)[:nbuckets + 1]
+    cumulative = []
+    acc = 0
+    for c in counts:
+        acc += c
+        cumulative.append(acc)
+    return Sample(kind, name, labels, help, total, bounds, cumulative, count)
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def exposition(path: str = DEFAULT_PATH) -> str:
+    """
+    :return: the shared metrics in the Prometheus text exposition format, version 0.0.4
+    """
+    header, samples = read(path)
+    lines = [
+        '# HELP firmware_up Whether the firmware process sharing the metrics is running',
+        '# TYPE firmware_up gauge',
+        'firmware_up {}'.format(1 if process_alive(header.pid) else 0),
+        '# HELP firmware_start_time_seconds Start time of the firmware metrics, since the epoch',
+        '# TYPE firmware_start_time_seconds gauge',
+        'firmware_start_time_seconds {}'.format(format_value(header.started)),
+    ]
+
+    families = collections.OrderedDict()  # type: Dict[str, List[Sample]]
+    for s in samples:
+        families.setdefault(s.name, []).append(s)
+
+    for name, family in families.items():
+        lines.append('# HELP {} {}'.format(name, family[0].help.replace('\\', r'\\').replace('\n', r'\n')))
+        lines.append('# TYPE {} {}'.format(name, KIND_NAMES.get(family[0].kind, 'untyped')))
+        for s in family:
+            if s.kind != HISTOGRAM:
+                lines.append('{}{} {}'.format(name, '{' + s.labels + '}' if s.labels else '', format_value(s.value)))
+                continue
+            sep = ',' if s.labels else ''
+            for bound, count in zip(s.buckets + (float('inf'),), s.counts):
+                lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, s.labels, sep, format_value(bound), count))
+            labels = '{' + s.labels + '}' if s.labels else ''
+            lines.append('{}_sum{} {}'.format(name, labels, format_value(s.value)))
+            lines.append('{}_count{} {}'.format(name, labels, s.count))
+
+    return '\n'.join(lines) + '\n'
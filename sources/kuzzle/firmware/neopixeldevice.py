@@ -1,11 +1,15 @@
 import json
 import sys
 from neopixel import *
+from framebuffer import FrameBuffer
+from animation import AnimationEngine, EFFECTS
 from kuzzle.kuzzle import KuzzleIOT
 from enum import Enum, unique
 import logging
 import coloredlogs
 import asyncio
+import collections
+import metrics
 
 # LED strip configuration:
 LED_COUNT = 8  # Number of LED pixels.
@@ -26,124 +30,206 @@ class LightMode(Enum):
     COLOR_RAMP = "color-ramp"
     BLINK = "blink"
     CYCLE = "cycle"
+    FADE = "fade"
+    BREATHE = "breathe"
+    CHASE = "chase"
+    GRADIENT = "gradient"
+
+
+# Modes rendered once, the other modes are animation effects
+STATIC_MODES = [LightMode.SINGLE_COLOR.value, LightMode.COLOR_RAMP.value]
+
+# Optional animation parameters of a state, see animation.py
+EFFECT_PARAMS = ['period', 'speed', 'length']
+
+FRAMES_SHOWN = metrics.counter('neopixel_frames_shown_total', 'Frames written to the LED strip')
+FRAMES_UNCHANGED = metrics.counter('neopixel_frames_unchanged_total', 'Frames not written, nothing changed')
+PIXELS_WRITTEN = metrics.counter('neopixel_pixels_written_total', 'LEDs written to the strip driver')
+
+# A neopixel state validated and compiled for rendering: packed colors, ramp in the framebuffer format,
+# animation parameters
+CompiledState = collections.namedtuple('CompiledState', ['on', 'mode', 'color', 'ramp', 'params'])
 
 
 class NeopixelDevice(Adafruit_NeoPixel):
     LOG = logging.getLogger('Neopixel')
 
     def __init__(self, led_count, led_pin, freq_hz=800000, dma_channel=5, invert=False,
-                 brightness=255, pwm_channel=0, strip_type=ws.WS2811_STRIP_RGB):
+                 brightness=255, pwm_channel=0, strip_type=ws.WS2811_STRIP_RGB, fps=30):
+        """
+        :param fps: frame rate of the animations
+        """
         super().__init__(led_count, led_pin, freq_hz=freq_hz, dma=dma_channel, invert=invert, brightness=brightness,
                          channel=pwm_channel, strip_type=strip_type)
 
-        self.cycle_offset = 0
         coloredlogs.install(logger=NeopixelDevice.LOG,
                             fmt='[%(thread)X] - %(asctime)s - %(name)s - %(levelname)s - %(message)s',
                             level=logging.DEBUG,
                             stream=sys.stdout)
 
         self.LOG.setLevel(logging.DEBUG)
-        self.blink_state = 1
 
         self.LOG.info("Neopixel inside")
 
         self.event_loop = asyncio.get_event_loop()
         self.k = None
         self.led_count = led_count
+        self.frame = FrameBuffer(led_count)
+        self.frames_shown = 0
+        self.frames_skipped = 0
+        self.pixels_written = 0
+        self.animation = AnimationEngine(self.show, fps, self.event_loop)
+        self.__flash_handle = None
         self.__state = {
             'on': True,
             'mode': LightMode.COLOR_RAMP.value,
             'ramp': [(0, 0, 0) for x in range(0, led_count)]
         }
+        self.__compiled = self.compile_state(self.__state)
         self.begin()
 
     def set_led_color(self, led_index, color):
-        if type(color) in (tuple, list, dict):
-            self.setPixelColorRGB(led_index, color[0], color[1], color[2])
-        elif isinstance(color, int):
-            self.setPixelColor(led_index, color)
-        elif isinstance(color, str):
-            self.setPixelColor(led_index, self.parse_color(color))
-
-    def blink(self):
-        if LightMode.BLINK.value not in self.state['mode'] or not self.state['on']:
-            return
-
-        self.LOG.debug('>>>BLINK<<<')
-        self.blink_state = 0 if self.blink_state else 1
-
-        if 'ramp' in self.state:
-            for i, c in enumerate(self.state["ramp"]):
-                if self.blink_state:
-                    self.set_led_color(i, c)
-                else:
-                    self.set_led_color(i, 0)
-
-        elif 'color' in self.state:
-            for i in range(0, self.led_count+1):
-                if self.blink_state:
-                    self.set_led_color(i, self.state["color"])
-                else:
-                    self.set_led_color(i, 0)
-
-        self.show()
-        if LightMode.BLINK.value in self.state['mode']:
-            self.event_loop.call_later(0.1, self.blink)
-
-    def cycle(self):
-        if LightMode.CYCLE.value not in self.state['mode'] or not self.state['on']:
+        self.frame[led_index] = self.parse_color(color)
+
+    def show(self):
+        """
+        Write the pixels of the frame that changed to the driver and render them, nothing is done
+        if the frame didn't change
+        """
+        changed = self.frame.flush()
+        if not changed:
+            self.frames_skipped += 1
+            FRAMES_UNCHANGED.inc()
             return
 
-        self.LOG.debug('>>>Cycle<<<')
-        self.cycle_offset += 1
-
-        if 'ramp' in self.state:
-            print('ramp, cycle_offset ', self.cycle_offset)
-            ramp = self.state["ramp"]
-            print(ramp)
-            l = len(ramp)
-            for i in range(0, self.led_count):
-                c = ramp[(i + self.cycle_offset) % l]
-                self.set_led_color(i, c)
-
+        led_set = ws.ws2811_led_set
+        channel = self._channel
+        for i, color in changed:
+            led_set(channel, i, color)
+        super().show()
+        self.frames_shown += 1
+        self.pixels_written += len(changed)
+        FRAMES_SHOWN.inc()
+        PIXELS_WRITTEN.inc(len(changed))
+
+    def render_stats(self) -> dict:
+        stats = {
+            "frames_shown": self.frames_shown,
+            "frames_skipped": self.frames_skipped,
+            "pixels_written": self.pixels_written,
+        }
+        stats.update(self.animation.stats())
+        return stats
+
+    def log_render_stats(self):
+        s = self.render_stats()
+        self.LOG.info('%d frames shown, %d skipped, %d pixels written, animation %.1f/%.1f fps, %d frames dropped, '
+                      'render avg/max %.2f/%.2f ms', s['frames_shown'], s['frames_skipped'], s['pixels_written'],
+                      s['fps'], s['fps_target'], s['dropped'], s['render_time_avg'] * 1000, s['render_time_max'] * 1000)
+
+    def flash(self, color, duration: float = 0.5):
+        """
+        Light all the LEDs with color for duration seconds, then render the current state again.
+        Local feedback only: the device state is not changed
+        """
+        self.animation.stop()
+        if self.__flash_handle is not None:
+            self.__flash_handle.cancel()
+        self.frame.fill(self.parse_color(color))
         self.show()
-        if LightMode.CYCLE.value in self.state['mode']:
-            self.event_loop.call_later(0.1, self.cycle)
-
+        self.__flash_handle = self.event_loop.call_later(duration, self.__apply_state)
 
     @staticmethod
-    def parse_color(color: str) -> int:
-        if type(color) == str:
-            if str(color).startswith('#'):
-                color = color[1:]
-            color = int(color, 16)
-
-        return color
+    def parse_color(color) -> int:
+        """
+        :param color: '#RRGGBB' or 'RRGGBB' string, [r, g, b] or [r, g, b, w] list, or packed 0xWWRRGGBB integer
+        :return: the packed color
+        :raise ValueError: invalid color
+        """
+        if isinstance(color, str):
+            digits = color[1:] if color.startswith('#') else color
+            if len(digits) not in (6, 8):
+                raise ValueError('Invalid color {!r}: expected #RRGGBB'.format(color))
+            try:
+                return int(digits, 16)
+            except ValueError:
+                raise ValueError('Invalid color {!r}: expected #RRGGBB'.format(color)) from None
+
+        if isinstance(color, (tuple, list)):
+            if len(color) not in (3, 4) or not all(isinstance(c, int) and 0 <= c <= 255 for c in color):
+                raise ValueError('Invalid color {!r}: expected [r, g, b] with components in [0, 255]'.format(color))
+            return Color(*color)
+
+        if isinstance(color, int) and not isinstance(color, bool):
+            if not 0 <= color <= 0xFFFFFFFF:
+                raise ValueError('Invalid color {!r}: out of range'.format(color))
+            return color
+
+        raise ValueError('Invalid color {!r}: expected a #RRGGBB string, a [r, g, b] list or an integer'.format(color))
+
+    def compile_state(self, state: dict) -> CompiledState:
+        """
+        Validate a full state and precompute what rendering needs, so animations never parse colors
+
+        :raise ValueError: invalid state
+        """
+        mode = state.get('mode')
+        if mode not in STATIC_MODES and mode not in EFFECTS:
+            raise ValueError('Invalid mode {!r}: expected one of {}'.format(mode, ', '.join(STATIC_MODES + sorted(EFFECTS))))
+
+        color = state.get('color')
+        if color is not None:
+            color = self.parse_color(color)
+
+        ramp = state.get('ramp')
+        if ramp is not None:
+            if not isinstance(ramp, (tuple, list)) or not ramp:
+                raise ValueError('Invalid ramp {!r}: expected a non empty list of colors'.format(ramp))
+            ramp = FrameBuffer.palette([self.parse_color(c) for c in ramp])
+
+        if mode == LightMode.SINGLE_COLOR.value and color is None:
+            raise ValueError('Mode {} needs a color'.format(mode))
+        if mode in [LightMode.COLOR_RAMP.value, LightMode.CYCLE.value, LightMode.GRADIENT.value] and ramp is None:
+            raise ValueError('Mode {} needs a ramp'.format(mode))
+        if color is None and ramp is None:
+            raise ValueError('Mode {} needs a color or a ramp'.format(mode))
+
+        params = {}
+        for name in EFFECT_PARAMS:
+            value = state.get(name)
+            if value is None:
+                continue
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError('Invalid {} {!r}: expected a number'.format(name, value))
+            if name == 'period' and value <= 0:
+                raise ValueError('Invalid period {!r}: expected a number > 0'.format(value))
+            if name == 'length' and (int(value) != value or value < 1):
+                raise ValueError('Invalid length {!r}: expected an integer >= 1'.format(value))
+            params[name] = value
+
+        return CompiledState(bool(state.get('on', True)), mode, color, ramp, params)
 
     def __apply_state(self):
 
         self.LOG.debug("Applying new state: %s", json.dumps(self.state, sort_keys=True))
-        mode = self.state["mode"]
-
-        if self.state['on']:
-            if mode == LightMode.SINGLE_COLOR.value:
-                color = self.state["color"]
-                for i in range(0, self.led_count + 1):
-                    self.set_led_color(i, color)
-            elif mode == LightMode.COLOR_RAMP.value:
-                ramp = self.state["ramp"]
-                l = len(ramp)
-                for i in range(0, self.led_count):
-                    c = ramp[i % l]
-                    self.set_led_color(i, c)
-            elif mode == LightMode.BLINK.value:
-                self.event_loop.call_later(0.3, self.blink)
-            elif mode == LightMode.CYCLE.value:
-                self.event_loop.call_later(0.3, self.cycle)
+        state = self.__compiled
+        self.animation.stop()
+        if self.__flash_handle is not None:
+            self.__flash_handle.cancel()
+            self.__flash_handle = None
+
+        if state.on:
+            if state.mode == LightMode.SINGLE_COLOR.value:
+                self.frame.fill(state.color)
+            elif state.mode == LightMode.COLOR_RAMP.value:
+                self.frame.pattern(state.ramp)
+            else:
+                colors = state.ramp if state.ramp is not None else FrameBuffer.palette([state.color])
+                self.animation.play(EFFECTS[state.mode](self.frame, colors, state.params))
+                return
 
         else:
-            for i in range(0, self.led_count + 1):
-                self.set_led_color(i, 0)
+            self.frame.fill(0)
 
         self.show()
 
@@ -153,7 +239,13 @@ class NeopixelDevice(Adafruit_NeoPixel):
 
     @state.setter
     def state(self, state: dict):
-        self.__state.update(state)
+        """
+        :raise ValueError: invalid state, the current state is kept
+        """
+        new_state = dict(self.__state)
+        new_state.update(state)
+        self.__compiled = self.compile_state(new_state)
+        self.__state = new_state
         self.__apply_state()
 
     def publish_state(self):
@@ -162,7 +254,11 @@ class NeopixelDevice(Adafruit_NeoPixel):
 
     async def __on_new_state_task(self, state, is_partial):
         self.LOG.debug("__on_new_state_task")
-        self.state = state
+        try:
+            self.state = state
+        except ValueError as e:
+            self.LOG.error('Ignoring invalid state: %s', e)
+            return
         self.publish_state()
 
     def on_new_state(self, state, is_partial):
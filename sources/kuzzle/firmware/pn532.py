@@ -1,21 +1,33 @@
+import asyncio
 import logging
 from typing import *
 
 import coloredlogs
 import sys
 import os
-import serial
 import subprocess
 import time
 
+import hal
+import metrics
+from pn532transport import Pn532Transport, Pn532Error
+from frametrace import HexBytes, FrameCapture
+from cardpresence import CardPresence
+
 """
 This class handles the Pn532 NFC module
 """
 
 
+POLLS = metrics.counter('pn532_polls_total', 'InAutoPoll polling cycles')
+POLL_ERRORS = metrics.counter('pn532_poll_errors_total', 'Polling cycles failed, timed out or with an invalid response')
+CARDS_ENTERED = metrics.counter('pn532_cards_entered_total', 'Cards entering the field')
+CARDS_LEFT = metrics.counter('pn532_cards_left_total', 'Cards leaving the field')
+
+
 class Pn532(object):
-    ACK = bytes([0x00, 0x00, 0xFF, 0x00, 0xFF, 0x00])
-    NACK = bytes([0x00, 0x00, 0xFF, 0xFF, 0x00, 0x00])
+    ACK = Pn532Transport.ACK
+    NACK = Pn532Transport.NACK
 
     CMD_DIAGNOSE = 0x01
     CMD_GET_FIRMWARE_VERSION = 0x02
@@ -25,17 +37,30 @@ class Pn532(object):
     CMD_IN_LIST_PASSIVE_TARGET = 0x4A
     CMD_IN_AUTO_POLL = 0x60
 
+    IN_AUTO_POLL_PERIOD = 0.150  # InAutoPoll period unit, in seconds
+    TARGET_MIFARE = 0x10  # InAutoPoll target type: Mifare card, 106 kbps type A
+
     LOG = logging.getLogger('PN532')
 
-    def __init__(self, serial_port: str = '/dev/serial0', state_callback: callable = None):
+    def __init__(self, serial_port: str = '/dev/serial0', state_callback: callable = None, serial_dev=None,
+                 event_loop: asyncio.AbstractEventLoop = None, trace: bool = False, capture: FrameCapture = None,
+                 idle_polls: int = 100, present_interval: float = 0.3, leave_misses: int = 2):
+        """
+        :param serial_dev: an already opened serial device to use instead of serial_port, e.g. a fake one
+        :param trace: log every frame sent and received, at debug level
+        :param capture: records the raw UART traffic, see frametrace.FrameCapture
+        :param idle_polls: InAutoPoll polls of 150ms done by the Pn532 while no card is in the field
+        :param present_interval: delay between two presence checks while cards are in the field, in seconds
+        :param leave_misses: consecutive presence checks missing a card before it is reported as left
+        """
+        assert 1 <= idle_polls <= 0xFE, "idle_polls must be in [1, 254]"
 
         self.serial_port = serial_port
         self.state_callback = state_callback
-
-        self.serial = None
-        self.serial = serial.Serial(self.serial_port, 115200)
-        self.LOG.info('Pn532 using serial port is: %s: %s', self.serial_port,
-                      '[OPENED]' if self.serial.is_open else '[CLOSED]')
+        self.ready = False
+        self.idle_polls = idle_polls
+        self.present_interval = present_interval
+        self.presence = CardPresence(leave_misses)
 
         coloredlogs.install(logger=Pn532.LOG,
                             fmt='[%(thread)X] - %(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -43,232 +68,183 @@ class Pn532(object):
                             stream=sys.stdout)
 
         self.LOG.setLevel(logging.DEBUG)
-        os.environ['LIBNFC_DEVICE'] = 'pn532_uart:/dev/serial0'
-        subprocess.run(['nfc-list'])
+
+        if serial_dev is None:
+            self.serial = hal.serial(self.serial_port, 115200)
+            self.LOG.info('Pn532 using serial port is: %s: %s', self.serial_port,
+                          '[OPENED]' if self.serial.is_open else '[CLOSED]')
+            if hal.backend().real:
+                os.environ['LIBNFC_DEVICE'] = 'pn532_uart:/dev/serial0'
+                subprocess.run(['nfc-list'])
+        else:
+            self.serial = serial_dev
+
+        self.transport = Pn532Transport(self.serial, event_loop, trace=trace, capture=capture)
 
     def cancel_command(self):
         """
         Cancel any pending operation on the Pn532
         :return:
         """
-        self.serial_write(self.ACK)
+        self.transport.cancel()
 
-    def version_check(self):
-        fw_version = None
+    async def version_check(self):
         self.LOG.debug("Get PN532 firmware revision: GetFirmwareVersion")
-        if self._write_frame(Pn532.CMD_GET_FIRMWARE_VERSION, prefix='getFirmwareVerion'):
-
-            frame = self._read_frame()
-
-            self.LOG.debug('Firmware version recv frame: %s', self.hex_dump('', frame))
-            fw_version = self.parse_firmware_version(frame)
+        resp = await self.transport.command(Pn532.CMD_GET_FIRMWARE_VERSION)
+        fw_version = self.parse_firmware_version(resp)
 
-            if fw_version:
-                self.LOG.info('Found PN53 version: %d.%d', fw_version['Ver'], fw_version['Rev'])
-            else:
-                self.LOG.error('Failed to get version from PN532')
+        if fw_version:
+            self.LOG.info('Found PN53 version: %d.%d', fw_version['Ver'], fw_version['Rev'])
+        else:
+            self.LOG.error('Failed to get version from PN532')
 
         return fw_version
 
-    def check_communication(self):
-        pass
-
-    def set_parameters(self, flags: int):
+    async def set_parameters(self, flags: int):
         assert 0x00 <= flags <= 0xFF, "flag is out of range"
 
-        if self._write_frame(self.CMD_SET_PARAMETERS, bytes([flags]), prefix='setParameter'):
-            resp = self._read_frame()
+        await self.transport.command(self.CMD_SET_PARAMETERS, bytes([flags]))
 
-    def sam_configuration(self):
+    async def sam_configuration(self):
         self.LOG.info('>SAMConfiguration')
-        if self._write_frame(self.CMD_SAM_CONFIGURATION, bytes([0x01, 0x17, 0x00]), prefix="SAMConfiguration"):
-            resp = self._read_frame()
-            self.LOG.info('<SAMConfiguration')
-
-    @staticmethod
-    def hex_dump(b, sep=' ', prefix=None):
-        _str = "{:13}: ".format(prefix) if prefix else ""
-
-        for a in b:
-            _str += "%02X%s" % (a, sep)
-
-        Pn532.LOG.debug(_str)
-        return _str
+        await self.transport.command(self.CMD_SAM_CONFIGURATION, bytes([0x01, 0x17, 0x00]))
+        self.LOG.info('<SAMConfiguration')
 
     @staticmethod
-    def _frame(cmd: int, data: bytes = None) -> bytes:
-        frame = bytes([0x00, 0x00, 0xFF, ])
-
-        l = 2 if not data else len(data) + 2
-        lcs = (-l) & 0xFF
-        frame += bytes([l, lcs, 0xD4, cmd])
-        if data:
-            frame += data
-
-        s = (0xD4 + cmd + (sum(data) if data else 0)) & 0xFF
-        dcs = (-s) & 0xFF
-        frame += bytes([dcs, 0x00])
-
-        return frame
-
-    def _write_frame(self, cmd: int, data: bytes = None, prefix=None):
-        ack = False
-        while not ack:
-            self.serial_write(self._frame(cmd, data))
-            ack = self._check_ack()
-
-            if ack is None:
-                self.LOG.warning("Cmd hasn't been ACKed...resending same cmd")
-            else:
-                if ack:
-                    self.LOG.debug("%s: ACK", prefix)
-                else:
-                    self.LOG.warning("%s: NACK", prefix)
-        return True  # TODO: return False after failling for some time
-
-    def _check_ack(self):
-        frame = self.serial_read_ack()
-        if frame is None:
-            return None
-
-        if frame == Pn532.ACK:
-            return True
-        else:
-            self.LOG.error(self.hex_dump(frame, prefix='NACK frame'))
-            return False
+    def card_id(nfcid: bytes) -> str:
+        """
+        :return: the card ID as published in the RFID reader state, e.g. '04A23BC2'
+        """
+        return bytes(nfcid).hex().upper()
 
     @staticmethod
-    def parse_firmware_version(frame):
-        if frame and bytes(frame[:6]) == b"\x00\x00\xff\x06\xfa\xd5":
-            IC = frame[7]
-            ver = frame[8]
-            rev = frame[9]
-            support = frame[10]
+    def parse_firmware_version(resp: bytes):
+        if resp and len(resp) >= 4:
+            IC = resp[0]
+            ver = resp[1]
+            rev = resp[2]
+            support = resp[3]
             return {'IC': IC, 'Ver': ver, 'Rev': rev, 'Support': support}
         else:
-            Pn532.LOG.critical("Invalid firmware version frame: %s", frame)
+            Pn532.LOG.critical("Invalid firmware version response: %s", resp)
             return None
 
-    def parse_card_id(self, frame: bytes) -> Optional[Dict[str, Any]]:
-        self.hex_dump(frame, prefix='InAutoPoll response')
-        data = frame[7:]
+    def parse_targets(self, data: bytes) -> List[Dict[str, Any]]:
+        """
+        :param data: InAutoPoll response data: NbTg, then for each target its type, length and data
+        :return: the cards found
+        """
+        if self.transport.trace:
+            Pn532.LOG.debug('InAutoPoll response: %s', HexBytes(data))
         nb_cards = data[0]
 
-        Pn532.LOG.debug("Nb card: %d", nb_cards)
-        if nb_cards == 0:
-            return None
-
-        card_type = data[1]
-        card_len = data[2]
-        card_data = data[3:card_len + 3]
-        SENS_RES = card_data[1:3]
-        SEL_RES = card_data[3]
-        NFCID_len = card_data[4]
-        NFCID = card_data[5:5 + NFCID_len]
-
-        if nb_cards != 1:
-            Pn532.LOG.warning('Not reading second card info...')
-
-        return {'SENS_RES': SENS_RES, 'SEL_RES': SENS_RES, 'NFCID': NFCID}
-
-    def serial_write(self, frame):
-        self.hex_dump(frame, prefix='Write frame')
-        self.serial.write(frame)
-
-    def _read_frame(self):
-        preamble = self.serial_read()
-        startcode = self.serial_read(2)
-        lenght = self.serial_read()
-        lcs = self.serial_read()
-        tfi = self.serial_read()
-        data = self.serial_read(int.from_bytes(lenght, byteorder='big') - 1)
-        dcs = self.serial_read()
-        postamble = self.serial_read()
-
-        self.hex_dump(preamble, prefix='PREAMBLE', )
-        self.hex_dump(startcode, prefix='START CODE')
-        self.hex_dump(lenght, prefix='LEN')
-        self.hex_dump(lcs, prefix='LCS')
-        self.hex_dump(tfi, prefix='TFI')
-        self.hex_dump(data, prefix='DATA[]')
-        self.hex_dump(dcs, prefix='DCS')
-        self.hex_dump(postamble, prefix='POSTAMBLE')
-
-        if int.from_bytes(tfi, byteorder='little') == 0x7f:
-            self.LOG.error("Syntax error frame!")
-
-        return preamble + startcode + lenght + lcs + tfi + data + dcs + postamble
-
-    def serial_read(self, count: int = 1):
-        return self.serial.read(count)
-
-    def serial_read_ack(self):
-        self.serial.timeout = 0.030
-        f = self.serial_read(6)
-        self.serial.timeout = None
-        return f
-
-    def start_polling(self):
-        Pn532.LOG.debug("Start polling for RFID cards...")
-
-        self.serial_write(
-            bytes([0x55, 0x55, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]))
-        time.sleep(2)
-        self.cancel_command()
-        time.sleep(2)
-        self.sam_configuration()
+        cards = []
+        offset = 1
+        for _ in range(0, nb_cards):
+            card_type = data[offset]
+            card_len = data[offset + 1]
+            card_data = data[offset + 2:offset + 2 + card_len]
+            offset += 2 + card_len
 
-        if self.version_check():
-            self.LOG.info('Found a Pn532 RFID/NFC module, starting card polling...')
-        else:
-            self.LOG.error('No Pn532 RFID/NFC found, exiting NFC/RFID card polling...')
-            return
+            if card_type != Pn532.TARGET_MIFARE:
+                Pn532.LOG.warning('Unsupported target type: 0x%02X', card_type)
+                continue
 
-        polling_data = [
-            0x64,  # PollNr : Number of polling [0x1-0xFE] or 0xFF for endless polling
-            0x01,  # Number of 150ms periods
-            0x10  # Type 1
-        ]
+            SENS_RES = card_data[1:3]
+            SEL_RES = card_data[3]
+            NFCID_len = card_data[4]
+            NFCID = card_data[5:5 + NFCID_len]
+            cards.append({'card_id': self.card_id(NFCID), 'SENS_RES': SENS_RES, 'SEL_RES': SEL_RES, 'NFCID': NFCID})
 
-        in_list_passive_target_data = [0x01, 0x00, ]
+        return cards
 
-        while 1:
-            self._write_frame(Pn532.CMD_IN_AUTO_POLL, bytes(polling_data), prefix='InAutoPoll')
-            frame = self._read_frame()
-            if frame:
-                Pn532.LOG.debug(self.hex_dump(frame))
-                card = self.parse_card_id(frame)
+    async def setup(self) -> bool:
+        """
+        Wake the Pn532 up and configure it
 
-                if card:
-                    self.LOG.info('Card ID: 0x%04x entering field', int.from_bytes(card["NFCID"], byteorder='little'))
-                    if self.state_callback:
-                        self.state_callback({'card_id': self.hex_dump(card["NFCID"], ''), 'in_field': True})
-                    in_field = True
-                else:
-                    in_field = False
+        :return: False if no Pn532 answered
+        """
+        self.transport.open()
+        self.transport.wake_up()
+        await asyncio.sleep(2)
+        self.cancel_command()
+        await asyncio.sleep(2)
 
-                while in_field:
+        try:
+            await self.sam_configuration()
+            if await self.version_check():
+                self.LOG.info('Found a Pn532 RFID/NFC module, starting card polling...')
+                return True
+        except (Pn532Error, asyncio.TimeoutError) as e:
+            self.LOG.error('Pn532 setup failed: %s', e)
 
-                    if self._write_frame(self.CMD_RF_CONFIGURATION, bytes([0x05, 0x00, 0x01, 0x02]),
-                                         prefix='RfConfiguration'):
-                        frame = self._read_frame()
-                        self.LOG.debug(self.hex_dump(frame))
+        self.LOG.error('No Pn532 RFID/NFC found')
+        return False
 
-                    if self._write_frame(self.CMD_IN_LIST_PASSIVE_TARGET,
-                                         bytes(in_list_passive_target_data) + card["NFCID"],
-                                         prefix='InListPassive'):
+    async def poll(self):
+        """
+        One polling cycle, the Pn532 itself polls the field with InAutoPoll:
+        - without card in the field: up to idle_polls polls of 150ms, the response comes as soon as a card enters
+        - with cards in the field: a single 150ms poll every present_interval, to check they are still there
+        Enter and leave transitions are published, debounced by presence.leave_misses
+        """
+        if not self.ready:
+            self.ready = await self.setup()
+            if not self.ready:
+                return
 
-                        frame = self._read_frame()
-                        self.LOG.debug(self.hex_dump(frame))
+        present = len(self.presence) > 0
+        polling_data = [
+            1 if present else self.idle_polls,  # PollNr : Number of polling [0x1-0xFE] or 0xFF for endless polling
+            0x01,  # Number of 150ms periods
+            Pn532.TARGET_MIFARE
+        ]
+        timeout = polling_data[0] * Pn532.IN_AUTO_POLL_PERIOD + self.transport.timeout
+
+        try:
+            sent_ts = time.monotonic()
+            resp = await self.transport.command(Pn532.CMD_IN_AUTO_POLL, bytes(polling_data), timeout=timeout)
+            cards = self.parse_targets(resp)
+            entered, left = self.presence.update(cards, time.monotonic() - sent_ts)
+        except asyncio.TimeoutError as e:
+            POLL_ERRORS.inc()
+            self.LOG.warning('%s', e)
+            return
+        except Pn532Error as e:
+            POLL_ERRORS.inc()
+            self.LOG.error('%s, setting the Pn532 up again', e)
+            self.ready = False
+            return
 
-                        in_field_cards_count = frame[7]
-                        in_field = in_field_cards_count != 0
+        POLLS.inc()
+        CARDS_ENTERED.inc(len(entered))
+        CARDS_LEFT.inc(len(left))
+        for card in entered:
+            self.LOG.info('Card ID: %s entering field', card['card_id'])
+            self.publish(card, True)
+        for card in left:
+            self.LOG.info('Card ID: %s leaving field', card['card_id'])
+            self.publish(card, False)
+
+        if len(self.presence):
+            await asyncio.sleep(self.present_interval)
+
+    def publish(self, card: dict, in_field: bool):
+        if self.state_callback:
+            self.state_callback({
+                'card_id': card['card_id'],
+                'in_field': in_field,
+                'cards_in_field': list(self.presence.cards),
+            })
+
+    async def start_polling(self):
+        Pn532.LOG.debug("Start polling for RFID cards...")
 
-                        if not in_field:
-                            self.LOG.info('Card ID: 0x%04x leaving field',
-                                          int.from_bytes(card["NFCID"], byteorder='little'))
-                            if self.state_callback:
-                                self.state_callback({'card_id': self.hex_dump(card["NFCID"], ''), 'in_field': False})
+        self.ready = await self.setup()
+        if not self.ready:
+            self.LOG.error('Exiting NFC/RFID card polling...')
+        while self.ready:
+            await self.poll()
 
 
 if __name__ == '__main__':
@@ -276,9 +252,6 @@ if __name__ == '__main__':
     pn532 = Pn532(state_callback=print)
 
     try:
-        v = pn532.version_check()
-        # pn532.set_parameters(0x14)
-        if v:
-            pn532.start_polling()
+        asyncio.get_event_loop().run_until_complete(pn532.start_polling())
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,381 @@
+import asyncio
+import collections
+import logging
+import time
+from typing import *
+
+import metrics
+from frametrace import HexBytes, FrameCapture
+
+"""
+Asynchronous transport of the Pn532 HSU (UART) link: the serial port is read in chunks when
+readable, frames are parsed incrementally and complete the future of the pending command
+"""
+
+
+class Pn532Error(Exception):
+    pass
+
+
+COMMANDS = metrics.counter('pn532_commands_total', 'Commands sent to the Pn532')
+COMMAND_DURATION = metrics.histogram('pn532_command_duration_seconds', 'Pn532 commands, from sending to the response')
+RESENT = metrics.counter('pn532_commands_resent_total', 'Pn532 commands sent again, not acknowledged')
+TIMEOUTS = metrics.counter('pn532_command_timeouts_total', 'Pn532 commands without response in time')
+
+# A frame received from the Pn532. data holds the frame payload after the TFI byte
+Pn532Frame = collections.namedtuple('Pn532Frame', ['kind', 'tfi', 'data'])
+
+
+class RingBuffer(object):
+    """
+    Fixed size receive buffer. Bytes are appended at the end and consumed from the start, the unread
+    bytes are moved back to the front only when the end of the storage is reached, so the parser always
+    works on contiguous memory without allocating.
+    """
+
+    def __init__(self, capacity: int = 512):
+        self.capacity = capacity
+        self.overflows = 0  # bytes dropped because the buffer was full
+        self.__buf = bytearray(capacity)
+        self.__start = 0
+        self.__end = 0
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def __getitem__(self, i: int) -> int:
+        return self.__buf[self.__start + i]
+
+    def write(self, data: bytes):
+        n = len(data)
+        if n > self.capacity:
+            self.overflows += n - self.capacity
+            data = data[-self.capacity:]
+            n = self.capacity
+
+        if self.__end + n > self.capacity:
+            size = self.__end - self.__start
+            if size + n > self.capacity:
+                # Full: drop the oldest bytes
+                drop = size + n - self.capacity
+                self.overflows += drop
+                self.__start += drop
+                size -= drop
+            self.__buf[0:size] = self.__buf[self.__start:self.__end]
+            self.__start = 0
+            self.__end = size
+
+        self.__buf[self.__end:self.__end + n] = data
+        self.__end += n
+
+    def find(self, sub: bytes, offset: int = 0) -> int:
+        i = self.__buf.find(sub, self.__start + offset, self.__end)
+        return i - self.__start if i >= 0 else -1
+
+    def peek(self, offset: int, count: int) -> bytes:
+        return bytes(self.__buf[self.__start + offset:self.__start + offset + count])
+
+    def consume(self, count: int):
+        self.__start = min(self.__start + count, self.__end)
+        if self.__start == self.__end:
+            self.__start = self.__end = 0
+
+
+class FrameParser(object):
+    """
+    Incremental Pn532 frame parser: PREAMBLE 00 FF LEN LCS TFI PD0..PDn DCS POSTAMBLE, extended
+    frames (00 FF FF FF LENM LENL LCS ...), ACK (00 FF 00 FF) and NACK (00 FF FF 00) frames.
+    Preamble and postamble bytes are skipped while looking for the next start code.
+    """
+
+    ACK = 'ack'
+    NACK = 'nack'
+    DATA = 'data'
+    ERROR = 'error'  # Application level error frame, TFI = 0x7F
+    CORRUPTED = 'corrupted'  # Valid length but wrong data checksum
+
+    START_CODE = b'\x00\xff'
+    TFI_ERROR = 0x7F
+
+    def __init__(self, capacity: int = 512):
+        self.buffer = RingBuffer(capacity)
+        self.frames = 0
+        self.lcs_errors = 0
+        self.dcs_errors = 0
+
+    def feed(self, data: bytes) -> List[Pn532Frame]:
+        """
+        :return: the frames completed by data
+        """
+        self.buffer.write(data)
+        frames = []
+        frame = self.__next_frame()
+        while frame is not None:
+            self.frames += 1
+            frames.append(frame)
+            frame = self.__next_frame()
+        return frames
+
+    def __next_frame(self) -> Optional[Pn532Frame]:
+        buf = self.buffer
+
+        while True:
+            i = buf.find(FrameParser.START_CODE)
+            if i < 0:
+                # Keep a trailing 00, it may be the first byte of a start code
+                buf.consume(len(buf) - 1 if len(buf) and buf[len(buf) - 1] == 0x00 else len(buf))
+                return None
+            buf.consume(i)
+
+            if len(buf) < 4:
+                return None
+
+            length, lcs = buf[2], buf[3]
+            if length == 0x00 and lcs == 0xFF:
+                buf.consume(4)
+                return Pn532Frame(FrameParser.ACK, None, b'')
+            if length == 0xFF and lcs == 0x00:
+                buf.consume(4)
+                return Pn532Frame(FrameParser.NACK, None, b'')
+
+            if length == 0xFF and lcs == 0xFF:
+                if len(buf) < 7:
+                    return None
+                header = 7
+                length = (buf[4] << 8) | buf[5]
+                valid = (buf[4] + buf[5] + buf[6]) & 0xFF == 0
+            else:
+                header = 4
+                valid = (length + lcs) & 0xFF == 0
+
+            if not valid or length == 0 or header + length + 1 > buf.capacity:
+                # Not a frame header: skip this start code
+                self.lcs_errors += 1
+                buf.consume(2)
+                continue
+
+            if len(buf) < header + length + 1:
+                return None
+
+            body = buf.peek(header, length)
+            dcs = buf[header + length]
+            buf.consume(header + length + 1)
+
+            if (sum(body) + dcs) & 0xFF:
+                self.dcs_errors += 1
+                return Pn532Frame(FrameParser.CORRUPTED, body[0], body[1:])
+            if body[0] == FrameParser.TFI_ERROR:
+                return Pn532Frame(FrameParser.ERROR, body[0], body[1:])
+            return Pn532Frame(FrameParser.DATA, body[0], body[1:])
+
+
+class Pn532Transport(object):
+    """
+    Sends Pn532 commands and waits for their ACK and response without blocking the event loop.
+
+    A command not acknowledged within ack_timeout is resent, up to retries times. A corrupted
+    response is requested again with a NACK, up to retries times.
+    """
+
+    ACK = bytes([0x00, 0x00, 0xFF, 0x00, 0xFF, 0x00])
+    NACK = bytes([0x00, 0x00, 0xFF, 0xFF, 0x00, 0x00])
+    WAKE_UP = bytes([0x55, 0x55, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00])
+
+    TFI_HOST = 0xD4
+    TFI_PN532 = 0xD5
+
+    READ_CHUNK = 256
+
+    LOG = logging.getLogger('PN532')
+
+    def __init__(self, serial, event_loop: asyncio.AbstractEventLoop = None, ack_timeout: float = 0.030,
+                 timeout: float = 1.0, retries: int = 3, trace: bool = False, capture: FrameCapture = None):
+        """
+        :param serial: an opened serial.Serial, or any object with read(), write() and fileno()
+        :param ack_timeout: delay to receive the ACK of a command, in seconds
+        :param timeout: default delay to receive the response of a command, in seconds
+        :param retries: resends of an unacknowledged command, and NACKs of a corrupted response
+        :param trace: log the frames sent and received, at debug level
+        :param capture: records the raw bytes sent and received
+        """
+        self.serial = serial
+        self.trace = trace
+        self.capture = capture
+        self.event_loop = event_loop if event_loop else asyncio.get_event_loop()
+        self.ack_timeout = ack_timeout
+        self.timeout = timeout
+        self.retries = retries
+        self.parser = FrameParser()
+
+        self.__lock = asyncio.Lock()
+        self.__opened = False
+        self.__ack = None  # type: asyncio.Future
+        self.__response = None  # type: asyncio.Future
+        self.__nacks = 0
+
+        self.reads = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.resent = 0
+        self.timeouts = 0
+
+    def open(self):
+        if self.__opened:
+            return
+        self.serial.timeout = 0  # Non blocking reads: read() returns what is already received
+        self.event_loop.add_reader(self.serial.fileno(), self.__on_readable)
+        self.__opened = True
+
+    def close(self):
+        if not self.__opened:
+            return
+        self.event_loop.remove_reader(self.serial.fileno())
+        self.__opened = False
+        for f in [self.__ack, self.__response]:
+            if f is not None and not f.done():
+                f.set_exception(Pn532Error('Transport closed'))
+
+    def __on_readable(self):
+        try:
+            data = self.serial.read(Pn532Transport.READ_CHUNK)
+        except Exception as e:
+            self.LOG.error('Serial read failed: %r', e)
+            return
+        self.reads += 1
+        if data:
+            if self.capture is not None:
+                self.capture.record(FrameCapture.RX, data)
+            self.feed(data)
+
+    def feed(self, data: bytes):
+        """
+        Handle bytes received from the Pn532
+        """
+        self.bytes_received += len(data)
+        for frame in self.parser.feed(data):
+            self.__on_frame(frame)
+
+    def __on_frame(self, frame: Pn532Frame):
+        if self.trace:
+            self.LOG.debug('< %s %s', frame.kind, HexBytes(frame.data))
+
+        if frame.kind in [FrameParser.ACK, FrameParser.NACK]:
+            if self.__ack is not None and not self.__ack.done():
+                self.__ack.set_result(frame.kind == FrameParser.ACK)
+            return
+
+        if self.__response is None or self.__response.done():
+            self.LOG.debug('Unexpected %s frame, dropped', frame.kind)
+            return
+
+        if frame.kind == FrameParser.CORRUPTED:
+            if self.__nacks < self.retries:
+                self.__nacks += 1
+                self.LOG.warning('Corrupted response frame, asking the Pn532 to resend it')
+                self.write(Pn532Transport.NACK)
+            else:
+                self.__response.set_exception(Pn532Error('Corrupted response frame'))
+        elif frame.kind == FrameParser.ERROR:
+            self.__response.set_exception(Pn532Error('Pn532 application error frame'))
+        else:
+            self.__response.set_result(frame)
+
+    def write(self, data: bytes):
+        if self.trace:
+            self.LOG.debug('> %s', HexBytes(data))
+        if self.capture is not None:
+            self.capture.record(FrameCapture.TX, data)
+        self.bytes_sent += len(data)
+        self.serial.write(data)
+
+    def wake_up(self):
+        self.write(Pn532Transport.WAKE_UP)
+
+    def cancel(self):
+        """
+        Cancel any pending operation on the Pn532
+        """
+        self.write(Pn532Transport.ACK)
+
+    @staticmethod
+    def frame(cmd: int, data: bytes = None) -> bytes:
+        frame = bytes([0x00, 0x00, 0xFF, ])
+
+        l = 2 if not data else len(data) + 2
+        lcs = (-l) & 0xFF
+        frame += bytes([l, lcs, Pn532Transport.TFI_HOST, cmd])
+        if data:
+            frame += data
+
+        s = (Pn532Transport.TFI_HOST + cmd + (sum(data) if data else 0)) & 0xFF
+        dcs = (-s) & 0xFF
+        frame += bytes([dcs, 0x00])
+
+        return frame
+
+    async def command(self, cmd: int, data: bytes = None, timeout: float = None) -> bytes:
+        """
+        Send a command and wait for its response
+
+        :param timeout: delay to receive the response, defaults to the transport timeout
+        :return: the response data, after the response code
+        :raise Pn532Error: the command has not been acknowledged, or the response is invalid
+        :raise asyncio.TimeoutError: no response received in time, the command is cancelled
+        """
+        timeout = self.timeout if timeout is None else timeout
+        request = self.frame(cmd, data)
+
+        async with self.__lock:
+            COMMANDS.inc()
+            sent_ts = time.perf_counter()
+            try:
+                for attempt in range(0, self.retries + 1):
+                    if attempt:
+                        self.resent += 1
+                        RESENT.inc()
+                    self.__ack = self.event_loop.create_future()
+                    self.__response = self.event_loop.create_future()
+                    self.__nacks = 0
+                    self.write(request)
+
+                    try:
+                        acked = await asyncio.wait_for(self.__ack, self.ack_timeout)
+                    except asyncio.TimeoutError:
+                        acked = None
+
+                    if acked:
+                        break
+                    self.LOG.warning('Command 0x%02X: %s', cmd, 'NACK' if acked is False else 'no ACK')
+                else:
+                    raise Pn532Error('Command 0x{:02X} not acknowledged after {} attempts'.format(
+                        cmd, self.retries + 1))
+
+                try:
+                    frame = await asyncio.wait_for(self.__response, timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    TIMEOUTS.inc()
+                    self.cancel()
+                    raise asyncio.TimeoutError('Command 0x{:02X}: no response after {}s'.format(cmd, timeout))
+            finally:
+                self.__ack = None
+                self.__response = None
+            COMMAND_DURATION.observe(time.perf_counter() - sent_ts)
+
+        if frame.tfi != Pn532Transport.TFI_PN532 or not frame.data or frame.data[0] != cmd + 1:
+            raise Pn532Error('Command 0x{:02X}: unexpected response TFI = 0x{:02X}, code = {}'.format(
+                cmd, frame.tfi, frame.data[:1].hex()))
+        return frame.data[1:]
+
+    def stats(self) -> dict:
+        return {
+            "reads": self.reads,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "frames": self.parser.frames,
+            "lcs_errors": self.parser.lcs_errors,
+            "dcs_errors": self.parser.dcs_errors,
+            "overflows": self.parser.buffer.overflows,
+            "resent": self.resent,
+            "timeouts": self.timeouts,
+        }
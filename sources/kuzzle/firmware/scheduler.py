@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import concurrent.futures
+from typing import *
+
+import metrics
+
+"""
+Runs the periodic sampling jobs of the firmware on the asyncio event loop.
+
+Each job is a coroutine task ticking on a drift-free schedule (tick n is due at start + n * period).
+Blocking hardware I/O is offloaded to a small executor shared by all the jobs, so adding a sensor
+adds a job, not a thread.
+"""
+
+
+class SamplingJob(object):
+    def __init__(self, name: str, func: callable, period: float, offload: bool = True):
+        """
+        :param name: job name, used in logs and statistics
+        :param func: called on each tick, a plain function or a coroutine function
+        :param period: delay between two ticks in seconds, 0 runs the job back to back
+        :param offload: run func in the scheduler executor, for blocking hardware I/O
+        """
+        assert period >= 0, "period must be >= 0"
+
+        self.name = name
+        self.func = func
+        self.period = period
+        self.offload = offload
+        self.task = None
+
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0  # runs that lasted longer than the time left before the next tick
+        self.skipped = 0  # ticks skipped because of overruns
+        self.jitter_last = 0.0
+        self.jitter_max = 0.0
+        self.jitter_total = 0.0
+        self.duration_last = 0.0
+        self.duration_max = 0.0
+        self.duration_total = 0.0
+
+        labels = {'job': name}
+        self.runs_metric = metrics.counter('firmware_job_runs_total', 'Runs of the sampling jobs', labels)
+        self.errors_metric = metrics.counter('firmware_job_errors_total', 'Failed runs of the sampling jobs', labels)
+        self.overruns_metric = metrics.counter('firmware_job_overruns_total',
+                                               'Runs longer than the time left before the next tick', labels)
+        self.skipped_metric = metrics.counter('firmware_job_skipped_ticks_total', 'Ticks skipped after overruns',
+                                              labels)
+        self.jitter_metric = metrics.histogram('firmware_job_jitter_seconds', 'Delay of the job runs after their tick',
+                                               labels=labels)
+        self.duration_metric = metrics.histogram('firmware_job_duration_seconds', 'Duration of the job runs',
+                                                 labels=labels)
+        metrics.gauge('firmware_job_period_seconds', 'Period of the sampling jobs', labels).set(period)
+
+    def stats(self) -> dict:
+        """
+        :return: jitter (tick start delay) and run duration statistics, in seconds
+        """
+        return {
+            "period": self.period,
+            "runs": self.runs,
+            "errors": self.errors,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "jitter_last": self.jitter_last,
+            "jitter_max": self.jitter_max,
+            "jitter_avg": self.jitter_total / self.runs if self.runs else 0.0,
+            "duration_last": self.duration_last,
+            "duration_max": self.duration_max,
+            "duration_avg": self.duration_total / self.runs if self.runs else 0.0,
+        }
+
+
+class SamplingScheduler(object):
+    ERROR_DELAY = 1.0  # delay before running a failed back to back job again, in seconds
+
+    LOG = logging.getLogger('Scheduler')
+
+    def __init__(self, max_workers: int = 2, event_loop: asyncio.AbstractEventLoop = None):
+        """
+        :param max_workers: size of the executor running the offloaded jobs. A job blocking for
+                            longer than its period holds a worker, and other offloaded jobs wait for it
+        """
+        self.event_loop = event_loop if event_loop else asyncio.get_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = []  # type: List[SamplingJob]
+        self.__running = False
+
+    def add_job(self, name: str, func: callable, period: float, offload: bool = True) -> SamplingJob:
+        """
+        Add a periodic job, started right away if the scheduler is running
+        """
+        assert name not in [j.name for j in self.jobs], 'Job {} already exists'.format(name)
+
+        job = SamplingJob(name, func, period, offload)
+        self.jobs.append(job)
+        if self.__running:
+            job.task = self.event_loop.create_task(self.__job_task(job))
+        return job
+
+    def start(self):
+        self.LOG.info('Starting sampling jobs: %s', ', '.join(
+            ['{} ({}s)'.format(j.name, j.period) for j in self.jobs]))
+        self.__running = True
+        for job in self.jobs:
+            if job.task is None:
+                job.task = self.event_loop.create_task(self.__job_task(job))
+
+    def stop(self):
+        self.__running = False
+        for job in self.jobs:
+            if job.task is not None:
+                job.task.cancel()
+                job.task = None
+        self.executor.shutdown(wait=False)
+
+    async def __job_task(self, job: SamplingJob):
+        next_tick = self.event_loop.time()
+
+        while self.__running:
+            delay = next_tick - self.event_loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            start = self.event_loop.time()
+            job.jitter_last = start - next_tick
+            job.jitter_max = max(job.jitter_max, job.jitter_last)
+            job.jitter_total += job.jitter_last
+            job.jitter_metric.observe(job.jitter_last)
+
+            failed = False
+            try:
+                if job.offload:
+                    result = await self.event_loop.run_in_executor(self.executor, job.func)
+                else:
+                    result = job.func()
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.errors += 1
+                job.errors_metric.inc()
+                failed = True
+                self.LOG.error('Job %s failed: %r', job.name, e)
+
+            end = self.event_loop.time()
+            job.runs += 1
+            job.duration_last = end - start
+            job.duration_max = max(job.duration_max, job.duration_last)
+            job.duration_total += job.duration_last
+            job.runs_metric.inc()
+            job.duration_metric.observe(job.duration_last)
+
+            if not job.period:
+                next_tick = end + self.ERROR_DELAY if failed else end
+                continue
+
+            next_tick += job.period
+            if end > next_tick:
+                # Skip the missed ticks instead of running them in a burst, keeping the schedule phase
+                missed = int((end - next_tick) / job.period) + 1
+                job.overruns += 1
+                job.skipped += missed
+                job.overruns_metric.inc()
+                job.skipped_metric.inc(missed)
+                next_tick += missed * job.period
+
+    def stats(self) -> dict:
+        return {job.name: job.stats() for job in self.jobs}
+
+    def log_stats(self):
+        for name, s in self.stats().items():
+            self.LOG.info('%s: %d runs, %d errors, %d overruns, jitter avg/max %.1f/%.1f ms, '
+                          'duration avg/max %.1f/%.1f ms', name, s['runs'], s['errors'], s['overruns'],
+                          s['jitter_avg'] * 1000, s['jitter_max'] * 1000,
+                          s['duration_avg'] * 1000, s['duration_max'] * 1000)
@@ -1,5 +1,14 @@
+import array
+import bisect
+from typing import *
+
 import mcp3208
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 """
 This class handles the TEPT5700 ambient light sensor
 """
@@ -10,23 +19,85 @@ class Tept5700(object):
     m = 1.0
     k = 1.3333333333333333
 
-    def __init__(self, v_ce, rl, mcp_channel = 0):
+    ADC_CODES = 4096  # MCP3208 is a 12 bits ADC
+    V_CE_SAT = 0.1  # collector emitter saturation voltage: the voltage across Rl cannot exceed v_ce - V_CE_SAT
+
+    def __init__(self, v_ce, rl, mcp_channel = 0, oversampling: int = 16, mcp: mcp3208.MCP3208 = None,
+                 m: float = None, k: float = None, calibration: Sequence[Tuple[float, float]] = None):
         """
 
         :param v_ce: Tept57000 alimentation tension
         :param Rl: Load resistor
+        :param oversampling: number of ADC samples read in one burst for each reading, the median is used
+        :param mcp: the MCP3208 the sensor is wired to, a dedicated one is opened on SPI bus 0 if None
+        :param m: slope of the log(lux)/log(I) line for v_ce, defaults to Tept5700.m (Vce = 5v)
+        :param k: factor of the log(lux)/log(I) line for v_ce, defaults to Tept5700.k (Vce = 5v)
+        :param calibration: optional per-board calibration curve, (computed lux, actual lux) points
         """
-        self.mcp3208 = mcp3208.MCP3208(5.2, 0, 0)
+        self.mcp3208 = mcp if mcp else mcp3208.MCP3208(5.2, 0, 0)
         self.v_ce = v_ce
         self.rl = rl
         self.mcp_channel = mcp_channel
+        self.oversampling = oversampling
+        if m is not None:
+            self.m = m
+        if k is not None:
+            self.k = k
+        self.calibration = sorted((float(x), float(y)) for x, y in calibration) if calibration else None
+        self.table = self.build_table()
+
+    def build_table(self):
+        """
+        Precompute the lux value of each of the 4096 ADC codes, calibration included. Codes above the
+        saturation voltage of the sensor for v_ce all map to the saturation lux value
+        """
+        scale = self.mcp3208.v_ref / Tept5700.ADC_CODES
+        table = [self.calibrate(self.lux(code * scale)) for code in range(0, Tept5700.ADC_CODES)]
+        return numpy.array(table, dtype=numpy.float64) if numpy is not None else array.array('d', table)
+
+    def calibrate(self, lux: float) -> float:
+        """
+        Correct a computed lux value with the calibration curve, using linear interpolation
+        """
+        if not self.calibration:
+            return lux
+
+        points = self.calibration
+        i = bisect.bisect_left(points, (lux,))
+        if i == 0:
+            i = 1
+        elif i == len(points):
+            i = len(points) - 1
+        (x0, y0), (x1, y1) = points[i - 1], points[i]
+        return y0 + (lux - x0) * (y1 - y0) / (x1 - x0) if x1 != x0 else y0
+
+    def lux_from_codes(self, codes):
+        """
+        Convert raw 12 bits ADC codes to lux in one pass through the lookup table
+
+        :param codes: a numpy array or a sequence of ADC codes
+        :return: a list of floats, numpy scalars are not JSON serializable by orjson
+        """
+        if numpy is not None:
+            return self.table[numpy.asarray(codes, dtype=numpy.intp)].tolist()
+        return [self.table[c] for c in codes]
+
+    def lux_from_code(self, code: int) -> float:
+        return float(self.table[int(code)])
 
     def read_lux(self):
+        if self.oversampling > 1:
+            burst = self.mcp3208.read_burst(mcp3208.MCP3208.SINGLE, [self.mcp_channel], self.oversampling)
+            reading = burst[self.mcp_channel]
+            return reading.median_voltage, self.lux_from_code(reading.median_code)
+
         voltage = self.mcp3208.read_channel(mcp3208.MCP3208.SINGLE, self.mcp_channel)
-        i_ua = voltage / self.rl * 1000000.0
-        lux = self.k * pow(i_ua, self.m)
+        return voltage, self.calibrate(self.lux(voltage))
 
-        return voltage, lux
+    def lux(self, voltage: float) -> float:
+        voltage = min(voltage, self.v_ce - Tept5700.V_CE_SAT)
+        i_ua = voltage / self.rl * 1000000.0
+        return self.k * pow(i_ua, self.m)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import sys
+from typing import *
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firmware'))
+
+import coloredlogs
+
+from simulator.fleet import Rates, run_boards
+from simulator.mockkuzzle import MockKuzzleProcess
+
+"""
+Fleet simulator: runs N virtual boards against Kuzzle, or against a local mock Kuzzle started in a child
+process, and reports the achieved message rate, the round trip time percentiles, and the client CPU and
+memory per board.
+
+Usage, from sources/kuzzle: python3 -m simulator --boards 1000 --processes 4 --duration 60
+"""
+
+log = logging.getLogger('Simulator')
+
+
+def percentile(samples: List[float], p: float) -> float:
+    """
+    :param samples: sorted samples
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+def aggregate(results: List[dict]) -> dict:
+    boards = sum(r["boards"] for r in results)
+    elapsed = max(r["elapsed"] for r in results)
+    latencies = sorted(l for r in results for l in r["latencies"])
+    published = sum(r["published"] for r in results)
+    requests = sum(r["requests"] for r in results)
+    cpu = sum(r["cpu_time"] for r in results)
+    return {
+        "boards": boards,
+        "connected": sum(r["connected"] for r in results),
+        "processes": len(results),
+        "duration": elapsed,
+        "states_published": published,
+        "states_rate": published / elapsed,
+        "requests": requests,
+        "requests_rate": requests / elapsed,
+        "commands": sum(r["commands"] for r in results),
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "p999": percentile(latencies, 99.9),
+            "max": max(r["latency_max"] for r in results),
+        },
+        "cpu_per_board": cpu / elapsed / boards,  # fraction of a core
+        "rss_per_board": sum(r["rss_boards"] for r in results) / boards,  # bytes
+        "rss_total": sum(r["rss"] for r in results),
+    }
+
+
+def report(stats: dict):
+    print("+-------------------------------+---------------+")
+    print("| boards (connected)            | {:>13} |".format('{} ({})'.format(stats["boards"], stats["connected"])))
+    print("| processes                     | {:13d} |".format(stats["processes"]))
+    print("| duration (s)                  | {:13.1f} |".format(stats["duration"]))
+    print("| states published / s          | {:13.1f} |".format(stats["states_rate"]))
+    print("| requests answered / s         | {:13.1f} |".format(stats["requests_rate"]))
+    for p in ["p50", "p90", "p99", "p999", "max"]:
+        print("| round trip {:4} (ms)          | {:13.2f} |".format(p, stats["latency"][p] * 1000))
+    print("| CPU per board (% of a core)   | {:13.3f} |".format(stats["cpu_per_board"] * 100))
+    print("| memory per board (KiB)        | {:13.1f} |".format(stats["rss_per_board"] / 1024))
+    mock = stats.get("mock")
+    if mock:
+        print("| mock: messages received / s   | {:13.1f} |".format(mock["received_rate"]))
+        print("| mock: notifications sent      | {:13d} |".format(mock["notifications"]))
+    print("+-------------------------------+---------------+")
+
+
+def main(argv: List[str]) -> dict:
+    parser = argparse.ArgumentParser(description='Kuzzle IoT - fleet simulator', prog='simulator')
+    parser.add_argument('--boards', type=int, default=100, help='virtual boards')
+    parser.add_argument('--processes', type=int, default=1, help='processes running the boards')
+    parser.add_argument('--duration', type=float, default=30.0, help='measure duration, in seconds')
+    parser.add_argument('--ramp', type=float, default=5.0, help='delay to connect all the boards, in seconds')
+    parser.add_argument('--host', default=None, help='Kuzzle host, a mock Kuzzle is started if not set')
+    parser.add_argument('--port', default='7512', help='Kuzzle port')
+    parser.add_argument('--rate-scale', type=float, default=1.0, help='multiplies every sensor rate')
+    parser.add_argument('--light-rate', type=float, default=Rates().light, help='light levels per second')
+    parser.add_argument('--buttons-rate', type=float, default=Rates().buttons, help='button presses per second')
+    parser.add_argument('--motion-rate', type=float, default=Rates().motion, help='motion detections per second')
+    parser.add_argument('--cards-rate', type=float, default=Rates().cards, help='card reads per second')
+    parser.add_argument('--command-rate', type=float, default=0.0,
+                        help='neopixel state changes per second sent by the mock Kuzzle')
+    parser.add_argument('--batch', action='store_true', help='publish the states with document:mCreate batches')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    coloredlogs.install(level=logging.INFO, stream=sys.stdout)
+    logging.getLogger('websockets').setLevel(logging.WARNING)
+    rates = Rates(*[r * args.rate_scale for r in [args.light_rate, args.buttons_rate, args.motion_rate,
+                                                   args.cards_rate]])
+
+    host = args.host
+    mock = None
+    if host is None:
+        host = 'localhost'
+        mock = MockKuzzleProcess(host, int(args.port), args.command_rate)
+        if not mock.start():
+            log.critical('Mock Kuzzle did not start')
+            exit(-1)
+
+    processes = max(1, min(args.processes, args.boards))
+    shares = [args.boards // processes + (1 if i < args.boards % processes else 0) for i in range(0, processes)]
+    jobs = [(sum(shares[:i]), shares[i], host, args.port, args.duration, rates, args.batch, args.ramp)
+            for i in range(0, processes)]
+    log.info('Running %d boards in %d processes for %.0fs, rates: %s', args.boards, processes, args.duration, rates)
+    if processes == 1:
+        results = [run_boards(*jobs[0])]
+    else:
+        with mp.Pool(processes) as pool:
+            results = pool.starmap(run_boards, jobs)
+
+    stats = aggregate(results)
+    if mock is not None:
+        stats["mock"] = mock.stop()
+
+    report(stats)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats, f, indent=2)
+    return stats
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
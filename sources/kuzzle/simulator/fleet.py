@@ -0,0 +1,227 @@
+import asyncio
+import collections
+import logging
+import os
+import random
+import resource
+import time
+from typing import *
+
+from kuzzle.kuzzle import KuzzleIOT
+from kuzzle.connection import KuzzleConnection
+
+"""
+Virtual boards: the devices of a real board (see firmware.init_hw_components) publishing synthetic
+sensor states through the real KuzzleIOT client, many boards sharing one event loop
+"""
+
+# Mean event rates of a board, per second
+Rates = collections.namedtuple('Rates', ['light', 'buttons', 'motion', 'cards'])
+Rates.__new__.__defaults__ = (0.2, 0.05, 0.02, 0.01)
+
+LOG = logging.getLogger('Fleet')
+
+LATENCY_SAMPLES = 100000  # round trip times kept per process for the percentiles
+
+
+class Reservoir(object):
+    """
+    Uniform random sample of at most size values of a stream (reservoir sampling): the memory used
+    does not grow with the duration of the run
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.samples = []  # type: List[float]
+        self.count = 0
+
+    def append(self, value: float):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            i = random.randrange(self.count)
+            if i < self.size:
+                self.samples[i] = value
+
+    def clear(self):
+        self.count = 0
+        del self.samples[:]
+
+
+class VirtualBoard(object):
+    def __init__(self, uid: str, host: str, port: str, owner: str = 'fleet', rates: Rates = Rates(),
+                 batch: bool = False, led_count: int = 16):
+        self.uid = uid
+        self.rates = rates
+        self.connection = KuzzleConnection(host, port)
+        if batch:
+            self.connection.enable_batching(KuzzleIOT.INDEX_IOT, KuzzleIOT.COLLECTION_DEVICE_STATES)
+
+        def device(device_uid: str, device_type: str, additional_info: dict = None) -> KuzzleIOT:
+            return KuzzleIOT(device_uid, device_type, host=host, port=port, owner=owner, connection=self.connection,
+                             additional_info=additional_info)
+
+        self.neo = device('rgb_light_{}'.format(uid), 'neopixel-linear', {'led_count': led_count})
+        self.rfid = device('NFC_' + uid, 'RFID_reader')
+        self.motion = device('motion_' + uid, 'motion-sensor')
+        self.buttons = device('buttons_{}'.format(uid), 'button')
+        self.light = device('light_lvl_{}'.format(uid), 'light_sensor')
+        self.devices = [self.neo, self.rfid, self.motion, self.buttons, self.light]
+        self.board = device(uid, 'iot-board-2018', {
+            'devices': [d.device_uid for d in self.devices],
+            'hw_version': '2.0',
+            'sw_version': 'fleet'
+        })
+
+        self.neo_state = {'on': True, 'mode': 'single-color', 'color': '#000000'}
+        self.button_states = {'button_{}'.format(i): 'RELEASED' for i in range(0, 4)}
+        self.lux = random.uniform(50.0, 500.0)
+        self.published = 0
+        self.commands = 0
+        self.__tasks = []  # type: List[asyncio.Task]
+
+    async def connect(self):
+        await asyncio.gather(*[d.connect(None) for d in self.devices])
+        await self.board.connect(None)
+        if self.connection.connected:
+            self.publish(self.neo, self.neo_state)
+            self.neo.subscribe_state(self.on_neo_state)
+
+    def publish(self, device: KuzzleIOT, state: dict):
+        self.published += 1
+        device.publish_state(state)
+
+    def on_neo_state(self, state: dict, is_partial: bool):
+        """
+        Apply and publish a state change received from Kuzzle, as the neopixel device does
+        """
+        self.commands += 1
+        self.neo_state.update(state)
+        self.publish(self.neo, self.neo_state)
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.__tasks = [loop.create_task(self.__sensor_task(rate, behaviour)) for rate, behaviour in [
+            (self.rates.light, self.light_changed),
+            (self.rates.buttons, self.button_pressed),
+            (self.rates.motion, self.motion_detected),
+            (self.rates.cards, self.card_read),
+        ] if rate > 0]
+
+    def stop(self):
+        for t in self.__tasks:
+            t.cancel()
+        self.__tasks = []
+
+    async def __sensor_task(self, rate: float, behaviour: callable):
+        # Random phase so the boards don't publish in lockstep
+        await asyncio.sleep(random.uniform(0, 1.0 / rate))
+        while True:
+            await behaviour()
+            await asyncio.sleep(random.expovariate(rate))
+
+    async def light_changed(self):
+        self.lux = max(0.0, self.lux * random.uniform(0.8, 1.25))
+        self.publish(self.light, {'level': round(self.lux, 1)})
+
+    async def button_pressed(self):
+        button = 'button_{}'.format(random.randrange(0, 4))
+        self.button_states[button] = 'PRESSED'
+        self.publish(self.buttons, dict(self.button_states))
+        await asyncio.sleep(random.uniform(0.05, 0.3))
+        self.button_states[button] = 'RELEASED'
+        self.publish(self.buttons, dict(self.button_states))
+
+    async def motion_detected(self):
+        self.publish(self.motion, {'motion': True})
+        await asyncio.sleep(random.uniform(1.0, 5.0))
+        self.publish(self.motion, {'motion': False})
+
+    async def card_read(self):
+        card_id = '{:08X}'.format(random.randrange(0x100000000))
+        self.publish(self.rfid, {'card_id': card_id, 'in_field': True, 'cards_in_field': [card_id]})
+        await asyncio.sleep(random.uniform(0.5, 3.0))
+        self.publish(self.rfid, {'card_id': card_id, 'in_field': False, 'cards_in_field': []})
+
+    def close(self):
+        self.stop()
+        return self.connection.close()
+
+
+def rss() -> int:
+    """
+    :return: resident set size of the process, in bytes
+    """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_boards(first: int, count: int, host: str, port: str, duration: float, rates: Rates, batch: bool = False,
+               ramp: float = 5.0) -> dict:
+    """
+    Run count boards on a new event loop of the calling process
+
+    :param first: index of the first board, used for the board UIDs
+    :param ramp: the boards connect over ramp seconds, not all at once
+    :return: the client side statistics of the boards
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    rss_start = rss()
+    boards = [VirtualBoard('fleet{:08d}'.format(i), host, port, rates=rates, batch=batch)
+              for i in range(first, first + count)]
+    for logger in [KuzzleIOT.LOG, KuzzleConnection.LOG, logging.getLogger('websockets')]:
+        logger.setLevel(logging.WARNING)  # KuzzleIOT sets it to debug on each instance
+
+    samples = Reservoir(LATENCY_SAMPLES)
+    for b in boards:
+        b.connection.rtt_samples = samples
+
+    async def connect_task(b: VirtualBoard, delay: float):
+        await asyncio.sleep(delay)
+        await b.connect()
+
+    loop.run_until_complete(asyncio.gather(*[connect_task(b, ramp * i / count) for i, b in enumerate(boards)]))
+    connected = sum(1 for b in boards if b.connection.connected)
+    LOG.info('%d/%d boards connected', connected, count)
+
+    samples.clear()
+    for b in boards:
+        b.published = 0
+        b.commands = 0
+        b.connection.rtt_count = 0
+        b.connection.rtt_max = 0.0
+        b.start()
+
+    cpu_start = cpu_time()
+    started = time.monotonic()
+    loop.run_until_complete(asyncio.sleep(duration))
+    elapsed = time.monotonic() - started
+    cpu = cpu_time() - cpu_start
+    rss_end = rss()
+
+    for b in boards:
+        b.stop()
+    loop.run_until_complete(asyncio.gather(*[b.close() for b in boards], return_exceptions=True))
+    loop.close()
+
+    return {
+        "boards": count,
+        "connected": connected,
+        "elapsed": elapsed,
+        "published": sum(b.published for b in boards),
+        "requests": sum(b.connection.rtt_count for b in boards),
+        "commands": sum(b.commands for b in boards),
+        "cpu_time": cpu,
+        "rss": rss_end,
+        "rss_boards": rss_end - rss_start,
+        "latencies": samples.samples,
+        "latency_max": max([b.connection.rtt_max for b in boards] or [0.0]),
+    }
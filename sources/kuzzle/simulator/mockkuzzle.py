@@ -0,0 +1,294 @@
+import asyncio
+import collections
+import http
+import logging
+import multiprocessing as mp
+import random
+import time
+import uuid
+from typing import *
+
+import websockets
+import websockets.exceptions as wse
+
+from kuzzle import serializer
+from kuzzle.connection import KuzzleConnection
+
+"""
+Kuzzle stand-in for load tests: answers the queries of the firmware over WebSocket (document get,
+create, createOrReplace, replace, mCreate, search, realtime subscribe), sends the realtime notifications
+of the documents created, and answers GET /_serverInfo over HTTP.
+
+Device states are counted, not stored, so the server memory does not grow with the test duration.
+"""
+
+# A realtime subscription: the client socket and the document filter, {} or {"equals": {field: value}}
+Subscription = collections.namedtuple('Subscription', ['ws', 'index', 'collection', 'filters'])
+
+
+class MockKuzzle(object):
+    LOG = logging.getLogger('MockKuzzle')
+
+    def __init__(self, host: str = 'localhost', port: int = 7512, command_rate: float = 0.0):
+        """
+        :param command_rate: state changes per second sent to the subscribed neopixels, as a dashboard would
+        """
+        self.host = host
+        self.port = port
+        self.command_rate = command_rate
+        self.documents = collections.defaultdict(dict)  # type: Dict[Tuple[str, str], Dict[str, dict]]
+        self.subscriptions = {}  # type: Dict[str, Subscription]
+        # (index, collection, device_id) => channels, device_id is None for the other filters
+        self.__routes = collections.defaultdict(set)  # type: Dict[Tuple[str, str, str], Set[str]]
+        self.server = None
+        self.__commands = None  # type: asyncio.Task
+
+        self.started = time.monotonic()
+        self.clients = 0
+        self.clients_max = 0
+        self.received = 0
+        self.states = 0
+        self.notifications = 0
+        self.commands = 0
+        self.actions = collections.Counter()
+
+    def server_info(self) -> bytes:
+        return serializer.dumps({
+            "status": 200,
+            "error": None,
+            "result": {"serverInfo": {"kuzzle": {"version": "mock"}}}
+        }).encode()
+
+    def process_request(self, *args):
+        """
+        HTTP requests that are not WebSocket upgrades. websockets < 14 calls it with (path, headers),
+        later versions with (connection, request)
+        """
+        if isinstance(args[0], str):
+            if args[0] == '/_serverInfo':
+                return http.HTTPStatus.OK, [('Content-Type', 'application/json')], self.server_info()
+            return None
+
+        connection, request = args
+        if request.path == '/_serverInfo':
+            response = connection.respond(http.HTTPStatus.OK, self.server_info().decode())
+            response.headers['Content-Type'] = 'application/json'
+            return response
+        return None
+
+    async def start(self):
+        self.server = await websockets.serve(self.__client_task, self.host, self.port,
+                                             process_request=self.process_request, max_size=None)
+        if self.command_rate > 0:
+            self.__commands = asyncio.get_event_loop().create_task(self.__commands_task())
+        self.LOG.info('Mock Kuzzle listening on ws://%s:%s', self.host, self.port)
+
+    async def stop(self):
+        if self.__commands is not None:
+            self.__commands.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def __client_task(self, ws, path: str = None):
+        self.clients += 1
+        self.clients_max = max(self.clients_max, self.clients)
+        try:
+            while True:
+                message = await ws.recv()
+                self.received += 1
+                query = serializer.loads(message)
+                await ws.send(serializer.dumps(self.handle(query, ws)))
+        except wse.ConnectionClosed:
+            pass
+        finally:
+            self.clients -= 1
+            for channel in [c for c, s in self.subscriptions.items() if s.ws is ws]:
+                self.__unsubscribe(channel)
+
+    @staticmethod
+    def response(query: dict, result, status: int = 200, error: str = None) -> dict:
+        return {
+            "status": status,
+            "requestId": query.get("requestId"),
+            "controller": query.get("controller"),
+            "action": query.get("action"),
+            "index": query.get("index"),
+            "collection": query.get("collection"),
+            "result": result,
+            "error": {"message": error, "stack": ""} if error else None,
+        }
+
+    def handle(self, query: dict, ws) -> dict:
+        controller, action = query.get("controller"), query.get("action")
+        self.actions[controller + ':' + action] += 1
+        index, collection = query.get("index"), query.get("collection")
+        documents = self.documents[(index, collection)]
+
+        if controller == 'document':
+            if action == 'get':
+                source = documents.get(query.get("_id"))
+                if source is None:
+                    return self.response(query, None, 404, 'Document not found')
+                return self.response(query, {"_id": query["_id"], "_source": source})
+
+            if action in ['create', 'createOrReplace', 'replace']:
+                _id = query.get("_id") or uuid.uuid4().hex
+                self.__store(query, _id, query.get("body") or {})
+                return self.response(query, {"_id": _id, "_source": query.get("body")})
+
+            if action == 'mCreate':
+                hits = []
+                for document in query["body"]["documents"]:
+                    _id = document.get("_id") or uuid.uuid4().hex
+                    self.__store(query, _id, document["body"], 'create')
+                    hits.append({"_id": _id, "_source": document["body"], "status": 201})
+                return self.response(query, {"hits": hits, "total": len(hits)})
+
+            if action == 'search':
+                size = query.get("size", 10)
+                hits = [{"_id": k, "_source": v} for k, v in list(documents.items())[:size]]
+                return self.response(query, {"hits": hits, "total": len(documents)})
+
+        if controller == 'realtime' and action == 'subscribe':
+            channel = self.__subscribe(Subscription(ws, index, collection, query.get("body") or {}))
+            return self.response(query, {"roomId": channel, "channel": channel})
+
+        return self.response(query, {})
+
+    def __store(self, query: dict, _id: str, source: dict, action: str = None):
+        index, collection = query.get("index"), query.get("collection")
+        if collection == KuzzleConnection.COLLECTION_DEVICE_STATES:
+            self.states += 1
+        else:
+            self.documents[(index, collection)][_id] = source
+        self.notify(index, collection, action or query["action"], _id, source, query.get("requestId"))
+
+    @staticmethod
+    def route(s: Subscription) -> Tuple[str, str, str]:
+        equals = s.filters.get("equals") or {}
+        device_id = equals.get("device_id") if list(equals) == ["device_id"] and len(s.filters) == 1 else None
+        return s.index, s.collection, device_id
+
+    def __subscribe(self, s: Subscription) -> str:
+        channel = uuid.uuid4().hex
+        self.subscriptions[channel] = s
+        self.__routes[self.route(s)].add(channel)
+        return channel
+
+    def __unsubscribe(self, channel: str):
+        s = self.subscriptions.pop(channel)
+        route = self.route(s)
+        self.__routes[route].discard(channel)
+        if not self.__routes[route]:
+            del self.__routes[route]
+
+    @staticmethod
+    def matches(filters: dict, source: dict) -> bool:
+        equals = filters.get("equals")
+        if not equals:
+            return True
+        return all(source.get(field) == value for field, value in equals.items())
+
+    def notify(self, index: str, collection: str, action: str, _id: str, source: dict, request_id: str = None):
+        channels = self.__routes.get((index, collection, source.get("device_id")), set()) | \
+            self.__routes.get((index, collection, None), set())
+        for channel in channels:
+            s = self.subscriptions[channel]
+            if not self.matches(s.filters, source):
+                continue
+            self.notifications += 1
+            notification = {
+                "status": 200,
+                "requestId": request_id,
+                "room": channel,
+                "controller": "document",
+                "action": action,
+                "index": index,
+                "collection": collection,
+                "scope": "in",
+                "result": {"_id": _id, "_source": source},
+            }
+            asyncio.get_event_loop().create_task(self.__send_task(s.ws, serializer.dumps(notification)))
+
+    @staticmethod
+    async def __send_task(ws, message: str):
+        try:
+            await ws.send(message)
+        except wse.ConnectionClosed:
+            pass
+
+    async def __commands_task(self):
+        """
+        Change the state of random neopixels, like the dashboard does
+        """
+        while True:
+            await asyncio.sleep(random.expovariate(self.command_rate))
+            neopixels = [s.filters["equals"]["device_id"] for s in self.subscriptions.values()
+                         if s.collection == KuzzleConnection.COLLECTION_DEVICE_STATES and
+                         s.filters.get("equals", {}).get("device_id", '').startswith('rgb_light_')]
+            if not neopixels:
+                continue
+            self.commands += 1
+            source = {
+                "device_id": random.choice(neopixels),
+                "device_type": "neopixel-linear",
+                "partial_state": True,
+                "state": {"mode": "single-color", "color": "#{:06X}".format(random.randrange(0x1000000))}
+            }
+            self.notify(KuzzleConnection.INDEX_IOT, KuzzleConnection.COLLECTION_DEVICE_STATES, 'create',
+                        uuid.uuid4().hex, source)
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "clients_max": self.clients_max,
+            "received": self.received,
+            "received_rate": self.received / elapsed if elapsed > 0 else 0.0,
+            "states": self.states,
+            "states_rate": self.states / elapsed if elapsed > 0 else 0.0,
+            "notifications": self.notifications,
+            "commands": self.commands,
+            "actions": dict(self.actions),
+        }
+
+
+def _serve(host: str, port: int, command_rate: float, ready, stop, results):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    logging.getLogger('websockets').setLevel(logging.WARNING)
+    mock = MockKuzzle(host, port, command_rate)
+    loop.run_until_complete(mock.start())
+    ready.set()
+    loop.run_until_complete(loop.run_in_executor(None, stop.wait))
+    results.put(mock.stats())
+    loop.run_until_complete(mock.stop())
+
+
+class MockKuzzleProcess(object):
+    """
+    A MockKuzzle serving from a child process, so its CPU time is not charged to the clients measured
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 7512, command_rate: float = 0.0):
+        self.__ready, self.__stop, self.__results = mp.Event(), mp.Event(), mp.Queue()
+        self.process = mp.Process(target=_serve, name='mock-kuzzle',
+                                  args=(host, port, command_rate, self.__ready, self.__stop, self.__results))
+
+    def start(self, timeout: float = 10.0) -> bool:
+        """
+        :return: False if the mock is not listening after timeout seconds
+        """
+        self.process.start()
+        if self.__ready.wait(timeout):
+            return True
+        self.process.terminate()
+        return False
+
+    def stop(self, timeout: float = 10.0) -> dict:
+        """
+        :return: the mock statistics, see MockKuzzle.stats
+        """
+        self.__stop.set()
+        stats = self.__results.get(timeout=timeout)
+        self.process.join(timeout)
+        return stats
@@ -15,6 +15,10 @@ yaml = YAML()
 
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'firmware'))
+
+import metrics
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
     sys.stdout.flush()
@@ -64,6 +68,11 @@ class AdminHTTPServer(HTTPServer):
         self.fw_config, self.hw_config = utils.load_configs(self.config_path)
         self.device_info["hw_config"] = self.hw_config
 
+    @property
+    def metrics_path(self) -> str:
+        metrics_cfg = self.fw_config.get('metrics') or {}
+        return metrics_cfg.get('path', metrics.DEFAULT_PATH)
+
     def save_fw_config(self):
         utils.save_fw_config(self.config_path, self.fw_config)
 
@@ -184,6 +193,18 @@ class AdminHTTPRequestHandler(SimpleHTTPRequestHandler):
                     self.wfile.write(bytes('\r\n', 'utf-8'))
                 except BrokenPipeError as e:
                     print('connection closed by client...')
+        elif self.path == "/metrics":
+            try:
+                content = bytes(metrics.exposition(self.server.metrics_path), 'utf-8')
+                status = HTTPStatus.OK
+            except (OSError, ValueError) as e:
+                content = bytes('Metrics unavailable: {}\n'.format(e), 'utf-8')
+                status = HTTPStatus.SERVICE_UNAVAILABLE
+            self.send_response(status)
+            self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-length", "{}".format(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
         elif self.path == "/reboot":
             content = bytes('<html><body><H1>Device rebooting...</H1></HTML></BODY>', 'utf-8')
             l = len(content)